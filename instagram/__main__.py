@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Command line entry point, e.g. python -m instagram posts <author id>
+# Author: Tishacy
+# Date: 2021-05-12
+import argparse
+
+# The tasks are imported by the commands running them, so that the cli starts fast.
+
+
+# Options of the cache of the raw responses, see add_cache_arguments.
+CACHE_OPTIONS = ['cache_dir', 'offline']
+
+
+def _kwargs(args, names):
+    """Keep the options given on the command line, so that the tasks use their own defaults."""
+    return {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+
+
+def cmd_posts(args):
+    from .instagram import task_fetch_posts, task_fetch_posts_and_comments, task_fetch_posts_and_download
+    if args.comments_out or args.comments_dir:
+        task_fetch_posts_and_comments(args.author_id, args.count, **_kwargs(
+            args, ['posts_out', 'comments_out', 'max_workers', 'resume', 'comments_dir', 'comments_ext']
+            + CACHE_OPTIONS))
+    elif args.pics_dir:
+        task_fetch_posts_and_download(args.author_id, args.count, **_kwargs(
+            args, ['posts_out', 'pics_dir', 'videos_dir', 'max_workers', 'store_dir'] + CACHE_OPTIONS))
+    else:
+        task_fetch_posts(args.author_id, args.count, **_kwargs(args, ['posts_out', 'resume'] + CACHE_OPTIONS))
+
+
+def cmd_tag_posts(args):
+    from .instagram import task_fetch_tag_posts, task_fetch_tag_posts_and_comments, \
+        task_fetch_tag_posts_and_download
+    if args.comments_out or args.comments_dir:
+        task_fetch_tag_posts_and_comments(args.tag_name, args.count, **_kwargs(
+            args, ['posts_out', 'comments_out', 'max_workers', 'resume', 'comments_dir', 'comments_ext']
+            + CACHE_OPTIONS))
+    elif args.pics_dir:
+        task_fetch_tag_posts_and_download(args.tag_name, args.count, **_kwargs(
+            args, ['posts_out', 'pics_dir', 'max_workers', 'store_dir'] + CACHE_OPTIONS))
+    else:
+        task_fetch_tag_posts(args.tag_name, args.count, **_kwargs(args, ['posts_out', 'resume'] + CACHE_OPTIONS))
+
+
+def cmd_new_posts(args):
+    from .instagram import task_fetch_new_posts, task_fetch_new_tag_posts
+    if args.tag:
+        task_fetch_new_tag_posts(args.name, **_kwargs(args, ['posts_out', 'state_fpath', 'first_count']))
+    else:
+        task_fetch_new_posts(args.name, **_kwargs(args, ['posts_out', 'state_fpath', 'first_count']))
+
+
+def cmd_targets(args):
+    from .instagram import task_fetch_targets
+    task_fetch_targets(args.targets_fpath, args.count, **_kwargs(
+        args, ['out_dir', 'out_ext', 'max_workers', 'resume'] + CACHE_OPTIONS))
+
+
+def cmd_download(args):
+    from .instagram import task_download_resources
+    task_download_resources(args.data_fpath, **_kwargs(
+        args, ['url_field', 'out_fields', 'out_dir', 'overwrite', 'store_dir', 'manifest_fpath', 'refresh_urls']))
+
+
+def cmd_retry_downloads(args):
+    from .instagram import task_retry_downloads
+    task_retry_downloads(args.manifest_fpath, **_kwargs(args, ['max_attempts', 'store_dir', 'refresh_urls']))
+
+
+def add_cache_arguments(sub_parser):
+    sub_parser.add_argument('--cache-dir', default=None, help="directory of the cache recording the raw responses")
+    sub_parser.add_argument('--offline', action='store_true', default=None,
+                            help="replay the responses recorded in --cache-dir without network")
+
+
+def build_arg_parser():
+    arg_parser = argparse.ArgumentParser(prog='python -m instagram', description="Crawl the posts and comments "
+                                         "of instagram authors and tags, and download their pics and videos.")
+    arg_parser.add_argument('--config', default=None,
+                            help="config file, $INSTAGRAM_CONFIG or config.ini of the working or project directory "
+                                 "by default")
+    arg_parser.add_argument('--metrics-file', default=None, help="Prometheus text file of the metrics of the crawl")
+    arg_parser.add_argument('--report-interval', type=float, default=60.0, help="seconds between the metrics summaries")
+    arg_parser.add_argument('--profile-dir', default=None, help="directory of the cpu profile of the crawl")
+    sub_parsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    for command, name, fn in [('posts', 'author_id', cmd_posts), ('tag-posts', 'tag_name', cmd_tag_posts)]:
+        sub_parser = sub_parsers.add_parser(command, help="fetch the posts of an %s" % name.split('_')[0])
+        sub_parser.set_defaults(fn=fn)
+        sub_parser.add_argument(name)
+        sub_parser.add_argument('--count', type=int, default=28 if command == 'posts' else 100,
+                                help="number of posts to fetch")
+        sub_parser.add_argument('--out', dest='posts_out', default=None, help="out file of the posts data")
+        sub_parser.add_argument('--comments-out', default=None,
+                                help="out file of the comments data, to fetch the comments of the posts too")
+        sub_parser.add_argument('--comments-dir', default=None,
+                                help="output directory of the comments partitioned by post and of their aggregates, "
+                                     "written as they are fetched instead of --comments-out")
+        sub_parser.add_argument('--comments-ext', default=None, help="extension of the files of --comments-dir")
+        sub_parser.add_argument('--pics-dir', default=None,
+                                help="output directory of the pics, to download them while fetching the posts")
+        if command == 'posts':
+            sub_parser.add_argument('--videos-dir', default=None, help="output directory of the videos")
+        sub_parser.add_argument('--store-dir', default=None, help="directory of the content-addressed media store")
+        sub_parser.add_argument('--max-workers', type=int, default=None, help="max number of workers")
+        sub_parser.add_argument('--resume', action='store_true', default=None,
+                                help="resume interrupted paginations from the checkpoints")
+        add_cache_arguments(sub_parser)
+
+    sub_parser = sub_parsers.add_parser('new-posts', help="fetch the posts published since the last run")
+    sub_parser.set_defaults(fn=cmd_new_posts)
+    sub_parser.add_argument('name', help="author id, or tag name with --tag")
+    sub_parser.add_argument('--tag', action='store_true', help="fetch the posts of a tag")
+    sub_parser.add_argument('--out', dest='posts_out', default=None, help="out file the new posts are appended to")
+    sub_parser.add_argument('--state', dest='state_fpath', default=None, help="file of the newest posts seen")
+    sub_parser.add_argument('--first-count', type=int, default=None,
+                            help="max number of posts fetched by the first run, 100 by default")
+
+    sub_parser = sub_parsers.add_parser('targets', help="fetch the posts of the authors and tags listed in a file")
+    sub_parser.set_defaults(fn=cmd_targets)
+    sub_parser.add_argument('targets_fpath', help="targets file, one '<kind>:<name>' per line")
+    sub_parser.add_argument('--count', type=int, default=None, help="number of posts to fetch of each target")
+    sub_parser.add_argument('--out-dir', default=None, help="output directory")
+    sub_parser.add_argument('--ext', dest='out_ext', default=None, help="extension of the output files")
+    sub_parser.add_argument('--max-workers', type=int, default=None, help="max number of pages queried at once")
+    sub_parser.add_argument('--resume', action='store_true', default=None,
+                            help="resume interrupted paginations from the checkpoints")
+    add_cache_arguments(sub_parser)
+
+    sub_parser = sub_parsers.add_parser('download', help="download the pics or videos listed in a data file")
+    sub_parser.set_defaults(fn=cmd_download)
+    sub_parser.add_argument('data_fpath', help="data file path")
+    sub_parser.add_argument('--url-field', default=None, help="field of the urls, display_image_url by default")
+    sub_parser.add_argument('--out-fields', nargs='+', default=None, help="fields of the output names")
+    sub_parser.add_argument('--out-dir', default=None, help="output directory")
+    sub_parser.add_argument('--overwrite', action='store_true', default=None, help="overwrite the existing files")
+    sub_parser.add_argument('--store-dir', default=None, help="directory of the content-addressed media store")
+    sub_parser.add_argument('--manifest', dest='manifest_fpath', default=None,
+                            help="manifest of the downloads, <out dir>/.manifest.db by default")
+    sub_parser.add_argument('--no-refresh', dest='refresh_urls', action='store_false', default=None,
+                            help="do not refresh the expired urls by querying their posts")
+
+    sub_parser = sub_parsers.add_parser('retry-downloads', help="download again the resources not done in a manifest")
+    sub_parser.set_defaults(fn=cmd_retry_downloads)
+    sub_parser.add_argument('manifest_fpath', help="manifest file path")
+    sub_parser.add_argument('--max-attempts', type=int, default=None,
+                            help="skip the resources which failed this number of times")
+    sub_parser.add_argument('--store-dir', default=None, help="directory of the content-addressed media store")
+    sub_parser.add_argument('--no-refresh', dest='refresh_urls', action='store_false', default=None,
+                            help="do not refresh the expired urls by querying their posts")
+    return arg_parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.config:
+        from .common import load_config
+        load_config(args.config)
+
+    from contextlib import nullcontext
+    from .metrics import MetricsReporter, profile
+    with MetricsReporter(interval=args.report_interval, fpath=args.metrics_file), \
+            (profile(args.profile_dir) if args.profile_dir else nullcontext()):
+        args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Pool of accounts used in rotation by queries
+# Author: Tishacy
+# Date: 2021-05-02
+import logging
+import threading
+
+from .common import get_config
+from .ratelimit import RateLimiter, DEFAULT_RATE_LIMITS
+from .sessions import new_session
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('accounts')
+
+ACCOUNT_SECTION_PREFIX = 'Account:'
+
+
+class Account:
+    """Credentials and proxies of an account.
+    :argument name: name of the account
+    :argument user_agent: user agent header
+    :argument cookie: cookie header of a logged in session
+    :argument http_proxy: (Str|None) proxy of http requests
+    :argument https_proxy: (Str|None) proxy of https requests
+    """
+    def __init__(self, name, user_agent, cookie, http_proxy=None, https_proxy=None):
+        self.name = name
+        self.user_agent = user_agent
+        self.cookie = cookie
+        self.http_proxy = http_proxy
+        self.https_proxy = https_proxy
+
+    @property
+    def proxies(self):
+        proxies = {}
+        if self.http_proxy:
+            proxies['http'] = self.http_proxy
+        if self.https_proxy:
+            proxies['https'] = self.https_proxy
+        return proxies
+
+    def __repr__(self):
+        return "Account{%s}" % self.name
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def load_accounts(parser=None):
+    """Load the accounts from the '[Account:<name>]' sections of the config, which
+    have the same options as the '[HttpSession]' section, e.g.
+        [Account:alice]
+        UserAgent : Mozilla/5.0 ...
+        Cookie : sessionid=...
+        HttpsProxy : http://127.0.0.1:1087
+    :param parser: (configparser.ConfigParser|None) parsed config, the one of the default config by default
+    :rtype List[Account]:
+    """
+    parser = parser or get_config().parser
+    accounts = []
+    for section in parser.sections():
+        if not section.startswith(ACCOUNT_SECTION_PREFIX):
+            continue
+        options = parser[section]
+        accounts.append(Account(
+            name=section[len(ACCOUNT_SECTION_PREFIX):].strip(),
+            user_agent=options.get('UserAgent', parser.get('HttpSession', 'UserAgent', fallback='')),
+            cookie=options['Cookie'],
+            http_proxy=options.get('HttpProxy'),
+            https_proxy=options.get('HttpsProxy'),
+        ))
+    return accounts
+
+
+class PooledSession:
+    """A http session of a pool, with its own rate limiter and health stats.
+    :argument sess: (requests.Session) http session
+    :argument rate_limiter: (RateLimiter) rate limiter of the session
+    :argument proxies: (Dict) proxies of requests
+    :argument name: name of the session
+    """
+    def __init__(self, sess, rate_limiter, proxies=None, name='default'):
+        self.sess = sess
+        self.rate_limiter = rate_limiter
+        self.proxies = proxies or {}
+        self.name = name
+        self.requests_count = 0
+        self.success_count = 0
+        self.throttle_count = 0
+        # Throttled responses in a row, which makes the cooldown grow exponentially.
+        self.consecutive_throttles = 0
+
+    @classmethod
+    def from_account(cls, account, rate_limiter=None):
+        """Create a session logged in as the account.
+        :param account: (Account) account
+        :param rate_limiter: (RateLimiter|None) rate limiter, a new one with the default query settings by default
+        :rtype PooledSession:
+        """
+        sess = new_session({
+            'User-Agent': account.user_agent,
+            'Cookie': account.cookie
+        })
+        rate_limiter = rate_limiter or RateLimiter(**DEFAULT_RATE_LIMITS['query'])
+        return cls(sess, rate_limiter, account.proxies, account.name)
+
+    @property
+    def stats(self):
+        return {
+            'name': self.name,
+            'rate': round(self.rate_limiter.rate, 3),
+            'cooldown': round(self.rate_limiter.wait_time(), 3),
+            'requests': self.requests_count,
+            'successes': self.success_count,
+            'throttles': self.throttle_count,
+        }
+
+    def __repr__(self):
+        return "PooledSession{%s}" % self.name
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class SessionPool:
+    """Pool of http sessions handed out per request.
+    Each request goes to the session which can send it the soonest, so the requests
+    are spread over all the accounts and the aggregate rate is the sum of the rates of
+    the accounts. A throttled session is paused by its rate limiter for an exponential
+    backoff, which takes it out of the rotation until it cools down while the other
+    sessions keep working.
+    :argument sessions: (List[PooledSession]) sessions of the pool
+    """
+    def __init__(self, sessions):
+        if not sessions:
+            raise ValueError("A session pool needs at least one session.")
+        self.sessions = list(sessions)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_accounts(cls, accounts):
+        """Create a pool with a session of each account.
+        :param accounts: (List[Account]) accounts
+        :rtype SessionPool:
+        """
+        return cls([PooledSession.from_account(account) for account in accounts])
+
+    @property
+    def max_retries(self):
+        return max(session.rate_limiter.max_retries for session in self.sessions)
+
+    def _pick(self):
+        with self._lock:
+            session = min(self.sessions, key=lambda s: (s.rate_limiter.wait_time(), s.requests_count))
+            session.requests_count += 1
+            return session
+
+    def acquire(self):
+        """Block until a session of the pool is allowed to send a request.
+        :rtype PooledSession:
+        """
+        session = self._pick()
+        session.rate_limiter.acquire()
+        return session
+
+    async def acquire_async(self):
+        """Wait on the event loop until a session of the pool is allowed to send a request.
+        :rtype PooledSession:
+        """
+        session = self._pick()
+        await session.rate_limiter.acquire_async()
+        return session
+
+    def on_success(self, session):
+        """Record a successful request of a session.
+        :param session: (PooledSession) session which sent the request
+        :return None:
+        """
+        with self._lock:
+            session.success_count += 1
+            session.consecutive_throttles = 0
+        session.rate_limiter.on_success()
+
+    def on_throttle(self, session, retry_after=None):
+        """Record a throttled or failed request of a session and cool the session down.
+        :param session: (PooledSession) session which sent the request
+        :param retry_after: (Float|None) delay in seconds asked by the server
+        :rtype Float: cooldown in seconds of the session
+        """
+        with self._lock:
+            session.throttle_count += 1
+            attempt = session.consecutive_throttles
+            session.consecutive_throttles += 1
+        return session.rate_limiter.on_throttle(attempt, retry_after)
+
+    @property
+    def stats(self):
+        """Health and throttle state of each session.
+        :rtype List[Dict]:
+        """
+        return [session.stats for session in self.sessions]
+
+
+_session_pools = {}
+_session_pools_lock = threading.Lock()
+
+
+def get_session_pool(config=None):
+    """Get the pool of the accounts of a config shared in the process.
+    :param config: (Config|None) config, the default one by default
+    :rtype SessionPool|None: None if no account is configured
+    """
+    config = config or get_config()
+    with _session_pools_lock:
+        if config not in _session_pools:
+            accounts = load_accounts(config.parser)
+            if not accounts:
+                return None
+            logger.info("Rotating %d accounts: %s" % (len(accounts), ', '.join(a.name for a in accounts)))
+            _session_pools[config] = SessionPool.from_accounts(accounts)
+        return _session_pools[config]
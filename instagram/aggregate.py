@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Aggregates of the comments computed while they are streamed
+# Author: Tishacy
+# Date: 2021-05-16
+from collections import Counter
+
+
+class CommentAggregate:
+    """Aggregates of the comments of a post, updated page by page so that the comments
+    are never held all at once. Only the number of comments of each commenter of the
+    post is kept until the post is done.
+    :argument post_short_code: (Str) short code of the post
+    :argument top_k: (Int) number of top commenters of the row
+    """
+    def __init__(self, post_short_code, top_k=10):
+        self.post_short_code = post_short_code
+        self.top_k = top_k
+        self.count = 0
+        self.likes_sum = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self._commenters = Counter()
+
+    def add(self, comments):
+        """Add a page of comments of the post.
+        :param comments: (List[Dict]) comments
+        :return None:
+        """
+        for comment in comments:
+            self.count += 1
+            self.likes_sum += comment['likes_count'] or 0
+            self._commenters[comment['username']] += 1
+            timestamp = comment['timestamp']
+            if timestamp is not None:
+                if self.first_timestamp is None or timestamp < self.first_timestamp:
+                    self.first_timestamp = timestamp
+                if self.last_timestamp is None or timestamp > self.last_timestamp:
+                    self.last_timestamp = timestamp
+
+    def top_commenters(self):
+        """Get the commenters of the most comments of the post.
+        :rtype List[Tuple[Str, Int]]: usernames and their numbers of comments
+        """
+        return self._commenters.most_common(self.top_k)
+
+    def to_dict(self):
+        """Convert the aggregates to a row, whose top commenters are joined as 'username:count'.
+        :rtype Dict:
+        """
+        return {
+            'post_short_code': self.post_short_code,
+            'comments_count': self.count,
+            'likes_sum': self.likes_sum,
+            'first_timestamp': self.first_timestamp,
+            'last_timestamp': self.last_timestamp,
+            'top_commenters': ','.join('%s:%d' % (username, n) for username, n in self.top_commenters()),
+        }
+
+    def __repr__(self):
+        return "CommentAggregate%s" % self.to_dict()
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+# Asyncio-based query and download engine
+# Author: Tishacy
+# Date: 2021-04-10
+import os
+import json
+import asyncio
+import logging
+import aiohttp
+
+from .parser import PostParser, CommentParser, TagPostParser
+from .instagram import load_resources
+from .sink import open_sink
+from .ratelimit import RetryError, get_rate_limiter, parse_retry_after
+from .jsonlib import loads
+from .common import get_config
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('aio')
+
+
+def init_sess(limit=1000, limit_per_host=100, config=None):
+    """Create an aiohttp session, which must be called inside a running event loop.
+    :param limit: (Int) max number of connections in total
+    :param limit_per_host: (Int) max number of connections to the same host
+    :param config: (Config|None) config of the user agent and cookie, the default one by default
+    :rtype aiohttp.ClientSession:
+    """
+    config = config or get_config()
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+    return aiohttp.ClientSession(connector=connector, headers={
+        'User-Agent': config.user_agent,
+        'Cookie': config.cookie
+    })
+
+
+def _init_proxy(url):
+    config = get_config()
+    if url.startswith('https') and config.https_proxy:
+        return config.https_proxy
+    return config.http_proxy
+
+
+class AsyncQuery:
+    """Async query class of instagram api, sharing the parser contract of Query.
+    :argument parser_cls: a parser class
+    :argument sess: an aiohttp session created by init_sess()
+    :argument rate_limiter: (RateLimiter|None) rate limiter, the one shared in the process by default
+    """
+    def __init__(self, parser_cls, sess, rate_limiter=None):
+        self._parser_cls = parser_cls
+        self._sess = sess
+        self._rate_limiter = rate_limiter or get_rate_limiter('query')
+        self._base_api = "https://www.instagram.com/graphql/query/?query_hash=%s&variables=%s"
+
+    async def _fetch(self, url):
+        """Fetch the data of the url, retrying with backoff while being throttled, see Query._fetch.
+        :param url: (Str) filled api url
+        :rtype Dict:
+        """
+        for attempt in range(self._rate_limiter.max_retries + 1):
+            await self._rate_limiter.acquire_async()
+            retry_after = None
+            try:
+                async with self._sess.get(url, proxy=_init_proxy(url)) as res:
+                    retry_after = parse_retry_after(res.headers)
+                    data = loads(await res.read())
+                if res.status != 429 and ('status' not in data or data['status'] == 'ok'):
+                    self._rate_limiter.on_success()
+                    return data
+                reason = "status code %s, %s" % (res.status, data.get('message', data.get('status')))
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                reason = repr(e)
+
+            delay = self._rate_limiter.on_throttle(attempt, retry_after)
+            logger.info("Throttled (%s), retrying in %.1fs..." % (reason, delay))
+
+        raise RetryError("Still throttled after %d retries: %s" % (self._rate_limiter.max_retries, url))
+
+    async def query_batch(self, query_hash, variables):
+        """Query batch data.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :rtype Tuple[List[Dict], Dict, Dict]:
+        """
+        dump_variables = json.dumps(variables)
+        filled_api = self._base_api % (query_hash, dump_variables)
+
+        data = await self._fetch(filled_api)
+
+        parser = self._parser_cls(data, variables)
+        parsed_data = parser.parse_data()
+        next_variables = parser.parse_next_variables()
+        page_info = parser.parse_page_info()
+        return parsed_data, next_variables, page_info
+
+    async def iter_pages(self, query_hash, variables, total_count=None):
+        """Iterate over the pages of data, see Query.iter_pages.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :param total_count: (Int) max number of data
+        :rtype AsyncIterator[Tuple[List[Dict], Dict]]:
+        """
+        count = 0
+        has_next = True
+        while has_next:
+            parsed_data, variables, page_info = await self.query_batch(query_hash, variables)
+            has_next = page_info['has_next']
+
+            if total_count and count + len(parsed_data) >= total_count:
+                parsed_data = parsed_data[:total_count - count]
+                has_next = False
+
+            count += len(parsed_data)
+            logger.info("Current count of data: %s, has next: %s" % (count, page_info['has_next']))
+            yield parsed_data, page_info
+
+    async def query_all(self, query_hash, variables, total_count=None):
+        """Query all data.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :param total_count: (Int) max number of data
+        :rtype List[Dict]:
+        """
+        all_data = []
+        async for parsed_data, _ in self.iter_pages(query_hash, variables, total_count):
+            all_data.extend(parsed_data)
+        return all_data
+
+
+class AsyncDownloader:
+    """Async downloader of resources.
+    :argument sess: an aiohttp session created by init_sess()
+    :argument max_concurrency: max number of resources downloaded at the same time
+    :argument rate_limiter: (RateLimiter|None) rate limiter, the one shared in the process by default
+    """
+    def __init__(self, sess, max_concurrency=100, rate_limiter=None):
+        self._sess = sess
+        self._rate_limiter = rate_limiter or get_rate_limiter('download')
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _download_item(self, url, out, timeout=6, overwrite=False):
+        """Download a resource from url to local file.
+        :param url: (str) resource url to download
+        :param out: (str) output file path.
+        :param overwrite: (bool) whether to overwrite the existing file
+        :rtype Bool:
+        """
+        _dir, _ = os.path.split(out)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
+
+        if os.path.exists(out) and not overwrite:
+            logger.info("File %s already exists." % out)
+            return True
+
+        try:
+            async with self._semaphore:
+                logger.info("Fetch the url: %s." % url)
+                client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+                for attempt in range(self._rate_limiter.max_retries + 1):
+                    await self._rate_limiter.acquire_async()
+                    async with self._sess.get(url, timeout=client_timeout, proxy=_init_proxy(url)) as res:
+                        if res.status == 429:
+                            delay = self._rate_limiter.on_throttle(attempt, parse_retry_after(res.headers))
+                            logger.info("Throttled when fetching the url: %s, retrying in %.1fs..." % (url, delay))
+                            continue
+                        self._rate_limiter.on_success()
+                        if str(res.status)[0] != '2':
+                            return False
+                        with open(out + '.part', 'wb') as file:
+                            async for chunk in res.content.iter_chunked(64 * 1024):
+                                file.write(chunk)
+                        os.replace(out + '.part', out)
+                        break
+                else:
+                    return False
+            logger.info("Saved the url to %s." % out)
+            return True
+
+        except Exception:
+            logger.warning("Failed to fetch the url: %s." % url)
+            return False
+
+    async def download(self, resources, overwrite=False):
+        """Download a bunch of resources from url to local file.
+        :param resources: (Iterable[Resource]) A sequence of Resources.
+        :param overwrite: (bool) whether to overwrite the existing file
+        :rtype Dict[Resource, Bool]:
+        """
+        resources = list(resources)
+        if len(resources) == 0:
+            raise ValueError("Urls' length must be greater than 0.")
+
+        results = await asyncio.gather(*[
+            self._download_item(resource.url, resource.out, 6, overwrite) for resource in resources
+        ])
+        return dict(zip(resources, results))
+
+
+async def query_comments_of_posts(comment_query, post_data, count_per_post=None, max_concurrency=100):
+    """Query the comments of the given posts concurrently, see instagram.query_comments_of_posts.
+    :param comment_query: (AsyncQuery) query instance with a CommentParser
+    :param post_data: (List[Dict]) posts data, each one has a 'short_code'
+    :param count_per_post: (Int|None) max number of comments of each post
+    :param max_concurrency: (Int) max number of posts queried at the same time
+    :rtype List[Dict]:
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def query_comments_of_one_post(i, post):
+        async with semaphore:
+            logger.info("Get comment of %d %s" % (i, post['short_code']))
+            comment_data_of_one_post = await comment_query.query_all(get_config().comments_query_hash, {
+                "shortcode": post['short_code'],
+                "first": 50,
+            }, count_per_post)
+        for comment in comment_data_of_one_post:
+            comment['post_short_code'] = post['short_code']
+        return comment_data_of_one_post
+
+    comment_data = []
+    for comment_data_of_one_post in await asyncio.gather(*[
+            query_comments_of_one_post(i, post) for i, post in enumerate(post_data)]):
+        comment_data.extend(comment_data_of_one_post)
+    return comment_data
+
+
+async def _fetch_posts_and_comments(parser_cls, query_hash, variables, count, count_per_post,
+                                    posts_out, comments_out, max_concurrency):
+    async with init_sess() as sess:
+        post_query = AsyncQuery(parser_cls, sess)
+        post_data = []
+        with open_sink(posts_out) as sink:
+            async for parsed_data, _ in post_query.iter_pages(query_hash, variables, count):
+                sink.write(parsed_data)
+                if comments_out is not None:
+                    post_data.extend(parsed_data)
+        logger.info("Count of posts data: %d" % sink.count)
+        logger.info("Save the posts data to %s." % posts_out)
+
+        if comments_out is None:
+            return
+
+        comment_query = AsyncQuery(CommentParser, sess)
+        comment_data = await query_comments_of_posts(comment_query, post_data, count_per_post, max_concurrency)
+        logger.info("Count of comment_data: %d" % len(comment_data))
+
+        with open_sink(comments_out) as sink:
+            sink.write(comment_data)
+        logger.info("Save the comments data to %s." % comments_out)
+
+
+async def async_task_fetch_posts_and_comments(
+        author_id,
+        count=28,
+        posts_out='data/posts_data.xlsx',
+        comments_out='data/comments_data.xlsx',
+        max_concurrency=100):
+    """[Task] Async version of instagram.task_fetch_posts_and_comments."""
+    await _fetch_posts_and_comments(PostParser, get_config().posts_query_hash, {
+        "id": author_id,
+        "first": 50,
+    }, count, None, posts_out, comments_out, max_concurrency)
+
+
+async def async_task_fetch_tag_posts_and_comments(
+        tag_name,
+        count=100,
+        posts_out='data/tag_posts_data.xlsx',
+        comments_out='data/tag_comments_data.xlsx',
+        max_concurrency=100):
+    """[Task] Async version of instagram.task_fetch_tag_posts_and_comments."""
+    await _fetch_posts_and_comments(TagPostParser, get_config().tag_posts_query_hash, {
+        "tag_name": tag_name,
+        "first": 50,
+    }, count, 100, posts_out, comments_out, max_concurrency)
+
+
+async def async_task_fetch_posts(
+        author_id,
+        count=28,
+        posts_out='data/posts_data.xlsx'):
+    """[Task] Async version of instagram.task_fetch_posts."""
+    await _fetch_posts_and_comments(PostParser, get_config().posts_query_hash, {
+        "id": author_id,
+        "first": 50,
+    }, count, None, posts_out, None, 1)
+
+
+async def async_task_fetch_tag_posts(
+        tag_name,
+        count=100,
+        posts_out='data/tag_posts_data.xlsx'):
+    """[Task] Async version of instagram.task_fetch_tag_posts."""
+    await _fetch_posts_and_comments(TagPostParser, get_config().tag_posts_query_hash, {
+        "tag_name": tag_name,
+        "first": 50,
+    }, count, None, posts_out, None, 1)
+
+
+async def async_task_download_resources(data_fpath, url_field='display_image_url', out_fields=None, out_dir='pics',
+                                        overwrite=False, max_concurrency=1000, limit_per_host=100):
+    """[Task] Async version of instagram.task_download_resources."""
+    resources = load_resources(data_fpath, url_field, out_fields, out_dir)
+    async with init_sess(max_concurrency, limit_per_host) as sess:
+        downloader = AsyncDownloader(sess, max_concurrency)
+        await downloader.download(resources, overwrite)
+
+
+# Entry points running the async tasks on a new event loop.
+def run_task_fetch_posts_and_comments(*args, **kwargs):
+    return asyncio.run(async_task_fetch_posts_and_comments(*args, **kwargs))
+
+
+def run_task_fetch_tag_posts_and_comments(*args, **kwargs):
+    return asyncio.run(async_task_fetch_tag_posts_and_comments(*args, **kwargs))
+
+
+def run_task_fetch_posts(*args, **kwargs):
+    return asyncio.run(async_task_fetch_posts(*args, **kwargs))
+
+
+def run_task_fetch_tag_posts(*args, **kwargs):
+    return asyncio.run(async_task_fetch_tag_posts(*args, **kwargs))
+
+
+def run_task_download_resources(*args, **kwargs):
+    return asyncio.run(async_task_download_resources(*args, **kwargs))
@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+# Offline benchmarks against a local mock of the GraphQL api and the CDN
+# Author: Tishacy
+# Date: 2021-05-02
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import subprocess
+from datetime import datetime
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+from . import query, ratelimit, common
+from .query import Query
+from . import jsonlib
+from .parser import PostParser, CommentParser, TagPostParser, as_dict
+from .downloader import Downloader, Resource
+from .ratelimit import RateLimiter
+from .sessions import pool_stats
+from .common import get_config
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    # The workers of a pool connect at once, which would overflow the default backlog of 5
+    # connections and wait for the retransmission of the dropped connections.
+    request_queue_size = 128
+
+
+class MockServer:
+    """Local stand-in of the GraphQL api and the CDN.
+    Every user timeline, hashtag and comment list has `pages` pages of `page_size` items
+    in the shapes expected by PostParser, TagPostParser and CommentParser, and every
+    media is a blob of `media_size` bytes.
+    :argument pages: number of pages of each pagination
+    :argument page_size: number of items of each page
+    :argument media_size: number of bytes of each media
+    :argument latency: seconds waited before each response
+    :argument error_rate: rate of throttled responses
+    :argument seed: seed of the random throttled responses
+    """
+    def __init__(self, pages=10, page_size=50, media_size=100 * 1024, latency=0.0, error_rate=0.0, seed=0):
+        self.pages = pages
+        self.page_size = page_size
+        self.media_size = media_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bytes_sent = 0
+        self.requests_count = 0
+        self.pages_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._blob = os.urandom(media_size)
+        self._server = _MockHTTPServer(('127.0.0.1', 0), self._handler_cls())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    @property
+    def base_api(self):
+        return self.url + "/graphql/query/?query_hash=%s&variables=%s"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _is_throttled(self):
+        with self._lock:
+            self.requests_count += 1
+            return self._random.random() < self.error_rate
+
+    def _post_node(self, key, i):
+        short_code = "%s%d" % (key, i)
+        is_video = i % 5 == 0
+        return {
+            'id': str(10 ** 9 - i),
+            'shortcode': short_code,
+            'edge_media_to_caption': {'edges': [{'node': {'text': "Post %d of %s #benchmark" % (i, key)}}]},
+            'display_url': "%s/media/%s.jpg?oe=%x&_nc_sig=%d" % (self.url, short_code, 2 ** 32 - 1, i),
+            'is_video': is_video,
+            'video_url': "%s/media/%s.mp4?oe=%x" % (self.url, short_code, 2 ** 32 - 1) if is_video else None,
+            'taken_at_timestamp': 1600000000 - i * 60,
+            'edge_media_preview_like': {'count': i * 7},
+            'edge_media_to_comment': {'count': self.pages * self.page_size},
+        }
+
+    def _comment_node(self, key, i):
+        return {
+            'id': "%s-%d" % (key, i),
+            'created_at': 1600000000 - i,
+            'text': "Comment %d of %s" % (i, key),
+            'owner': {'username': "user%d" % (i % 97)},
+            'edge_liked_by': {'count': i % 13},
+        }
+
+    def graphql_page(self, variables):
+        """Build the response of a page.
+        :param variables: (Dict) query variables
+        :rtype Dict:
+        """
+        page = int(variables.get('after') or 0)
+        first = page * self.page_size
+        page_info = {'end_cursor': str(page + 1), 'has_next_page': page + 1 < self.pages}
+
+        if 'shortcode' in variables:
+            edges = [{'node': self._comment_node(variables['shortcode'], first + k)} for k in range(self.page_size)]
+            return {'data': {'shortcode_media': {
+                'edge_media_to_parent_comment': {'edges': edges, 'page_info': page_info}}}, 'status': 'ok'}
+
+        key = 'u%s_' % variables['id'] if 'id' in variables else 't%s_' % variables['tag_name']
+        edges = [{'node': self._post_node(key, first + k)} for k in range(self.page_size)]
+        if 'id' in variables:
+            return {'data': {'user': {
+                'edge_owner_to_timeline_media': {'edges': edges, 'page_info': page_info}}}, 'status': 'ok'}
+        return {'data': {'hashtag': {
+            'edge_hashtag_to_media': {'edges': edges, 'page_info': page_info}}}, 'status': 'ok'}
+
+    def _handler_cls(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, which would wait for delayed acks.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server._lock:
+                    server.bytes_sent += len(body)
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                url = urlsplit(self.path)
+
+                if url.path.startswith('/media/'):
+                    if server._is_throttled():
+                        return self._send(429, b'', 'text/plain')
+                    return self._send(200, server._blob, 'image/jpeg')
+
+                if server._is_throttled():
+                    body = {'message': 'Please wait a few minutes before you try again.', 'status': 'fail'}
+                    return self._send(200, json.dumps(body).encode(), 'application/json')
+                variables = json.loads(parse_qs(url.query)['variables'][0])
+                with server._lock:
+                    server.pages_sent += 1
+                return self._send(200, json.dumps(server.graphql_page(variables)).encode(), 'application/json')
+
+        return Handler
+
+
+def _unthrottled_rate_limiter():
+    return RateLimiter(rate=1e6, burst=10 ** 6, max_rate=1e6, base_delay=0.01, max_delay=0.1)
+
+
+@contextmanager
+def local_environment(server, latencies):
+    """Point the queries and downloaders created inside at the mock server, without
+    proxies and throttling, and record the latency of each request.
+    :param server: (MockServer) running mock server
+    :param latencies: (List[Float]) list the latencies are appended to
+    """
+    saved_send = requests.Session.send
+    saved = (query.BASE_API, common._config, dict(ratelimit._rate_limiters))
+
+    def send(sess, request, **kwargs):
+        start = time.perf_counter()
+        res = saved_send(sess, request, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        return res
+
+    requests.Session.send = send
+    query.BASE_API = server.base_api
+    # The default config has no cookie, accounts and proxies.
+    common.set_config(common.Config())
+    ratelimit._rate_limiters['query'] = _unthrottled_rate_limiter()
+    ratelimit._rate_limiters['download'] = _unthrottled_rate_limiter()
+    try:
+        yield
+    finally:
+        requests.Session.send = saved_send
+        query.BASE_API, config, rate_limiters = saved
+        common.set_config(config)
+        ratelimit._rate_limiters.clear()
+        ratelimit._rate_limiters.update(rate_limiters)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_benchmark(name, server, fn):
+    """Run a benchmark and measure its throughput.
+    :param name: (Str) name of the benchmark
+    :param server: (MockServer) running mock server
+    :param fn: (Callable[[], Int]) benchmark returning its number of items
+    :rtype Dict:
+    """
+    latencies = []
+    bytes_sent, pages_sent = server.bytes_sent, server.pages_sent
+    stats = pool_stats()
+    with local_environment(server, latencies):
+        start = time.perf_counter()
+        items = fn()
+        elapsed = time.perf_counter() - start
+    new_stats = pool_stats()
+    requests_count = new_stats['requests'] - stats['requests']
+    pages = server.pages_sent - pages_sent
+    mb = (server.bytes_sent - bytes_sent) / 1024 / 1024
+    return {
+        'name': name,
+        'seconds': round(elapsed, 3),
+        'pages/sec': round(pages / elapsed, 1),
+        'items/sec': round(items / elapsed, 1),
+        'MB/sec': round(mb / elapsed, 2),
+        'p50 latency (ms)': round(_percentile(latencies, 0.5) * 1000, 2),
+        'p99 latency (ms)': round(_percentile(latencies, 0.99) * 1000, 2),
+        'conn reuse': round((new_stats['hits'] - stats['hits']) / requests_count, 3) if requests_count else 0.0,
+        # ru_maxrss is the peak of the whole process so far, in kilobytes on linux.
+        'peak RSS (MB)': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def benchmark_query_all(server, parser_cls, query_hash, variables):
+    def fn():
+        return len(Query(parser_cls).query_all(query_hash, variables))
+    return fn
+
+
+def benchmark_download(server, out_dir, count, max_workers):
+    def fn():
+        resources = [Resource("%s/media/d%d.jpg?oe=ffffffff" % (server.url, i), os.path.join(out_dir, "d%d.jpg" % i))
+                     for i in range(count)]
+        results = Downloader(max_workers=max_workers).download(resources, overwrite=True)
+        return sum(results.values())
+    return fn
+
+
+def benchmark_task(task, count, *args, **kwargs):
+    def fn():
+        task(*args, **kwargs)
+        return count
+    return fn
+
+
+def run_all(pages=10, page_size=50, media_size=100 * 1024, latency=0.0, error_rate=0.0,
+            downloads=200, max_workers=16):
+    """Run all the benchmarks against a new mock server.
+    :rtype List[Dict]:
+    """
+    from .instagram import task_fetch_posts_and_comments, task_fetch_posts_and_download
+
+    out_dir = tempfile.mkdtemp(prefix='instagram-benchmark-')
+    try:
+        with MockServer(pages, page_size, media_size, latency, error_rate) as server:
+            n_posts = min(pages * page_size, 200)
+            return [
+                run_benchmark('Query.query_all posts', server, benchmark_query_all(
+                    server, PostParser, get_config().posts_query_hash, {"id": "1", "first": page_size})),
+                run_benchmark('Query.query_all tag posts', server, benchmark_query_all(
+                    server, TagPostParser, get_config().tag_posts_query_hash, {"tag_name": "bench", "first": page_size})),
+                run_benchmark('Query.query_all comments', server, benchmark_query_all(
+                    server, CommentParser, get_config().comments_query_hash, {"shortcode": "bench", "first": page_size})),
+                run_benchmark('Downloader.download', server, benchmark_download(
+                    server, os.path.join(out_dir, 'download'), downloads, max_workers)),
+                run_benchmark('task_fetch_posts_and_comments', server, benchmark_task(
+                    task_fetch_posts_and_comments, n_posts * (1 + pages * page_size), "1", n_posts,
+                    os.path.join(out_dir, 'posts.jsonl'), os.path.join(out_dir, 'comments.jsonl'), max_workers)),
+                run_benchmark('task_fetch_posts_and_download', server, benchmark_task(
+                    task_fetch_posts_and_download, n_posts, "1", n_posts, os.path.join(out_dir, 'posts.jsonl'),
+                    os.path.join(out_dir, 'pics'), os.path.join(out_dir, 'videos'), max_workers)),
+            ]
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def _parser_cls_of(data):
+    if 'user' in data['data']:
+        return PostParser
+    if 'hashtag' in data['data']:
+        return TagPostParser
+    return CommentParser
+
+
+def load_pages(cache_dir=None, pages=10, page_size=50):
+    """Load raw pages recorded by a ResponseCache, or synthetic ones of the mock server.
+    :param cache_dir: (Str|None) root of a ResponseCache
+    :rtype List[Bytes]:
+    """
+    if cache_dir is not None:
+        contents = []
+        for _dir, _, fnames in os.walk(cache_dir):
+            for fname in sorted(fnames):
+                if fname.endswith('.json'):
+                    with open(os.path.join(_dir, fname), 'rb') as file:
+                        contents.append(file.read())
+        return contents
+
+    server = MockServer(pages, page_size)
+    try:
+        return [json.dumps(server.graphql_page(variables)).encode()
+                for variables in [{"id": "1", "after": str(i)} for i in range(pages)]
+                + [{"tag_name": "bench", "after": str(i)} for i in range(pages)]
+                + [{"shortcode": "bench", "after": str(i)} for i in range(pages)]]
+    finally:
+        server.stop()
+
+
+def _eager_time(timestamp):
+    return datetime.fromtimestamp(int(timestamp)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _eager_post(node, with_video):
+    caption_edges = node['edge_media_to_caption']['edges']
+    row = {
+        'id': node['id'],
+        'short_code': node['shortcode'],
+        'text': caption_edges[0]['node']['text'] if len(caption_edges) > 0 else '',
+        'display_image_url': node['display_url'],
+        'is_video': node['is_video'],
+    }
+    if with_video:
+        row['video_url'] = node['video_url'] if node['is_video'] else ''
+    row.update({
+        'timestamp': node['taken_at_timestamp'],
+        'formatted-time': _eager_time(node['taken_at_timestamp']),
+        'likes_count': node['edge_media_preview_like']['count'],
+        'comments_count': node['edge_media_to_comment']['count'],
+    })
+    return row
+
+
+def eager_parse(data):
+    """Parse a page the way the parsers did before the records, into dicts whose times are
+    formatted while parsing, which is the baseline of the parse benchmark.
+    :param data: (Dict) decoded page
+    :rtype List[Dict]:
+    """
+    parser_cls = _parser_cls_of(data)
+    if parser_cls is PostParser:
+        edges = data['data']['user']['edge_owner_to_timeline_media']['edges']
+        return [_eager_post(edge['node'], True) for edge in edges]
+    if parser_cls is TagPostParser:
+        edges = data['data']['hashtag']['edge_hashtag_to_media']['edges']
+        return [_eager_post(edge['node'], False) for edge in edges]
+    edges = data['data']['shortcode_media']['edge_media_to_parent_comment']['edges']
+    return [{
+        'id': edge['node']['id'],
+        'timestamp': edge['node']['created_at'],
+        'formatted-time': _eager_time(edge['node']['created_at']),
+        'text': edge['node']['text'],
+        'username': edge['node']['owner']['username'],
+        'likes_count': edge['node']['edge_liked_by']['count'],
+    } for edge in edges]
+
+
+def run_parse_benchmark(contents, repeat=5):
+    """Microbenchmark of the decoding and parsing of raw pages, without network. The end to
+    end stages decode, parse and convert the pages to the dicts written by the sinks, the
+    baseline with json.loads(str) and the eager parse of eager_parse, and the current one
+    with jsonlib.loads, the records of parse_data and their to_dict.
+    :param contents: (List[Bytes]) raw pages
+    :param repeat: (Int) number of runs, of which the fastest one is kept
+    :rtype List[Dict]:
+    """
+    data_list = [json.loads(content) for content in contents]
+    n_items = sum(len(_parser_cls_of(data)(data, {}).parse_data()) for data in data_list)
+
+    def parse_all():
+        return [row for data in data_list for row in _parser_cls_of(data)(data, {}).parse_data()]
+
+    def baseline():
+        return [row for content in contents for row in eager_parse(json.loads(content.decode()))]
+
+    def end_to_end():
+        rows = []
+        for content in contents:
+            data = jsonlib.loads(content)
+            rows.extend(as_dict(row) for row in _parser_cls_of(data)(data, {}).parse_data())
+        return rows
+
+    rows = parse_all()
+    if baseline() != end_to_end():
+        raise AssertionError("The rows of the baseline differ from the current ones.")
+
+    stages = [
+        ('decode json.loads(str)', lambda: [json.loads(content.decode()) for content in contents]),
+        ('decode json.loads(bytes)', lambda: [json.loads(content) for content in contents]),
+        ('decode jsonlib.loads (%s)' % ('orjson' if jsonlib.orjson else 'json'),
+         lambda: [jsonlib.loads(content) for content in contents]),
+        ('eager parse (baseline)', lambda: [row for data in data_list for row in eager_parse(data)]),
+        ('parse_data', parse_all),
+        ('to_dict', lambda: [as_dict(row) for row in rows]),
+        ('parse_data + to_dict', lambda: [as_dict(row) for row in parse_all()]),
+        ('end to end baseline: json.loads(str) + eager parse', baseline),
+        ('end to end: jsonlib.loads + parse_data + to_dict', end_to_end),
+    ]
+    results = []
+    baseline_elapsed = None
+    for name, fn in stages:
+        elapsed = min(_timed(fn) for _ in range(repeat))
+        if fn is baseline:
+            baseline_elapsed = elapsed
+        results.append({
+            'name': name,
+            'seconds': round(elapsed, 4),
+            'pages/sec': round(len(contents) / elapsed, 1),
+            'items/sec': round(n_items / elapsed, 1),
+            'speedup': round(baseline_elapsed / elapsed, 2) if baseline_elapsed is not None else '-',
+        })
+    return results
+
+
+# Slow modules to import, which the cli and the tasks only import when they need them.
+DEFERRED_MODULES = ['pandas', 'numpy', 'pyarrow', 'aiohttp', 'openpyxl']
+
+
+def _imported_modules(cmd, cwd):
+    res = subprocess.run([cmd[0], '-X', 'importtime'] + cmd[1:], cwd=cwd, capture_output=True, text=True)
+    return {line.split('|')[-1].strip() for line in res.stderr.splitlines() if line.startswith('import time:')}
+
+
+def run_startup_benchmark(repeat=10):
+    """Measure the cold start of the cli and of the import of the tasks, each one in a
+    new interpreter, and list the deferred modules they import anyway.
+    :param repeat: (Int) number of runs of each command
+    :rtype List[Dict]:
+    """
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    commands = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('python -m instagram --help', [sys.executable, '-m', 'instagram', '--help']),
+        ('import instagram.instagram', [sys.executable, '-c', 'import instagram.instagram']),
+    ]
+    results = []
+    for name, cmd in commands:
+        elapsed = sorted(_timed(lambda: subprocess.run(cmd, cwd=project_dir, stdout=subprocess.DEVNULL, check=True))
+                         for _ in range(repeat))
+        modules = _imported_modules(cmd, project_dir)
+        results.append({
+            'name': name,
+            'median (ms)': round(elapsed[len(elapsed) // 2] * 1000, 1),
+            'min (ms)': round(elapsed[0] * 1000, 1),
+            'deferred modules imported': ','.join(m for m in DEFERRED_MODULES if m in modules) or '-',
+        })
+    return results
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def print_results(results):
+    columns = list(results[0].keys())
+    print(' | '.join(columns))
+    for result in results:
+        print(' | '.join(str(result[column]) for column in columns))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Offline benchmarks against a local mock server.")
+    arg_parser.add_argument('--pages', type=int, default=10, help="number of pages of each pagination")
+    arg_parser.add_argument('--page-size', type=int, default=50, help="number of items of each page")
+    arg_parser.add_argument('--media-size', type=int, default=100 * 1024, help="number of bytes of each media")
+    arg_parser.add_argument('--latency', type=float, default=0.0, help="seconds waited before each response")
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help="rate of throttled responses")
+    arg_parser.add_argument('--downloads', type=int, default=200, help="number of media downloaded")
+    arg_parser.add_argument('--max-workers', type=int, default=16, help="max number of workers")
+    arg_parser.add_argument('--parse', action='store_true', help="only run the parse microbenchmark")
+    arg_parser.add_argument('--cache-dir', default=None, help="root of a ResponseCache with recorded pages to parse")
+    arg_parser.add_argument('--startup', action='store_true', help="only measure the cold start of the cli")
+    arg_parser.add_argument('--out', default=None, help="json file to save the results to")
+    args = arg_parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.startup:
+        results = run_startup_benchmark()
+    elif args.parse:
+        results = run_parse_benchmark(load_pages(args.cache_dir, args.pages, args.page_size))
+    else:
+        results = run_all(args.pages, args.page_size, args.media_size, args.latency, args.error_rate,
+                          args.downloads, args.max_workers)
+    print_results(results)
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Cache of raw query responses used by query.py
+# Author: Tishacy
+# Date: 2021-04-28
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class CacheMissError(LookupError):
+    """Raised when a response is not in the cache in offline mode."""
+    pass
+
+
+class ResponseCache:
+    """On-disk cache of raw query responses keyed by the query hash and the query variables.
+    Entries expire ttl seconds after being written, and the least recently used entries
+    are evicted once the cache is larger than max_bytes. In offline mode, responses are
+    only replayed from the cache, and a missing one raises CacheMissError.
+        <root>/<key[:2]>/<key>.json     raw response
+    :argument root: directory of the cache
+    :argument ttl: (Float|None) seconds before an entry expires, None to never expire
+    :argument max_bytes: (Int) max size of the cache
+    :argument offline: (Bool) whether to replay the responses without network
+    """
+    def __init__(self, root='data/.cache', ttl=None, max_bytes=1024 * 1024 * 1024, offline=False):
+        self._root = root
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(os.path.getsize(fpath) for fpath in self._iter_fpaths())
+
+    @staticmethod
+    def key(query_hash, variables):
+        """Get the key of a response.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :rtype Str:
+        """
+        raw_key = query_hash + json.dumps(variables, sort_keys=True)
+        return hashlib.sha1(raw_key.encode()).hexdigest()
+
+    def _fpath(self, key):
+        return os.path.join(self._root, key[:2], key + '.json')
+
+    def _iter_fpaths(self):
+        for _dir, _, fnames in os.walk(self._root):
+            for fname in fnames:
+                if fname.endswith('.json'):
+                    yield os.path.join(_dir, fname)
+
+    def get(self, query_hash, variables):
+        """Get a cached response.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :rtype Bytes|None:
+        """
+        fpath = self._fpath(self.key(query_hash, variables))
+        try:
+            stat = os.stat(fpath)
+            if self._ttl is not None and not self.offline and time.time() - stat.st_mtime > self._ttl:
+                return None
+            with open(fpath, 'rb') as file:
+                content = file.read()
+            # Mark the entry as recently used, keeping its written time for the ttl.
+            os.utime(fpath, (time.time(), stat.st_mtime))
+            return content
+        except FileNotFoundError:
+            if self.offline:
+                raise CacheMissError("Response of %s %s is not in the cache."
+                                     % (query_hash, json.dumps(variables))) from None
+            return None
+
+    def put(self, query_hash, variables, content):
+        """Put a response into the cache.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :param content: (Bytes) raw response
+        :return None:
+        """
+        fpath = self._fpath(self.key(query_hash, variables))
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        old_size = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+        with open(fpath + '.tmp', 'wb') as file:
+            file.write(content)
+        os.replace(fpath + '.tmp', fpath)
+
+        with self._lock:
+            self._size += len(content) - old_size
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is smaller than 90% of max_bytes."""
+        entries = sorted((os.stat(fpath).st_atime, fpath) for fpath in self._iter_fpaths())
+        for _, fpath in entries:
+            if self._size <= self._max_bytes * 0.9:
+                break
+            self._size -= os.path.getsize(fpath)
+            os.remove(fpath)
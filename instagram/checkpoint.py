@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Checkpoints of paginations used by query.py
+# Author: Tishacy
+# Date: 2021-04-12
+import os
+import json
+import hashlib
+import threading
+
+from .parser import as_dict
+
+
+class Checkpoint:
+    """Checkpoint store of paginations on local disk.
+    A checkpoint is keyed by the query hash and the query variables except the
+    cursor, and keeps the next variables to query and the data queried so far:
+        <root>/<key>/state.json     latest cursor and size of the saved data
+        <root>/<key>/data.jsonl     data queried so far, one item per line
+    A task running several paginations keeps the finished ones until it completes, so that
+    a rerun after a crash loads their data instead of querying them again, and clears them
+    with clear_kept once it completes.
+    :argument root: directory of the checkpoints
+    :argument keep_finished: (Bool) whether to keep the checkpoints of the finished paginations
+    """
+    def __init__(self, root='data/.checkpoints', keep_finished=False):
+        self._root = root
+        self._keep_finished = keep_finished
+        self._lock = threading.Lock()
+        # Checkpoints of the paginations run with this store, which are cleared by clear_kept.
+        self._keys = set()
+
+    @staticmethod
+    def key(query_hash, variables):
+        """Get the key of a pagination.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :rtype Str:
+        """
+        variables = {k: v for k, v in variables.items() if k != 'after'}
+        raw_key = query_hash + json.dumps(variables, sort_keys=True)
+        return hashlib.sha1(raw_key.encode()).hexdigest()
+
+    def _dir(self, query_hash, variables):
+        return os.path.join(self._root, self.key(query_hash, variables))
+
+    def _read_state(self, _dir):
+        state_fpath = os.path.join(_dir, 'state.json')
+        if not os.path.exists(state_fpath):
+            return None
+        with open(state_fpath, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def load(self, query_hash, variables):
+        """Load the checkpoint of a pagination.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables of the first page
+        :rtype Tuple[Dict, List[Dict], Bool]|None: next variables, data so far and whether has next page
+        """
+        _dir = self._dir(query_hash, variables)
+        state = self._read_state(_dir)
+        if state is None:
+            return None
+        with self._lock:
+            self._keys.add(self.key(query_hash, variables))
+
+        with open(os.path.join(_dir, 'data.jsonl'), 'rb') as file:
+            # Bytes after the saved offset come from a page whose state was never saved.
+            lines = file.read(state['offset']).decode('utf-8').splitlines()
+        data = [json.loads(line) for line in lines]
+        return state['variables'], data, state['has_next']
+
+    def save(self, query_hash, variables, next_variables, parsed_data, has_next):
+        """Save a newly queried page to the checkpoint of a pagination.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables of the first page
+        :param next_variables: (Dict) query variables of the next page
+        :param parsed_data: (List[Dict]) data of the newly queried page
+        :param has_next: (Bool) whether the pagination has next page
+        :return None:
+        """
+        _dir = self._dir(query_hash, variables)
+        with self._lock:
+            os.makedirs(_dir, exist_ok=True)
+            self._keys.add(self.key(query_hash, variables))
+        state = self._read_state(_dir) or {'offset': 0}
+
+        data_fpath = os.path.join(_dir, 'data.jsonl')
+        with open(data_fpath, 'r+b' if os.path.exists(data_fpath) else 'wb') as file:
+            # Drop the bytes of a page whose state was never saved before appending.
+            file.truncate(state['offset'])
+            file.seek(state['offset'])
+            for item in parsed_data:
+                file.write((json.dumps(as_dict(item), ensure_ascii=False) + '\n').encode('utf-8'))
+            offset = file.tell()
+
+        self._write_state(_dir, {
+            'variables': next_variables,
+            'offset': offset,
+            'has_next': has_next
+        })
+
+    @staticmethod
+    def _write_state(_dir, state):
+        # Replace the state atomically, so that it is never half written, from a temporary file
+        # of the thread, so that two writers never replace the temporary file of each other.
+        state_fpath = os.path.join(_dir, 'state.json')
+        tmp_fpath = '%s.%d.%d.tmp' % (state_fpath, os.getpid(), threading.get_ident())
+        with open(tmp_fpath, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(tmp_fpath, state_fpath)
+
+    def copy_to(self, other, query_hash, variables):
+        """Copy the checkpoint of a pagination to another store, e.g. the one of the worker resuming it,
+        with the data up to the saved offset only.
+        :param other: (Checkpoint) checkpoint store to copy to
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables of the first page
+        :rtype Bool: whether a checkpoint is copied
+        """
+        _dir = self._dir(query_hash, variables)
+        state = self._read_state(_dir)
+        if state is None:
+            return False
+        other_dir = other._dir(query_hash, variables)
+        os.makedirs(other_dir, exist_ok=True)
+        with open(os.path.join(_dir, 'data.jsonl'), 'rb') as src, \
+                open(os.path.join(other_dir, 'data.jsonl'), 'wb') as dst:
+            remaining = state['offset']
+            while remaining > 0:
+                chunk = src.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+        other._write_state(other_dir, state)
+        with other._lock:
+            other._keys.add(other.key(query_hash, variables))
+        return True
+
+    def finish(self, query_hash, variables):
+        """Mark a pagination as finished, whose checkpoint is removed unless finished ones are kept.
+        A kept checkpoint has no next page, so a rerun loads its data without querying.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables of the first page
+        :return None:
+        """
+        if not self._keep_finished:
+            self.clear(query_hash, variables)
+
+    def clear_kept(self):
+        """Remove the checkpoints of all the paginations run with this store, once the task completes."""
+        with self._lock:
+            keys, self._keys = self._keys, set()
+        for key in keys:
+            self._remove(os.path.join(self._root, key))
+
+    def clear(self, query_hash, variables):
+        """Remove the checkpoint of a finished pagination.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables of the first page
+        :return None:
+        """
+        with self._lock:
+            self._keys.discard(self.key(query_hash, variables))
+        self._remove(self._dir(query_hash, variables))
+
+    @staticmethod
+    def _remove(_dir):
+        if not os.path.isdir(_dir):
+            return
+        for fname in os.listdir(_dir):
+            # The temporary states left by a crash are removed too.
+            if fname in ('state.json', 'data.jsonl') or fname.endswith('.tmp'):
+                os.remove(os.path.join(_dir, fname))
+        os.rmdir(_dir)
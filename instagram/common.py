@@ -1,24 +1,173 @@
 # -*- coding: utf-8 -*-
 # Author: Tishacy
 # Date: 2021-03-26
-
+import os
+import logging
+import threading
 import configparser
 
-# Load configurations
-config = configparser.ConfigParser(interpolation=None)
-config.read("config.ini")
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('common')
+
+# Environment variable of the config file path, which overrides the search of config.ini.
+CONFIG_ENV = 'INSTAGRAM_CONFIG'
+CONFIG_FNAME = 'config.ini'
+
+# Defaults of the options missing from the config file.
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 11_2_3) AppleWebKit/537.36 (KHTML, like Gecko) " \
+                     "Chrome/89.0.4389.90 Safari/537.36"
+DEFAULT_QUERY_HASHES = {
+    'PostsQueryHash': '42d2750e44dbac713ff30130659cd891',
+    'CommentsQueryHash': 'bc3296d1ce80a24b1b6e40b1e72903f5',
+    'TagPostsQueryHash': '9b498c08113f1e09617a1703c22b2f32',
+    'MediaQueryHash': '2b0673e0dc4580674a88d426fe00ea90',
+}
+
+
+class Config:
+    """Configurations of the http sessions and the query api, e.g. the ones of a config.ini file.
+    Each config gets its own shared http session, account pool and proxy pool.
+    :argument parser: (configparser.ConfigParser|None) parsed configurations, empty by default
+    :argument fpath: (Str|None) path of the config file
+    """
+    def __init__(self, parser=None, fpath=None):
+        self.parser = parser or configparser.ConfigParser(interpolation=None)
+        self.fpath = fpath
+
+    @classmethod
+    def from_file(cls, fpath):
+        """Read the configurations of a config file.
+        :param fpath: (Str) config file path
+        :rtype Config:
+        """
+        if not os.path.exists(fpath):
+            raise FileNotFoundError("Config file %s is not found." % fpath)
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read(fpath, encoding='utf-8')
+        return cls(parser, fpath)
+
+    def get(self, section, option, fallback=None):
+        return self.parser.get(section, option, fallback=fallback)
+
+    @property
+    def user_agent(self):
+        return self.get('HttpSession', 'UserAgent', DEFAULT_USER_AGENT)
+
+    @property
+    def cookie(self):
+        return self.get('HttpSession', 'Cookie', '')
+
+    @property
+    def http_proxy(self):
+        return self.get('HttpSession', 'HttpProxy')
+
+    @property
+    def https_proxy(self):
+        return self.get('HttpSession', 'HttpsProxy')
+
+    @property
+    def proxies(self):
+        proxies = {}
+        if self.http_proxy:
+            proxies['http'] = self.http_proxy
+        if self.https_proxy:
+            proxies['https'] = self.https_proxy
+        return proxies
+
+    @property
+    def posts_query_hash(self):
+        return self.get('QueryAPI', 'PostsQueryHash', DEFAULT_QUERY_HASHES['PostsQueryHash'])
+
+    @property
+    def comments_query_hash(self):
+        return self.get('QueryAPI', 'CommentsQueryHash', DEFAULT_QUERY_HASHES['CommentsQueryHash'])
+
+    @property
+    def tag_posts_query_hash(self):
+        return self.get('QueryAPI', 'TagPostsQueryHash', DEFAULT_QUERY_HASHES['TagPostsQueryHash'])
+
+    @property
+    def media_query_hash(self):
+        return self.get('QueryAPI', 'MediaQueryHash', DEFAULT_QUERY_HASHES['MediaQueryHash'])
+
+    def __repr__(self):
+        return "Config{%s}" % (self.fpath or 'defaults')
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def find_config_fpath():
+    """Find the config file, which is the one of the INSTAGRAM_CONFIG environment variable,
+    or config.ini in the working directory, or config.ini in the project directory.
+    :rtype Str|None: None if no config file is found
+    """
+    if os.environ.get(CONFIG_ENV):
+        return os.environ[CONFIG_ENV]
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for _dir in [os.getcwd(), project_dir]:
+        fpath = os.path.join(_dir, CONFIG_FNAME)
+        if os.path.exists(fpath):
+            return fpath
+    return None
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def load_config(fpath=None):
+    """Load the config file used by default in the process.
+    :param fpath: (Str|None) config file path, found by find_config_fpath by default
+    :rtype Config:
+    """
+    global _config
+    fpath = fpath or find_config_fpath()
+    if fpath is None:
+        logger.warning("No %s is found, using the default configurations without cookie." % CONFIG_FNAME)
+        config = Config()
+    else:
+        config = Config.from_file(fpath)
+    with _config_lock:
+        _config = config
+    return config
+
+
+def set_config(config):
+    """Set the config used by default in the process.
+    :param config: (Config) config
+    :return None:
+    """
+    global _config
+    with _config_lock:
+        _config = config
+
+
+def get_config():
+    """Get the config used by default in the process, which is loaded on first use.
+    :rtype Config:
+    """
+    config = _config
+    return config if config is not None else load_config()
+
 
-sess_config = config['HttpSession']
-query_config = config['QueryAPI']
+# Global variables of the former versions, which are read from the config on first use.
+_LEGACY_NAMES = {
+    'config': lambda config: config.parser,
+    'sess_config': lambda config: config.parser['HttpSession'],
+    'query_config': lambda config: config.parser['QueryAPI'],
+    'USER_AGENT': lambda config: config.user_agent,
+    'COOKIE': lambda config: config.cookie,
+    'HTTP_PROXY': lambda config: config.http_proxy,
+    'HTTPS_PROXY': lambda config: config.https_proxy,
+    'POSTS_QUERY_HASH_PARAM': lambda config: config.posts_query_hash,
+    'COMMENTS_QUERY_HASH_PARAM': lambda config: config.comments_query_hash,
+    'TAG_POSTS_QUERY_HASH_PARAM': lambda config: config.tag_posts_query_hash,
+}
 
-# Global variables
-# Http session
-USER_AGENT = sess_config['UserAgent']
-COOKIE = sess_config['Cookie']
-HTTP_PROXY = sess_config['HttpProxy'] if config.has_option('HttpSession', 'HttpProxy') else None
-HTTPS_PROXY = sess_config['HttpsProxy'] if config.has_option('HttpSession', 'HttpsProxy') else None
 
-# Query api hash codes
-POSTS_QUERY_HASH_PARAM = query_config['PostsQueryHash']
-COMMENTS_QUERY_HASH_PARAM = query_config['CommentsQueryHash']
-TAG_POSTS_QUERY_HASH_PARAM = query_config['TagPostsQueryHash']
+def __getattr__(name):
+    if name in _LEGACY_NAMES:
+        return _LEGACY_NAMES[name](get_config())
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
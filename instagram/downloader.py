@@ -3,42 +3,319 @@
 # Author: Tishacy
 # Date: 2021-03-27
 import os
-import requests
+import re
+import time
+import heapq
+import queue
 import logging
-import concurrent
-from concurrent.futures import ThreadPoolExecutor
-from collections import Iterable
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from collections.abc import Iterable
+from urllib.parse import urlsplit, parse_qs
 
-from .common import USER_AGENT, COOKIE, HTTP_PROXY, HTTPS_PROXY
+from .common import get_config
+from .ratelimit import get_rate_limiter, parse_retry_after
+from .proxypool import ProxyPool, get_proxy_pool
+from .sessions import get_session
+from .metrics import get_metrics
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
 logger = logging.getLogger('downloader')
 
 
-class Downloader:
-    def __init__(self, max_workers=None):
-        self._executor = ThreadPoolExecutor(max_workers=max_workers)
-        self._proxies = self._init_proxies()
-        self._sess = self._init_sess()
+# Default max number of bytes held in memory by the workers of a downloader.
+DEFAULT_MAX_INFLIGHT_BYTES = 16 * 1024 * 1024
 
-    @staticmethod
-    def _init_sess():
-        sess = requests.Session()
-        sess.headers.update({
-            'User-Agent': USER_AGENT,
-            'Cookie': COOKIE
-        })
-        return sess
 
-    @staticmethod
-    def _init_proxies():
-        proxies = {}
-        if HTTP_PROXY:
-            proxies['http'] = HTTP_PROXY
-        if HTTPS_PROXY:
-            proxies['https'] = HTTPS_PROXY
-        return proxies
+class ByteBudget:
+    """Budget of bytes held in memory at the same time by the workers of a pool.
+    :argument max_bytes: (Int) max number of bytes in flight
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, n):
+        """Reserve n bytes of the budget, blocking until they are available."""
+        n = min(n, self._max_bytes)
+        with self._cond:
+            while self._used + n > self._max_bytes:
+                self._cond.wait()
+            self._used += n
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._used -= n
+                self._cond.notify_all()
+
+
+class Bandwidth:
+    """Token bucket of bytes limiting the bandwidth shared by the workers of a pool.
+    :argument max_bytes_per_sec: (Float) max number of bytes received per second
+    :argument burst: (Int|None) max number of bytes received at once, one second of bandwidth by default
+    """
+    def __init__(self, max_bytes_per_sec, burst=None):
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.burst = burst or max_bytes_per_sec
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """Take n bytes from the bucket, blocking until the bandwidth allows them.
+        :param n: (Int) number of bytes received
+        :rtype Float: seconds waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.max_bytes_per_sec)
+            self._updated_at = now
+            self._tokens -= n
+            wait = -self._tokens / self.max_bytes_per_sec if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+# Extensions of the videos, which are downloaded after the images.
+VIDEO_EXTS = ('.mp4', '.mov', '.m4v', '.webm')
+# Status codes of the cdn for the urls whose signature has expired.
+EXPIRED_STATUS_CODES = (403, 410)
+
+
+class ExpiredUrlError(Exception):
+    """The signed url of a resource has expired."""
+    pass
+
+
+def url_expired(url, now=None):
+    """Whether the signed url of the cdn has expired, according to its 'oe' parameter,
+    which is the hex unix timestamp of its expiration.
+    :param url: (Str) url of a resource
+    :param now: (Float|None) unix timestamp, the current one by default
+    :rtype Bool: False if the url has no expiration
+    """
+    oe = parse_qs(urlsplit(url).query).get('oe')
+    if not oe:
+        return False
+    try:
+        return int(oe[0], 16) <= (now or time.time())
+    except ValueError:
+        return False
+
+
+def parse_content_range(value):
+    """Parse the Content-Range header of a response, e.g. 'bytes 100-199/1000' or 'bytes */1000'.
+    :param value: (Str|None) header value
+    :rtype Tuple[Int|None, Int|None]|None: first byte, None for an unsatisfied range, and size of the
+        resource, None if unknown; None if the header is not a range of bytes
+    """
+    match = re.match(r'bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)\s*$', value or '')
+    if match is None:
+        return None
+    first, size = match.groups()
+    return (int(first) if first is not None else None), (int(size) if size != '*' else None)
+
+
+def response_validator(headers):
+    """Validator of the resource of a response, to resume it with If-Range: its strong ETag,
+    or else its Last-Modified.
+    :param headers: (Mapping) response headers
+    :rtype Str|None:
+    """
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def resource_priority(resource):
+    """Default priority of a resource, the lower the sooner. The images go before the videos,
+    and the smallest resources first among the ones whose size is known.
+    :param resource: (Resource) resource
+    :rtype Tuple:
+    """
+    if resource.priority is not None:
+        return resource.priority, 0
+    _, ext = os.path.splitext((resource.url or '').split("?")[0])
+    return (1 if ext.lower() in VIDEO_EXTS else 0), resource.size or 0
+
+
+class DownloadScheduler:
+    """Pool of workers downloading the resources by priority.
+    The resources wait in a queue of each host, and a free worker takes the resource of
+    highest priority among the hosts having less than max_per_host resources in flight,
+    so that the small images are not stuck behind the videos, and no host takes all the
+    workers. Submitting blocks while max_pending resources are waiting, which bounds the
+    memory of a batch of any size.
+    :argument fn: (Callable[[Resource, Bool], Bool]) function downloading a resource
+    :argument max_workers: (Int) number of workers
+    :argument max_per_host: (Int|None) max number of resources downloaded at the same time from a host
+    :argument max_pending: (Int) max number of resources waiting to be downloaded
+    :argument priority: (Callable[[Resource], Any]) priority key of a resource, the lower the sooner
+    """
+    def __init__(self, fn, max_workers, max_per_host=None, max_pending=10000, priority=resource_priority):
+        self._fn = fn
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.max_pending = max_pending
+        self._priority = priority
+        self._queues = {}
+        self._active = {}
+        self._pending = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        # Waited on by the workers when no resource can be taken, and by the submitters when the queue is full.
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._workers = []
+        self._closed = False
+        self._metrics = get_metrics()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _start(self):
+        # Called with the lock held, on the first submission.
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work, name='downloader-%d' % i, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, resource, overwrite=False):
+        """Queue a resource to download, blocking while the queue is full.
+        :param resource: (Resource) resource to download
+        :param overwrite: (Bool) whether to overwrite the existing file
+        :rtype Future: future of whether the resource is downloaded
+        """
+        future = Future()
+        host = urlsplit(resource.url or '').netloc
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Can not submit a resource to a closed scheduler.")
+            if not self._workers:
+                self._start()
+            while self._pending >= self.max_pending:
+                self._not_full.wait()
+            self._seq += 1
+            heapq.heappush(self._queues.setdefault(host, []), (
+                self._priority(resource), self._seq, resource, overwrite, future, time.perf_counter()))
+            self._pending += 1
+            self._not_empty.notify()
+        return future
+
+    def _next(self):
+        # Called with the lock held.
+        best = None
+        for host, host_queue in self._queues.items():
+            if not host_queue:
+                continue
+            if self.max_per_host is not None and self._active.get(host, 0) >= self.max_per_host:
+                continue
+            if best is None or host_queue[0] < self._queues[best][0]:
+                best = host
+        return best
+
+    def _work(self):
+        while True:
+            with self._lock:
+                host = self._next()
+                while host is None:
+                    if self._closed and not self._pending:
+                        return
+                    self._not_empty.wait()
+                    host = self._next()
+                _, _, resource, overwrite, future, submitted_at = heapq.heappop(self._queues[host])
+                if not self._queues[host]:
+                    del self._queues[host]
+                self._pending -= 1
+                self._active[host] = self._active.get(host, 0) + 1
+                self._not_full.notify()
+
+            self._metrics.observe('download_queue_seconds', time.perf_counter() - submitted_at)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._fn(resource, overwrite))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._lock:
+                self._active[host] -= 1
+                if not self._active[host]:
+                    del self._active[host]
+                # The host may have been capped, so that a waiting resource can be taken now.
+                self._not_empty.notify()
+
+    def close(self, wait=True):
+        """Let the workers exit once the queued resources are downloaded.
+        :param wait: (Bool) whether to wait for the workers to exit
+        :return None:
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+class Downloader:
+    """Downloader of resources.
+    Resources are streamed in chunks to a '.part' file, which is renamed to the
+    output file once completed and resumed with a HTTP Range request if interrupted.
+    They are downloaded by priority with per-host caps, see DownloadScheduler, and the
+    caps and the bandwidth default to the ones of the config, e.g.
+        [Downloader]
+        MaxPerHost : 16
+        MaxBytesPerSec : 10485760
+    :argument max_workers: max number of resources downloaded at the same time
+    :argument rate_limiter: (RateLimiter|None) rate limiter, the one shared in the process by default
+    :argument chunk_size: (Int) number of bytes of each chunk written to the file
+    :argument max_inflight_bytes: (Int|None) max number of bytes held in memory by all the workers,
+        the chunks of all the workers up to DEFAULT_MAX_INFLIGHT_BYTES by default
+    :argument store: (MediaStore|None) content-addressed store deduplicating the media
+    :argument sess: (requests.Session|None) http session, the one shared in the process by default
+    :argument proxies: (Dict|None) proxies of requests, the configured ones by default
+    :argument proxy_pool: (ProxyPool|None) pool of proxies routing the requests, the pool of the
+        proxies of config.ini by default if any is configured and proxies is not given
+    :argument config: (Config|None) config of the session and proxies, the default one by default
+    :argument max_per_host: (Int|None) max number of resources downloaded at the same time from a host
+    :argument max_bytes_per_sec: (Float|None) max number of bytes received per second by all the workers
+    :argument max_pending: (Int) max number of submitted resources waiting for a worker
+    :argument priority: (Callable[[Resource], Any]) priority key of a resource, the lower the sooner
+    :argument manifest: (DownloadManifest|None) manifest recording the result of each resource
+    :argument refresher: (MediaUrlRefresher|None) refresher of the expired urls of the resources
+        having a short code, which are downloaded again with the fresh urls
+    """
+    def __init__(self, max_workers=None, rate_limiter=None, chunk_size=256 * 1024, max_inflight_bytes=None,
+                 store=None, sess=None, proxies=None, proxy_pool=None, config=None, max_per_host=None,
+                 max_bytes_per_sec=None, max_pending=10000, priority=resource_priority, manifest=None,
+                 refresher=None):
+        config = config or get_config()
+        self._store = store
+        self._manifest = manifest
+        self._refresher = refresher
+        max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        max_per_host = max_per_host or config.parser.getint('Downloader', 'MaxPerHost', fallback=None)
+        max_bytes_per_sec = max_bytes_per_sec or config.parser.getfloat('Downloader', 'MaxBytesPerSec', fallback=None)
+        self._scheduler = DownloadScheduler(self._download_resource, max_workers, max_per_host, max_pending,
+                                            priority)
+        self._bandwidth = Bandwidth(max_bytes_per_sec) if max_bytes_per_sec else None
+        self._rate_limiter = rate_limiter or get_rate_limiter('download')
+        self._chunk_size = chunk_size
+        self._budget = ByteBudget(max_inflight_bytes or min(max_workers * chunk_size, DEFAULT_MAX_INFLIGHT_BYTES))
+        if proxy_pool is None and proxies is None:
+            proxy_pool = get_proxy_pool(config)
+        self._proxy_pool = proxy_pool or ProxyPool.direct(config.proxies if proxies is None else proxies)
+        # Keep a connection alive for each worker.
+        self._sess = sess or get_session(pool_maxsize=max_workers, config=config)
+        self._metrics = get_metrics()
 
     @staticmethod
     def _split_name(url):
@@ -46,12 +323,62 @@ class Downloader:
             return "data/resource"
         return url.split("?")[0].split("/")[-1]
 
-    def _download_item(self, url, out=None, timeout=6, overwrite=False):
+    def _download_resource(self, resource, overwrite=False):
+        """Download a resource, refreshing its url once if it has expired.
+        :param resource: (Resource) resource to download
+        :param overwrite: (bool) whether to overwrite the existing file
+        :rtype Bool:
+        """
+        refreshable = self._refresher is not None and resource.short_code is not None
+        errors = []
+        is_success = False
+        try:
+            # Skip the request of a url known to have expired.
+            if refreshable and url_expired(resource.url) and not self._refresh(resource):
+                errors.append('expired url, no fresh url')
+                return False
+            try:
+                is_success = self._download_item(resource.url, resource.out, 6, overwrite, errors)
+                return is_success
+            except ExpiredUrlError:
+                if not refreshable:
+                    return False
+                if not self._refresh(resource):
+                    errors.append('expired url, no fresh url')
+                    return False
+            try:
+                is_success = self._download_item(resource.url, resource.out, 6, overwrite, errors)
+                return is_success
+            except ExpiredUrlError:
+                errors.append('expired url, no fresh url')
+                return False
+        except Exception as e:
+            errors.append(repr(e))
+            raise
+        finally:
+            # Only the outcome of the resource is recorded, whatever the number of urls tried.
+            self._record(resource.url, resource.out, is_success, None if is_success or not errors else errors[-1])
+
+    def _refresh(self, resource):
+        """Replace the url of a resource by a fresh one.
+        :param resource: (Resource) resource having a short code
+        :rtype Bool: whether a fresh url is found
+        """
+        url = self._refresher.refresh(resource)
+        if url is None or url == resource.url:
+            logger.warning("No fresh url of %s is found." % resource)
+            return False
+        resource.url = url
+        return True
+
+    def _download_item(self, url, out=None, timeout=6, overwrite=False, errors=None):
         """Download a resource from url to local file.
         :param url: (str) resource url to download
         :param out: (str|None) output file path.
         :param overwrite: (bool) whether to overwrite the existing file
+        :param errors: (List[Str]|None) list the error of a failed download is appended to
         :rtype Bool:
+        :raise ExpiredUrlError: if the signed url has expired
         """
         if url is None or not isinstance(url, str):
             raise ValueError("Url must be a string type.")
@@ -62,65 +389,271 @@ class Downloader:
         out = out or self._split_name(url)
 
         _dir, _ = os.path.split(out)
-        if not os.path.exists(_dir):
-            os.makedirs(_dir)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
 
+        metrics = self._metrics
         if os.path.exists(out) and not overwrite:
             logger.info("File %s already exists." % out)
+            metrics.inc('downloads_total', result='exists')
             return True
 
+        # Link the known media from the store without fetching it.
+        if self._store is not None:
+            digest = self._store.lookup(url)
+            if digest is not None:
+                self._store.link(digest, out)
+                logger.info("Linked the known url to %s." % out)
+                metrics.inc('downloads_total', result='linked')
+                return True
+
         # Fetch resource with the given url.
+        part = out + '.part'
+        start = time.perf_counter()
+        n_bytes = 0
+        result = 'failed'
+        error = None
         try:
             logger.info("Fetch the url: %s." % url)
-            res = self._sess.get(url, timeout=timeout, proxies=self._proxies)
+            # Hold the slot of the proxy until the resource is streamed.
+            with self._proxy_pool.use() as proxy:
+                for attempt in range(self._rate_limiter.max_retries + 1):
+                    # Resume the partial file left by an interrupted download, if the resource is unchanged.
+                    offset, validator = self._partial(part)
+                    headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator} if offset else {}
 
-            if str(res.status_code)[0] != '2':
-                return False
-            content = res.content
-            with open(out, 'wb') as file:
-                file.write(content)
-                logger.info("Saved the url to %s." % out)
+                    if attempt:
+                        metrics.inc('retries_total', stage='download')
+                    metrics.inc('sleep_seconds_total', self._rate_limiter.acquire(), stage='download')
+                    try:
+                        res = self._sess.get(url, timeout=timeout, proxies=proxy.proxies, headers=headers, stream=True)
+                    except Exception:
+                        metrics.inc('requests_total', stage='download', status='error')
+                        raise
+                    proxy.observe(res)
+                    metrics.inc('requests_total', stage='download', status=res.status_code)
+                    metrics.observe('request_seconds', res.elapsed.total_seconds(), stage='download')
+                    if res.status_code == 206 and (parse_content_range(res.headers.get('Content-Range'))
+                                                   or (None,))[0] != offset:
+                        # The range does not start at the end of the partial file, which is downloaded again.
+                        res.close()
+                        self._remove_partial(part)
+                        logger.info("Misaligned range of the url: %s, downloading it again..." % url)
+                        continue
+                    if res.status_code != 429:
+                        self._rate_limiter.on_success()
+                        break
+                    res.close()
+                    delay = self._rate_limiter.on_throttle(attempt, parse_retry_after(res.headers))
+                    logger.info("Throttled when fetching the url: %s, retrying in %.1fs..." % (url, delay))
+
+                with res:
+                    content_range = parse_content_range(res.headers.get('Content-Range'))
+                    # A partial file already complete gets a 416 with the size of the resource.
+                    complete = res.status_code == 416 and offset > 0 and content_range == (None, offset)
+                    if res.status_code == 416 and not complete:
+                        # The partial file does not match the resource any more.
+                        self._remove_partial(part)
+                        error = "status code 416"
+                        return False
+                    if str(res.status_code)[0] != '2' and not complete:
+                        error = "status code %d" % res.status_code
+                        if res.status_code in EXPIRED_STATUS_CODES:
+                            raise ExpiredUrlError(url)
+                        return False
+
+                    # The server sends the whole resource if it ignores the Range header or the resource
+                    # has changed since the partial file, and only a range starting at its end is appended.
+                    append = complete or (res.status_code == 206 and offset > 0 and content_range is not None
+                                          and content_range[0] == offset)
+                    if not append:
+                        if res.status_code == 206 and (content_range is None or content_range[0] != 0):
+                            self._remove_partial(part)
+                            error = "content range %s does not start at %d" % (
+                                res.headers.get('Content-Range'), offset)
+                            return False
+                        self._save_validator(part, response_validator(res.headers))
+                    hasher = self._store.new_hasher() if self._store is not None else None
+                    if hasher is not None and append:
+                        with open(part, 'rb') as file:
+                            for chunk in iter(lambda: file.read(self._chunk_size), b''):
+                                hasher.update(chunk)
+                    with open(part, 'ab' if append else 'wb') as file:
+                        chunks = iter(()) if complete else res.iter_content(self._chunk_size)
+                        while True:
+                            with self._budget.reserve(self._chunk_size):
+                                chunk = next(chunks, None)
+                                if chunk is None:
+                                    break
+                                file.write(chunk)
+                                n_bytes += len(chunk)
+                                if self._bandwidth is not None:
+                                    self._bandwidth.consume(len(chunk))
+                                if hasher is not None:
+                                    hasher.update(chunk)
+
+            if self._store is not None:
+                self._store.link(self._store.put(part, url, hasher.hexdigest()), out)
+            else:
+                os.replace(part, out)
+            self._save_validator(part, None)
+            logger.info("Saved the url to %s." % out)
+            result = 'ok'
             return True
 
-        except Exception:
+        except ExpiredUrlError:
+            logger.warning("The url has expired: %s." % url)
+            result = 'expired'
+            raise
+
+        except Exception as e:
             logger.warning("Failed to fetch the url: %s." % url)
+            error = repr(e)
             return False
 
+        finally:
+            metrics.inc('downloads_total', result=result)
+            metrics.inc('bytes_total', n_bytes, stage='download')
+            metrics.observe('download_seconds', time.perf_counter() - start)
+            if error is not None and errors is not None:
+                errors.append(error)
+
+    @staticmethod
+    def _partial(part):
+        """Get the size and the validator of the resource of a partial file. A partial file
+        without a validator can not be checked against the resource, and is removed.
+        :rtype Tuple[Int, Str|None]:
+        """
+        if not os.path.exists(part):
+            return 0, None
+        validator = None
+        if os.path.exists(part + '.validator'):
+            with open(part + '.validator', 'r', encoding='utf-8') as file:
+                validator = file.read().strip() or None
+        if validator is None:
+            Downloader._remove_partial(part)
+            return 0, None
+        return os.path.getsize(part), validator
+
+    @staticmethod
+    def _save_validator(part, validator):
+        """Save the validator of the resource of a partial file, or remove it if None."""
+        if validator is not None:
+            with open(part + '.validator', 'w', encoding='utf-8') as file:
+                file.write(validator)
+        elif os.path.exists(part + '.validator'):
+            os.remove(part + '.validator')
+
+    @staticmethod
+    def _remove_partial(part):
+        for fpath in [part, part + '.validator']:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+
+    def _record(self, url, out, is_success, error=None):
+        """Record the result of a resource in the manifest if any."""
+        if self._manifest is None:
+            return
+        n_bytes = os.path.getsize(out) if is_success and os.path.exists(out) else None
+        self._manifest.record(out, url, is_success, n_bytes, error)
+
+    def submit(self, resource, overwrite=False):
+        """Submit a resource to download without waiting for it, blocking while max_pending
+        resources are already waiting for a worker.
+        :param resource: (Resource) resource to download
+        :param overwrite: (bool) whether to overwrite the existing file
+        :rtype Future: future of whether the resource is downloaded
+        """
+        return self._scheduler.submit(resource, overwrite)
+
+    def iter_download(self, resources, overwrite=False):
+        """Download resources of any number, yielding the result of each one once downloaded.
+        The resources are taken from the iterable as the queue of the workers has room for
+        them, so a generator of millions of resources is never held in memory at once.
+        :param resources: (Iterable[Resource]) resources to download
+        :param overwrite: (bool) whether to overwrite the existing files
+        :rtype Iterator[Tuple[Resource, Bool]]: resources and whether they are downloaded
+        """
+        done = queue.Queue()
+        fed = {}
+
+        def feed():
+            n_submitted = 0
+            try:
+                for resource in resources:
+                    future = self.submit(resource, overwrite)
+                    future.add_done_callback(lambda f, r=resource: done.put((r, f)))
+                    n_submitted += 1
+            except Exception as e:
+                fed['error'] = e
+            finally:
+                fed['count'] = n_submitted
+                done.put(None)
+
+        feeder = threading.Thread(target=feed, name='downloader-feeder', daemon=True)
+        feeder.start()
+        n_done = 0
+        while 'count' not in fed or n_done < fed['count']:
+            item = done.get()
+            if item is None:
+                continue
+            resource, future = item
+            n_done += 1
+            try:
+                yield resource, future.result()
+            except Exception as e:
+                logger.warning("%s generated an exception: %s" % (resource, e))
+                yield resource, False
+        if 'error' in fed:
+            raise fed['error']
+
     def download(self, resources, overwrite=False):
         """Download a bunch of resources from url to local file.
         :param resources: (Iterable[Resource]) A sequence of Resources.
         :param overwrite: (bool) whether to overwrite the existing file
-        :rtype List[Future]:
+        :rtype Dict[Resource, Bool]:
         """
         if not isinstance(resources, Iterable):
             raise ValueError("Urls must be an iterable type.")
 
-        if len(resources) == 0:
+        if hasattr(resources, '__len__') and len(resources) == 0:
             raise ValueError("Urls' length must be greater than 0.")
 
-        future_to_resource = {}
-        for resource in resources:
-            url, out = resource.url, resource.out
-            future = self._executor.submit(self._download_item, url, out, 6, overwrite)
-            future_to_resource[future] = resource
-
         resource_to_result = {}
-        for future in concurrent.futures.as_completed(future_to_resource):
-            resource = future_to_resource[future]
-            try:
-                is_success = future.result()
-                resource_to_result[resource] = is_success
-                logging.info("%s result: %s" % (resource, is_success))
-            except Exception as e:
-                logger.warning("%s generated an exception: %s" % (resource, e))
-
+        for resource, is_success in self.iter_download(resources, overwrite):
+            resource_to_result[resource] = is_success
+            logging.info("%s result: %s" % (resource, is_success))
         return resource_to_result
 
+    def close(self):
+        """Wait for the submitted resources to be downloaded, and stop the workers."""
+        self._scheduler.close()
+        if self._manifest is not None:
+            self._manifest.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 class Resource:
-    def __init__(self, url, out):
+    """A resource to download.
+    :argument url: url of the resource
+    :argument out: output file path
+    :argument size: (Int|None) number of bytes of the resource if known, the smallest ones go first
+    :argument priority: (Int|None) priority class overriding the one of the extension, the lower the sooner
+    :argument short_code: (Str|None) short code of the post of the resource, to refresh its expired url
+    :argument url_field: (Str|None) field of the url in the post data, e.g. 'display_image_url' or 'video_url'
+    """
+    def __init__(self, url, out, size=None, priority=None, short_code=None, url_field=None):
         self.url = url
         self.out = out
+        self.size = size
+        self.priority = priority
+        self.short_code = short_code
+        self.url_field = url_field
 
     def __repr__(self):
         return "Resource{out=%s}" % self.out
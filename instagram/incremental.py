@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Incremental crawls which only fetch the posts newer than the last run
+# Author: Tishacy
+# Date: 2021-04-25
+import os
+import json
+
+
+class CrawlState:
+    """Newest post seen of each target, kept in a json file between runs.
+    :argument fpath: state file path
+    """
+    def __init__(self, fpath='data/.crawl_state.json'):
+        self._fpath = fpath
+        self._state = {}
+        if os.path.exists(fpath):
+            with open(fpath, 'r', encoding='utf-8') as file:
+                self._state = json.load(file)
+
+    def get(self, key):
+        """Get the newest post seen of a target.
+        :param key: (Str) target key, e.g. 'author:1596900784' or 'tag:computerscience'
+        :rtype Dict|None: the 'id' and 'timestamp' of the post
+        """
+        return self._state.get(key)
+
+    def update(self, key, items):
+        """Update the newest post seen of a target with the newly fetched posts.
+        :param key: (Str) target key
+        :param items: (List[Dict]) newly fetched posts
+        :return None:
+        """
+        for item in items:
+            newest = self._state.get(key)
+            if newest is None or int(item['timestamp']) > newest['timestamp']:
+                self._state[key] = {'id': item['id'], 'timestamp': int(item['timestamp'])}
+
+    def save(self):
+        """Save the state to the file atomically."""
+        _dir, _ = os.path.split(self._fpath)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
+        with open(self._fpath + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self._state, file, indent=2)
+        os.replace(self._fpath + '.tmp', self._fpath)
+
+
+# Max number of posts fetched by a first run, which has no newest post to stop at.
+DEFAULT_FIRST_COUNT = 100
+
+
+def iter_new_pages(pages, newest, first_count=DEFAULT_FIRST_COUNT):
+    """Filter the pages of a pagination ordered from the newest post, keeping only
+    the posts newer than the newest post seen, and stop at the first page reaching
+    the known posts. Old pinned posts at the top of a timeline do not stop the
+    pagination, since a page only reaches the known posts when its last post is known.
+    A first run, with no post seen yet, keeps the first_count newest posts instead of
+    walking the whole history of the author or tag.
+    :param pages: (Iterator[Tuple[List[Dict], Dict]]) pages from Query.iter_pages
+    :param newest: (Dict|None) newest post seen, None for a first run
+    :param first_count: (Int|None) max number of posts of a first run, None to keep all the posts
+    :rtype Iterator[Tuple[List[Dict], Dict]]:
+    """
+    if newest is None:
+        count = 0
+        for parsed_data, page_info in pages:
+            if first_count is not None and count + len(parsed_data) >= first_count:
+                yield parsed_data[:first_count - count], page_info
+                pages.close()
+                return
+            count += len(parsed_data)
+            yield parsed_data, page_info
+        return
+
+    def is_known(item):
+        return item['id'] == newest['id'] or int(item['timestamp']) <= newest['timestamp']
+
+    for parsed_data, page_info in pages:
+        yield [item for item in parsed_data if not is_known(item)], page_info
+        if parsed_data and is_known(parsed_data[-1]):
+            pages.close()
+            return
@@ -3,184 +3,548 @@
 # Date: 2021-03-26
 import os
 import logging
-import pandas as pd
+import concurrent
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from .query import Query
 from .parser import PostParser, CommentParser, TagPostParser
 from .downloader import Downloader, Resource
-from .common import POSTS_QUERY_HASH_PARAM, \
-    COMMENTS_QUERY_HASH_PARAM, TAG_POSTS_QUERY_HASH_PARAM
+from .checkpoint import Checkpoint
+from .cache import ResponseCache
+from .store import MediaStore
+from .manifest import DownloadManifest
+from .refresh import MediaUrlRefresher
+from .sink import open_sink, read_data, SINKS, PartitionedSink
+from .aggregate import CommentAggregate
+from .scheduler import CrawlScheduler, load_targets
+from .incremental import CrawlState, iter_new_pages, DEFAULT_FIRST_COUNT
+from .common import get_config
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
 logger = logging.getLogger('instagram')
 
 
+def _response_cache(cache_dir, offline):
+    """Get the cache of the raw responses of a task, which records them, or replays them offline.
+    :param cache_dir: (Str|None) directory of the cache, None to disable it
+    :param offline: (Bool) whether to replay the responses without network
+    :rtype ResponseCache|None:
+    """
+    if offline and not cache_dir:
+        raise ValueError("Offline mode needs the cache_dir of the recorded responses.")
+    return ResponseCache(cache_dir, offline=offline) if cache_dir else None
+
+
+def iter_comments_of_posts(comment_query, post_data, count_per_post=None, max_workers=8):
+    """Query the comments of the given posts with a bounded pool of workers.
+    The comments of one post are still paginated sequentially, and the comments
+    of each post are yielded in the order of the given posts. No more than twice
+    max_workers posts are submitted and held at the same time.
+
+    :param comment_query: (Query) query instance with a CommentParser
+    :param post_data: (Iterable[Dict]) posts data, each one has a 'short_code'
+    :param count_per_post: (Int|None) max number of comments of each post
+    :param max_workers: (Int) max number of posts queried at the same time
+    :rtype Iterator[List[Dict]]:
+    """
+    def query_comments_of_one_post(i, post):
+        logger.info("Get comment of %d %s" % (i, post['short_code']))
+        comment_data_of_one_post = comment_query.query_all(get_config().comments_query_hash, {
+            "shortcode": post['short_code'],
+            "first": 50,
+        }, count_per_post)
+        for comment in comment_data_of_one_post:
+            comment['post_short_code'] = post['short_code']
+        return comment_data_of_one_post
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The results are yielded in the order of post_data, which keeps
+        # the combined comments deterministic.
+        futures = deque()
+        for i, post in enumerate(post_data):
+            if len(futures) >= 2 * max_workers:
+                yield futures.popleft().result()
+            futures.append(executor.submit(query_comments_of_one_post, i, post))
+        while futures:
+            yield futures.popleft().result()
+
+
+def query_comments_of_posts(comment_query, post_data, count_per_post=None, max_workers=8):
+    """Query the comments of the given posts with a bounded pool of workers, see iter_comments_of_posts.
+    :param comment_query: (Query) query instance with a CommentParser
+    :param post_data: (Iterable[Dict]) posts data, each one has a 'short_code'
+    :param count_per_post: (Int|None) max number of comments of each post
+    :param max_workers: (Int) max number of posts queried at the same time
+    :rtype List[Dict]:
+    """
+    comment_data = []
+    for comment_data_of_one_post in iter_comments_of_posts(comment_query, post_data, count_per_post, max_workers):
+        comment_data.extend(comment_data_of_one_post)
+    return comment_data
+
+
+def stream_comments_of_posts(comment_query, post_data, sink, count_per_post=None, max_workers=8, top_k=10):
+    """Query the comments of the given posts with a bounded pool of workers, writing each page
+    of comments to the partition of its post as soon as it is queried, and yield the aggregates
+    of each post once its comments are done, in the order the posts are done.
+    No more than a page of comments per worker is held in memory, and no more than twice
+    max_workers posts are submitted at the same time. A post given several times is queried
+    once, since the partition of its comments is rewritten when it is opened again.
+
+    :param comment_query: (Query) query instance with a CommentParser
+    :param post_data: (Iterable[Dict]) posts data, each one has a 'short_code'
+    :param sink: (PartitionedSink) sink of the comments partitioned by 'post_short_code'
+    :param count_per_post: (Int|None) max number of comments of each post
+    :param max_workers: (Int) max number of posts queried at the same time
+    :param top_k: (Int) number of top commenters of the aggregates
+    :rtype Iterator[Dict]: aggregates of each post, see CommentAggregate.to_dict
+    """
+    def stream_comments_of_one_post(i, post):
+        short_code = post['short_code']
+        logger.info("Get comment of %d %s" % (i, short_code))
+        aggregate = CommentAggregate(short_code, top_k)
+        try:
+            for comments, _ in comment_query.iter_pages(get_config().comments_query_hash, {
+                "shortcode": short_code,
+                "first": 50,
+            }, count_per_post):
+                for comment in comments:
+                    comment['post_short_code'] = short_code
+                sink.write(comments)
+                aggregate.add(comments)
+        finally:
+            sink.close_partition(short_code)
+        return aggregate.to_dict()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = set()
+        short_codes = set()
+        for i, post in enumerate(post_data):
+            if post['short_code'] in short_codes:
+                continue
+            short_codes.add(post['short_code'])
+            if len(futures) >= 2 * max_workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            futures.add(executor.submit(stream_comments_of_one_post, i, post))
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _stream_comments(comment_query, post_data, count_per_post, max_workers, comments_dir, comments_ext):
+    aggregates_out = os.path.join(comments_dir, '_aggregates' + comments_ext)
+    with PartitionedSink(comments_dir, 'post_short_code', comments_ext) as sink, \
+            open_sink(aggregates_out) as aggregates_sink:
+        for aggregate in stream_comments_of_posts(comment_query, post_data, sink, count_per_post, max_workers):
+            aggregates_sink.write([aggregate])
+            logger.info("Count of comment_data: %d" % sink.count)
+    logger.info("Save the comments data to %s, and their aggregates to %s." % (comments_dir, aggregates_out))
+
+
 def task_fetch_posts_and_comments(
         author_id,
         count=28,
         posts_out='data/posts_data.xlsx',
-        comments_out='data/comments_data.xlsx'):
+        comments_out='data/comments_data.xlsx',
+        max_workers=8,
+        resume=False,
+        comments_dir=None,
+        comments_ext='.jsonl',
+        cache_dir=None,
+        offline=False):
     """[Task] Fetch a specific number of posts of the given author and the comments
     of these posts, and save them to files.
 
     :param author_id: author id
     :param count: number of posts to fetch
-    :param posts_out: out file of the posts data
-    :param comments_out: out file of the comments data
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param comments_out: out file of the comments data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param max_workers: max number of posts whose comments are fetched concurrently
+    :param resume: whether to resume interrupted paginations from the checkpoints
+    :param comments_dir: output directory of the comments partitioned by post, written as they are queried
+        with the aggregates of each post in '_aggregates<comments_ext>', instead of comments_out
+    :param comments_ext: extension of the files of comments_dir, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
     :return None:
     """
 
     # Create query instances for posts and comments
-    post_query = Query(PostParser)
-    comment_query = Query(CommentParser)
-
-    # Query posts data
-    post_data = post_query.query_all(POSTS_QUERY_HASH_PARAM, {
-        "id": author_id,
-        "first": 50,
-    }, count)
+    # Keep the finished paginations until the comments of all the posts are saved.
+    checkpoint = Checkpoint(keep_finished=True) if resume else None
+    cache = _response_cache(cache_dir, offline)
+    post_query = Query(PostParser, checkpoint, cache=cache)
+    comment_query = Query(CommentParser, checkpoint, cache=cache)
+
+    # Query posts data and save them page by page
+    post_data = []
+    with open_sink(posts_out) as sink:
+        for parsed_data, _ in post_query.iter_pages(get_config().posts_query_hash, {
+            "id": author_id,
+            "first": 50,
+        }, count):
+            sink.write(parsed_data)
+            post_data.extend(parsed_data)
     logger.info("Count of posts data: %d" % len(post_data))
-
-    # Save the posts data
-    post_data_df = pd.DataFrame(post_data)
-    post_data_df.to_excel(posts_out, encoding='utf-8', index=False)
     logger.info("Save the posts data to %s." % posts_out)
 
-    # Query comments data of posts
-    comment_data = []
-    for i, post in enumerate(post_data):
-        logger.info("Get comment of %d %s" % (i, post['short_code']))
-        comment_data_of_one_post = comment_query.query_all(COMMENTS_QUERY_HASH_PARAM, {
-            "shortcode": post['short_code'],
-            "first": 50,
-        }, None)
-        for comment in comment_data_of_one_post:
-            comment['post_short_code'] = post['short_code']
-        comment_data.extend(comment_data_of_one_post)
-        logger.info("Count of comment_data: %d" % len(comment_data))
+    if comments_dir:
+        # Stream comments data of posts to their partitions page by page
+        _stream_comments(comment_query, post_data, None, max_workers, comments_dir, comments_ext)
+    else:
+        # Query comments data of posts and save them post by post
+        with open_sink(comments_out) as sink:
+            for comment_data_of_one_post in iter_comments_of_posts(comment_query, post_data, None, max_workers):
+                sink.write(comment_data_of_one_post)
+                logger.info("Count of comment_data: %d" % sink.count)
+        logger.info("Save the comments data to %s." % comments_out)
 
-    # Save the comments data
-    comment_data_df = pd.DataFrame(comment_data)
-    comment_data_df.to_excel(comments_out, encoding='utf-8', index=False)
-    logger.info("Save the comments data to %s." % comments_out)
+    if checkpoint is not None:
+        checkpoint.clear_kept()
 
 
 def task_fetch_tag_posts_and_comments(
         tag_name,
         count=100,
         posts_out='data/tag_posts_data.xlsx',
-        comments_out='data/tag_comments_data.xlsx'):
+        comments_out='data/tag_comments_data.xlsx',
+        max_workers=8,
+        resume=False,
+        comments_dir=None,
+        comments_ext='.jsonl',
+        cache_dir=None,
+        offline=False):
     """[Task] Fetch a specific number of posts of the given tag and the comments
     of these posts, and save them to files.
 
     :param tag_name: tag name
     :param count: number of posts to fetch
-    :param posts_out: out file of the posts data
-    :param comments_out: out file of the comments data
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param comments_out: out file of the comments data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param max_workers: max number of posts whose comments are fetched concurrently
+    :param resume: whether to resume interrupted paginations from the checkpoints
+    :param comments_dir: output directory of the comments partitioned by post, written as they are queried
+        with the aggregates of each post in '_aggregates<comments_ext>', instead of comments_out
+    :param comments_ext: extension of the files of comments_dir, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
     :return None:
     """
 
     # Create query instances for posts and comments
-    post_query = Query(TagPostParser)
-    comment_query = Query(CommentParser)
-
-    # Query posts data
-    post_data = post_query.query_all(TAG_POSTS_QUERY_HASH_PARAM, {
-        "tag_name": tag_name,
-        "first": 50,
-    }, count)
+    # Keep the finished paginations until the comments of all the posts are saved.
+    checkpoint = Checkpoint(keep_finished=True) if resume else None
+    cache = _response_cache(cache_dir, offline)
+    post_query = Query(TagPostParser, checkpoint, cache=cache)
+    comment_query = Query(CommentParser, checkpoint, cache=cache)
+
+    # Query posts data and save them page by page
+    post_data = []
+    with open_sink(posts_out) as sink:
+        for parsed_data, _ in post_query.iter_pages(get_config().tag_posts_query_hash, {
+            "tag_name": tag_name,
+            "first": 50,
+        }, count):
+            sink.write(parsed_data)
+            post_data.extend(parsed_data)
     logger.info("Count of posts data: %d" % len(post_data))
-
-    # Save the posts data
-    post_data_df = pd.DataFrame(post_data)
-    post_data_df.to_excel(posts_out, encoding='utf-8', index=False)
     logger.info("Save the posts data to %s." % posts_out)
 
-    # Query comments data of posts
-    comment_data = []
-    for i, post in enumerate(post_data):
-        logger.info("Get comment of %d %s" % (i, post['short_code']))
-        comment_data_of_one_post = comment_query.query_all(COMMENTS_QUERY_HASH_PARAM, {
-            "shortcode": post['short_code'],
-            "first": 50,
-        }, 100)
-        for comment in comment_data_of_one_post:
-            comment['post_short_code'] = post['short_code']
-        comment_data.extend(comment_data_of_one_post)
-        logger.info("Count of comment_data: %d" % len(comment_data))
+    if comments_dir:
+        # Stream comments data of posts to their partitions page by page
+        _stream_comments(comment_query, post_data, 100, max_workers, comments_dir, comments_ext)
+    else:
+        # Query comments data of posts and save them post by post
+        with open_sink(comments_out) as sink:
+            for comment_data_of_one_post in iter_comments_of_posts(comment_query, post_data, 100, max_workers):
+                sink.write(comment_data_of_one_post)
+                logger.info("Count of comment_data: %d" % sink.count)
+        logger.info("Save the comments data to %s." % comments_out)
 
-    # Save the comments data
-    comment_data_df = pd.DataFrame(comment_data)
-    comment_data_df.to_excel(comments_out, encoding='utf-8', index=False)
-    logger.info("Save the comments data to %s." % comments_out)
+    if checkpoint is not None:
+        checkpoint.clear_kept()
 
 
 def task_fetch_posts(
         author_id,
         count=28,
-        posts_out='data/posts_data.xlsx'):
+        posts_out='data/posts_data.xlsx',
+        resume=False,
+        cache_dir=None,
+        offline=False):
     """[Task] Fetch a specific number of posts of the given author and the comments
     of these posts, and save them to files.
 
     :param author_id: author id
     :param count: number of posts to fetch
-    :param posts_out: out file of the posts data
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param resume: whether to resume interrupted paginations from the checkpoints
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
     :return None:
     """
 
     # Create query instances for posts
-    post_query = Query(PostParser)
-
-    # Query posts data
-    post_data = post_query.query_all(POSTS_QUERY_HASH_PARAM, {
-        "id": author_id,
-        "first": 50,
-    }, count)
-    logger.info("Count of posts data: %d" % len(post_data))
+    post_query = Query(PostParser, Checkpoint() if resume else None, cache=_response_cache(cache_dir, offline))
 
-    # Save the posts data
-    post_data_df = pd.DataFrame(post_data)
-    post_data_df.to_excel(posts_out, encoding='utf-8', index=False)
+    # Query posts data and save them page by page
+    with open_sink(posts_out) as sink:
+        for parsed_data, _ in post_query.iter_pages(get_config().posts_query_hash, {
+            "id": author_id,
+            "first": 50,
+        }, count):
+            sink.write(parsed_data)
+    logger.info("Count of posts data: %d" % sink.count)
     logger.info("Save the posts data to %s." % posts_out)
 
 
 def task_fetch_tag_posts(
         tag_name,
         count=100,
-        posts_out='data/tag_posts_data.xlsx'):
+        posts_out='data/tag_posts_data.xlsx',
+        resume=False,
+        cache_dir=None,
+        offline=False):
     """[Task] Fetch a specific number of posts of the given tag and the comments
     of these posts, and save them to files.
 
     :param tag_name: tag name
     :param count: number of posts to fetch
-    :param posts_out: out file of the posts data
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param resume: whether to resume interrupted paginations from the checkpoints
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
     :return None:
     """
     # Create query instances for posts
-    post_query = Query(TagPostParser)
+    post_query = Query(TagPostParser, Checkpoint() if resume else None,
+                       cache=_response_cache(cache_dir, offline))
+
+    # Query posts data and save them page by page
+    with open_sink(posts_out) as sink:
+        for parsed_data, _ in post_query.iter_pages(get_config().tag_posts_query_hash, {
+            "tag_name": tag_name,
+            "first": 50,
+        }, count):
+            sink.write(parsed_data)
+    logger.info("Count of posts data: %d" % sink.count)
+    logger.info("Save the posts data to %s." % posts_out)
+
+
+def _fetch_new_posts(key, parser_cls, query_hash, variables, posts_out, state_fpath, first_count):
+    state = CrawlState(state_fpath)
+    newest = state.get(key)
+    logger.info("Newest post seen of %s: %s" % (key, newest))
 
-    # Query posts data
-    post_data = post_query.query_all(TAG_POSTS_QUERY_HASH_PARAM, {
+    post_query = Query(parser_cls)
+    pages = post_query.iter_pages(query_hash, variables)
+    with open_sink(posts_out, append=True) as sink:
+        for parsed_data, _ in iter_new_pages(pages, newest, first_count):
+            sink.write(parsed_data)
+            state.update(key, parsed_data)
+    logger.info("Count of new posts data: %d" % sink.count)
+    logger.info("Append the new posts data to %s." % posts_out)
+
+    # Only remember the new posts once they are saved.
+    state.save()
+
+
+def task_fetch_new_posts(
+        author_id,
+        posts_out='data/posts_data.jsonl',
+        state_fpath='data/.crawl_state.json',
+        first_count=DEFAULT_FIRST_COUNT):
+    """[Task] Fetch the posts of the given author published since the last run,
+    and append them to the file.
+
+    :param author_id: author id
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .xls and .xlsx
+    :param state_fpath: file keeping the newest post seen of each author and tag
+    :param first_count: max number of posts fetched by the first run, None to fetch the whole history
+    :return None:
+    """
+    _fetch_new_posts('author:%s' % author_id, PostParser, get_config().posts_query_hash, {
+        "id": author_id,
+        "first": 50,
+    }, posts_out, state_fpath, first_count)
+
+
+def task_fetch_new_tag_posts(
+        tag_name,
+        posts_out='data/tag_posts_data.jsonl',
+        state_fpath='data/.crawl_state.json',
+        first_count=DEFAULT_FIRST_COUNT):
+    """[Task] Fetch the posts of the given tag published since the last run,
+    and append them to the file.
+
+    :param tag_name: tag name
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .xls and .xlsx
+    :param state_fpath: file keeping the newest post seen of each author and tag
+    :param first_count: max number of posts fetched by the first run, None to fetch the whole history
+    :return None:
+    """
+    _fetch_new_posts('tag:%s' % tag_name, TagPostParser, get_config().tag_posts_query_hash, {
         "tag_name": tag_name,
         "first": 50,
-    }, count)
-    logger.info("Count of posts data: %d" % len(post_data))
+    }, posts_out, state_fpath, first_count)
+
+
+def task_fetch_targets(
+        targets_fpath,
+        count=None,
+        out_dir='data',
+        out_ext='.jsonl',
+        max_workers=8,
+        resume=False,
+        cache_dir=None,
+        offline=False):
+    """[Task] Fetch the posts of many authors and tags listed in a file, interleaving
+    their paginations over a pool of workers, and save the posts of each target to a file.
+
+    :param targets_fpath: targets file path, one 'author:<author id>' or 'tag:<tag name>' per line
+    :param count: number of posts to fetch of each target, None for all
+    :param out_dir: output directory, each target is saved to <out_dir>/<kind>_<name><out_ext>
+    :param out_ext: extension of the output files, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param max_workers: max number of pages queried at the same time
+    :param resume: whether to resume interrupted paginations from the checkpoints
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
+    :return Dict[Str, Dict]: progress of each target
+    """
+    targets = load_targets(targets_fpath, count)
+    scheduler = CrawlScheduler(out_dir, out_ext, max_workers, Checkpoint() if resume else None,
+                               cache=_response_cache(cache_dir, offline))
+    progress = scheduler.run(targets)
 
-    # Save the posts data
-    post_data_df = pd.DataFrame(post_data)
-    post_data_df.to_excel(posts_out, encoding='utf-8', index=False)
-    logger.info("Save the posts data to %s." % posts_out)
+    failed = [key for key, target_progress in progress.items() if target_progress['status'] != 'done']
+    logger.info("Fetched %d targets, %d failed: %s" % (len(progress), len(failed), failed))
+    return progress
 
 
-def task_download_resources(data_fpath, url_field='display_image_url', out_fields=None, out_dir='pics', overwrite=False):
-    """[Task] Download all pics to files.
-    :param data_fpath: data file path
+def _resource(url, out_dir, out_name, short_code=None, url_field=None):
+    _, ext = os.path.splitext(url.split("?")[0])
+    return Resource(url, os.path.join(out_dir, out_name + ext), short_code=short_code, url_field=url_field)
+
+
+def resources_of_post(post, pics_dir='pics', videos_dir='videos'):
+    """Get the resources of a post, which are the display image and the video if any,
+    named by the short code of the post.
+    :param post: (Dict) post data
+    :param pics_dir: (Str) output directory of the pics
+    :param videos_dir: (Str|None) output directory of the videos, None to skip the videos
+    :rtype List[Resource]:
+    """
+    resources = []
+    if post.get('display_image_url'):
+        resources.append(_resource(post['display_image_url'], pics_dir, post['short_code'],
+                                   post['short_code'], 'display_image_url'))
+    if videos_dir and post.get('is_video') and post.get('video_url'):
+        resources.append(_resource(post['video_url'], videos_dir, post['short_code'],
+                                   post['short_code'], 'video_url'))
+    return resources
+
+
+def _fetch_posts_and_download(post_query, query_hash, variables, count, posts_out, pics_dir, videos_dir,
+                              max_workers, store_dir):
+    downloader = Downloader(max_workers=max_workers, store=MediaStore(store_dir) if store_dir else None)
+
+    # Download the resources of each page while querying the next one, by priority
+    # so that the pics are not stuck behind the videos.
+    future_to_resource = {}
+    with downloader:
+        with open_sink(posts_out) as sink:
+            for parsed_data, _ in post_query.iter_pages(query_hash, variables, count):
+                sink.write(parsed_data)
+                for post in parsed_data:
+                    for resource in resources_of_post(post, pics_dir, videos_dir):
+                        future_to_resource[downloader.submit(resource)] = resource
+                logger.info("Submitted %d resources to download." % len(future_to_resource))
+        logger.info("Count of posts data: %d" % sink.count)
+        logger.info("Save the posts data to %s." % posts_out)
+
+        n_success = 0
+        for future in concurrent.futures.as_completed(future_to_resource):
+            try:
+                n_success += future.result()
+            except Exception as e:
+                logger.warning("%s generated an exception: %s" % (future_to_resource[future], e))
+    logger.info("Downloaded %d of %d resources." % (n_success, len(future_to_resource)))
+
+
+def task_fetch_posts_and_download(
+        author_id,
+        count=28,
+        posts_out='data/posts_data.jsonl',
+        pics_dir='pics',
+        videos_dir='videos',
+        max_workers=100,
+        store_dir=None,
+        cache_dir=None,
+        offline=False):
+    """[Task] Fetch a specific number of posts of the given author, and download their
+    pics and videos while the posts are still being fetched.
+
+    :param author_id: author id
+    :param count: number of posts to fetch
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param pics_dir: output directory of the pics
+    :param videos_dir: output directory of the videos, None to skip the videos
+    :param max_workers: max number of resources downloaded at the same time
+    :param store_dir: directory of the content-addressed media store shared by crawls, None to disable it
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
+    :return None:
+    """
+    post_query = Query(PostParser, cache=_response_cache(cache_dir, offline))
+    _fetch_posts_and_download(post_query, get_config().posts_query_hash, {
+        "id": author_id,
+        "first": 50,
+    }, count, posts_out, pics_dir, videos_dir, max_workers, store_dir)
+
+
+def task_fetch_tag_posts_and_download(
+        tag_name,
+        count=100,
+        posts_out='data/tag_posts_data.jsonl',
+        pics_dir='pics',
+        max_workers=100,
+        store_dir=None,
+        cache_dir=None,
+        offline=False):
+    """[Task] Fetch a specific number of posts of the given tag, and download their
+    pics while the posts are still being fetched.
+
+    :param tag_name: tag name
+    :param count: number of posts to fetch
+    :param posts_out: out file of the posts data, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param pics_dir: output directory of the pics
+    :param max_workers: max number of resources downloaded at the same time
+    :param store_dir: directory of the content-addressed media store shared by crawls, None to disable it
+    :param cache_dir: directory of the cache recording the raw responses, None to disable it
+    :param offline: whether to replay the responses of cache_dir without network
+    :return None:
+    """
+    # Tag posts have no video url.
+    post_query = Query(TagPostParser, cache=_response_cache(cache_dir, offline))
+    _fetch_posts_and_download(post_query, get_config().tag_posts_query_hash, {
+        "tag_name": tag_name,
+        "first": 50,
+    }, count, posts_out, pics_dir, None, max_workers, store_dir)
+
+
+def load_resources(data_fpath, url_field='display_image_url', out_fields=None, out_dir='pics'):
+    """Load the resources to download from a data file.
+    :param data_fpath: data file path, one of .jsonl, .csv, .parquet, .xls and .xlsx
     :param url_field: field of pic urls in the data file.
     :param out_fields: fields of output names in the data file, using '-' to join these fields.
     :param out_dir: output directory of downloaded pics.
-    :param overwrite: whether to overwrite the existing files
-    :return None:
+    :rtype List[Resource]:
     """
     if data_fpath is None or not isinstance(data_fpath, str):
         raise ValueError("data_fpath must be a string.")
@@ -189,25 +553,81 @@ def task_download_resources(data_fpath, url_field='display_image_url', out_field
         raise FileNotFoundError("data_fpath is not found.")
 
     _, ext = os.path.splitext(data_fpath)
-    if ext not in ['.xls', '.xlsx']:
-        raise TypeError("data_fpath must be an excel file path with the extension of .xls or .xlsx, but got %s" % ext)
+    if ext not in SINKS:
+        raise TypeError("data_fpath must be a data file path with one of the extensions %s, but got %s"
+                        % (', '.join(SINKS), ext))
 
     if out_fields is None:
         out_fields = ['short_code']
 
-    data_df = pd.read_excel(data_fpath)
+    # Pandas is only imported by the tasks reading data files, since it is slow to import.
+    import pandas as pd
+    data_df = read_data(data_fpath)
     resources = []
     for i, item in data_df.iterrows():
         url = item[url_field]
         if not url or pd.isna(url):
             continue
-        _, ext = os.path.splitext(url.split("?")[0])
-        out_fname = '-'.join([item[out_field] for out_field in out_fields]) + ext
-        out = os.path.join(out_dir, out_fname)
-        resources.append(Resource(url, out))
+        out_name = '-'.join([item[out_field] for out_field in out_fields])
+        short_code = item['short_code'] if 'short_code' in item else None
+        resources.append(_resource(url, out_dir, out_name, short_code, url_field))
 
-    downloader = Downloader(max_workers=100)
-    downloader.download(resources)
+    return resources
+
+
+def _log_manifest(manifest):
+    stats = manifest.stats()
+    logger.info("Manifest %s: %s." % (manifest.fpath, ', '.join(
+        "%d %s (%d bytes)" % (stat['count'], status, stat['bytes']) for status, stat in sorted(stats.items()))))
+
+
+def task_download_resources(data_fpath, url_field='display_image_url', out_fields=None, out_dir='pics', overwrite=False,
+                            store_dir=None, manifest_fpath=None, refresh_urls=True):
+    """[Task] Download all pics to files.
+    The result of each pic is recorded in a manifest, and a rerun downloads only the pics
+    which are not done in the manifest, without checking the existence of every file.
+    The expired urls are refreshed by querying the posts of their short codes.
+    :param data_fpath: data file path, one of .jsonl, .csv, .parquet, .xls and .xlsx
+    :param url_field: field of pic urls in the data file.
+    :param out_fields: fields of output names in the data file, using '-' to join these fields.
+    :param out_dir: output directory of downloaded pics.
+    :param overwrite: whether to overwrite the existing files
+    :param store_dir: directory of the content-addressed media store shared by crawls, None to disable it
+    :param manifest_fpath: file path of the manifest, '<out_dir>/.manifest.db' by default
+    :param refresh_urls: whether to refresh the expired urls of the pics, which needs the short codes
+    :return None:
+    """
+    resources = load_resources(data_fpath, url_field, out_fields, out_dir)
+    with DownloadManifest(manifest_fpath or os.path.join(out_dir, '.manifest.db')) as manifest, \
+            (MediaUrlRefresher() if refresh_urls else nullcontext()) as refresher:
+        manifest.add(resources)
+        with Downloader(max_workers=100, store=MediaStore(store_dir) if store_dir else None,
+                        manifest=manifest, refresher=refresher) as downloader:
+            for _ in downloader.iter_download(resources if overwrite else manifest.iter_missing(), overwrite):
+                pass
+        _log_manifest(manifest)
+
+
+def task_retry_downloads(manifest_fpath, max_attempts=None, store_dir=None, refresh_urls=True):
+    """[Task] Download again the pics which are not done in a manifest.
+    :param manifest_fpath: file path of the manifest
+    :param max_attempts: (Int|None) skip the pics which failed this number of times
+    :param store_dir: directory of the content-addressed media store shared by crawls, None to disable it
+    :param refresh_urls: whether to refresh the expired urls of the pics
+    :return None:
+    """
+    if not os.path.exists(manifest_fpath):
+        raise FileNotFoundError("Manifest %s is not found." % manifest_fpath)
+    with DownloadManifest(manifest_fpath) as manifest, \
+            (MediaUrlRefresher() if refresh_urls else nullcontext()) as refresher:
+        with Downloader(max_workers=100, store=MediaStore(store_dir) if store_dir else None,
+                        manifest=manifest, refresher=refresher) as downloader:
+            for _ in downloader.iter_download(manifest.iter_missing(max_attempts)):
+                pass
+        _log_manifest(manifest)
+        for failure in manifest.failures(limit=10):
+            logger.warning("Failed %d times to download %s: %s"
+                           % (failure['attempts'], failure['out'], failure['error']))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Json decoding of raw responses
+# Author: Tishacy
+# Date: 2021-05-05
+import json
+
+# orjson is an optional faster backend.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(content):
+    """Decode json straight from the bytes of a response, without copying them into a str first.
+    :param content: (Bytes) raw json
+    :rtype Any:
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Durable manifest of the downloads used by downloader.py
+# Author: Tishacy
+# Date: 2021-05-14
+import os
+import time
+import sqlite3
+import threading
+
+from .downloader import Resource
+
+# Statuses of the resources of a manifest.
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class DownloadManifest:
+    """Manifest of the resources of a download job in a SQLite file, recording the status,
+    bytes, number of attempts, last error and completion time of each output file.
+    A job reruns only the resources which are not done, read from the manifest, instead
+    of checking the existence of every output file. The results are buffered and written
+    in batches, so that a job of millions of resources does not commit them one by one.
+    :argument fpath: path of the SQLite file
+    :argument batch_size: (Int) max number of results buffered before being written
+    :argument flush_interval: (Float) max seconds a result is buffered
+    """
+    def __init__(self, fpath='data/.manifest.db', batch_size=500, flush_interval=1.0):
+        _dir, _ = os.path.split(fpath)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
+        self.fpath = fpath
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(fpath, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS resources ("
+                               "out TEXT PRIMARY KEY, url TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', "
+                               "bytes INTEGER, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, completed_at REAL, "
+                               "short_code TEXT, url_field TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS resources_status ON resources (status)")
+
+    def add(self, resources):
+        """Add resources to the manifest as pending. The resources already done are kept,
+        and the other ones get the new url, e.g. a refreshed signed url.
+        :param resources: (Iterable[Resource]) resources
+        :rtype Int: number of resources added or updated
+        """
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO resources (out, url, short_code, url_field) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (out) DO UPDATE SET url = excluded.url, short_code = excluded.short_code, "
+                "url_field = excluded.url_field WHERE status != 'done'",
+                [(resource.out, resource.url, resource.short_code, resource.url_field) for resource in resources])
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def record(self, out, url, is_success, n_bytes=None, error=None):
+        """Record the final result of the download of a resource, whatever the number of urls tried.
+        :param out: (Str) output file path of the resource
+        :param url: (Str) url of the resource
+        :param is_success: (Bool) whether the resource is downloaded
+        :param n_bytes: (Int|None) number of bytes of the output file
+        :param error: (Str|None) error of a failed download
+        :return None:
+        """
+        now = time.time()
+        with self._lock:
+            self._buffer.append((out, url, DONE if is_success else FAILED, n_bytes, error,
+                                 now if is_success else None))
+            if len(self._buffer) >= self._batch_size or time.monotonic() - self._flushed_at >= self._flush_interval:
+                self._flush()
+
+    def _flush(self):
+        # Called with the lock held.
+        self._flushed_at = time.monotonic()
+        if not self._buffer:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.executemany(
+            "INSERT INTO resources (out, url, status, bytes, attempts, error, completed_at) "
+            "VALUES (?, ?, ?, ?, 1, ?, ?) "
+            "ON CONFLICT (out) DO UPDATE SET url = excluded.url, status = excluded.status, "
+            "bytes = excluded.bytes, attempts = attempts + 1, error = excluded.error, "
+            "completed_at = excluded.completed_at", self._buffer)
+        self._conn.execute("COMMIT")
+        self._buffer = []
+
+    def flush(self):
+        """Write the buffered results."""
+        with self._lock:
+            self._flush()
+
+    def iter_missing(self, max_attempts=None, batch_size=1000):
+        """Iterate over the resources which are not done yet, in batches read from the manifest.
+        :param max_attempts: (Int|None) skip the resources which failed this number of times
+        :param batch_size: (Int) number of resources read at once
+        :rtype Iterator[Resource]:
+        """
+        self.flush()
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, url, out, short_code, url_field FROM resources "
+                    "WHERE status != 'done' AND rowid > ? AND attempts < ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, max_attempts if max_attempts is not None else 2 ** 62, batch_size)).fetchall()
+            if not rows:
+                return
+            for rowid, url, out, short_code, url_field in rows:
+                yield Resource(url, out, short_code=short_code, url_field=url_field)
+            last_rowid = rows[-1][0]
+
+    def failures(self, limit=None):
+        """Get the failed resources with their last errors.
+        :param limit: (Int|None) max number of failures
+        :rtype List[Dict]:
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute("SELECT out, url, attempts, error FROM resources WHERE status = 'failed' "
+                                      "ORDER BY out LIMIT ?", (limit if limit is not None else -1,)).fetchall()
+        return [{'out': out, 'url': url, 'attempts': attempts, 'error': error} for out, url, attempts, error in rows]
+
+    def stats(self):
+        """Number and bytes of the resources of each status.
+        :rtype Dict[Str, Dict]:
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*), COALESCE(SUM(bytes), 0) FROM resources "
+                                      "GROUP BY status").fetchall()
+        return {status: {'count': count, 'bytes': n_bytes} for status, count, n_bytes in rows}
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
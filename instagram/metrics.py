@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# Metrics and profiling hooks of the stages of a crawl
+# Author: Tishacy
+# Date: 2021-05-10
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('metrics')
+
+# Prefix of the exported metric names.
+PREFIX = 'instagram_'
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Help texts of the metrics recorded by the queries, parsers, downloaders and sinks.
+HELP = {
+    'requests_total': "Http requests sent, by stage and status code.",
+    'retries_total': "Requests retried after being throttled or failing, by stage.",
+    'sleep_seconds_total': "Seconds waited for the rate limiters, by stage.",
+    'bytes_total': "Bytes received, by stage.",
+    'cache_hits_total': "Pages read from the response cache instead of being requested.",
+    'items_total': "Items parsed, by parser.",
+    'downloads_total': "Resources downloaded, by result.",
+    'url_refreshes_total': "Expired urls of resources refreshed by querying their posts, by result.",
+    'rows_written_total': "Rows written to the output files, by sink.",
+    'request_seconds': "Latency of the http requests until the response headers, by stage.",
+    'download_seconds': "Time to download a resource, including its retries.",
+    'download_queue_seconds': "Time a resource waits in the queue of the downloader before a worker takes it.",
+    'parse_seconds': "Time to parse a page, by parser.",
+    'write_seconds': "Time to write or flush rows to an output file, by sink.",
+}
+
+
+class Histogram:
+    """Histogram of observed values counted in buckets.
+    :argument buckets: (Tuple[Float]) sorted upper bounds of the buckets
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is the one of the values above the last bound.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Get the upper bound of the bucket of the q-quantile.
+        :param q: (Float) quantile between 0 and 1
+        :rtype Float: inf if the quantile is above the last bound
+        """
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Registry of the counters and latency histograms of the stages of a crawl,
+    recorded by name and labels, e.g.
+        metrics.inc('requests_total', stage='query', status=200)
+        with metrics.timer('parse_seconds', parser='PostParser'):
+            ...
+    :argument buckets: (Tuple[Float]) upper bounds in seconds of the buckets of the histograms
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter.
+        :param name: (Str) counter name
+        :param value: (Float) increment
+        :return None:
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram.
+        :param name: (Str) histogram name
+        :param value: (Float) value, in seconds for the latencies
+        :return None:
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the time spent in the block in a histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _matches(key_labels, labels):
+        key_labels = dict(key_labels)
+        return all(str(key_labels.get(key)) == str(value) for key, value in labels.items())
+
+    def total(self, name, **labels):
+        """Get the sum of the counters of a name over the labels not given.
+        :rtype Float:
+        """
+        with self._lock:
+            return sum(value for (key_name, key_labels), value in self._counters.items()
+                       if key_name == name and self._matches(key_labels, labels))
+
+    def histogram(self, name, **labels):
+        """Get the merged histogram of a name over the labels not given.
+        :rtype Histogram:
+        """
+        merged = Histogram(self._buckets)
+        with self._lock:
+            for (key_name, key_labels), histogram in self._histograms.items():
+                if key_name == name and self._matches(key_labels, labels):
+                    merged.merge(histogram)
+        return merged
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def summary(self):
+        """Summarize the time spent in each stage, which tells whether a crawl is bound by
+        the network, the throttling, the parsing or the writing.
+        :rtype Str:
+        """
+        lines = ["Metrics after %.1fs:" % (time.time() - self.started_at)]
+        for stage in ['query', 'download']:
+            requests_count = self.total('requests_total', stage=stage)
+            if not requests_count:
+                continue
+            latency = self.histogram('request_seconds', stage=stage)
+            lines.append("  %s: %d requests (%d retries, %d throttled), %.1f MB, %.1fs in requests "
+                         "(p50 < %ss, p95 < %ss), %.1fs waiting for the rate limiter"
+                         % (stage, requests_count, self.total('retries_total', stage=stage),
+                            self.total('requests_total', stage=stage, status=429),
+                            self.total('bytes_total', stage=stage) / 1024 / 1024, latency.sum,
+                            _format_value(latency.quantile(0.5)), _format_value(latency.quantile(0.95)),
+                            self.total('sleep_seconds_total', stage=stage)))
+        cache_hits = self.total('cache_hits_total')
+        if cache_hits:
+            lines.append("  cache: %d hits" % cache_hits)
+        parse = self.histogram('parse_seconds')
+        if parse.count:
+            lines.append("  parse: %d pages, %d items, %.2fs (%.1fms per page)"
+                         % (parse.count, self.total('items_total'), parse.sum, parse.sum / parse.count * 1000))
+        downloads = self.histogram('download_seconds')
+        if downloads.count:
+            lines.append("  downloads: %d ok, %d failed, %.1fs in downloads"
+                         % (self.total('downloads_total', result='ok'),
+                            self.total('downloads_total', result='failed'), downloads.sum))
+        write = self.histogram('write_seconds')
+        if write.count:
+            lines.append("  sink: %d rows, %.2fs writing" % (self.total('rows_written_total'), write.sum))
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """Export the metrics in the Prometheus text format.
+        :rtype Str:
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP %s%s %s" % (PREFIX, name, HELP.get(name, name)))
+                lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append("%s%s%s %s" % (PREFIX, name, _format_labels(labels), _format_value(value)))
+        for (name, labels), (counts, _sum, count) in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append("%s%s_bucket%s %d" % (PREFIX, name, _format_labels(labels, [('le', _format_value(
+                    float(bound)))]), cumulative))
+            lines.append("%s%s_sum%s %s" % (PREFIX, name, _format_labels(labels), repr(_sum)))
+            lines.append("%s%s_count%s %d" % (PREFIX, name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, fpath):
+        """Write the metrics to a Prometheus text file, e.g. for the textfile collector of
+        the node exporter. The file is replaced at once, so it is never read half written.
+        :param fpath: (Str) output file path
+        :return None:
+        """
+        _dir, fname = os.path.split(fpath)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
+        tmp_fpath = os.path.join(_dir, '.' + fname)
+        with open(tmp_fpath, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(tmp_fpath, fpath)
+
+
+_metrics = Metrics()
+
+
+def _reset_after_fork():
+    # Each worker process reports its own metrics.
+    _metrics._lock = threading.Lock()
+    _metrics.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_metrics():
+    """Get the metrics shared in the process.
+    :rtype Metrics:
+    """
+    return _metrics
+
+
+class MetricsReporter:
+    """Thread logging a summary of the metrics every interval seconds, and writing them
+    to a Prometheus text file if any. The last report is done when it is stopped.
+        with MetricsReporter(interval=30, fpath='data/metrics.prom'):
+            task_fetch_posts(...)
+    :argument metrics: (Metrics|None) metrics, the ones shared in the process by default
+    :argument interval: (Float) seconds between the reports
+    :argument fpath: (Str|None) Prometheus text file path, None to only log the summaries
+    """
+    def __init__(self, metrics=None, interval=60.0, fpath=None):
+        self._metrics = metrics or get_metrics()
+        self._interval = interval
+        self._fpath = fpath
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def report(self):
+        logger.info(self._metrics.summary())
+        if self._fpath:
+            self._metrics.write_prometheus(self._fpath)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.report()
+            except Exception as e:
+                logger.warning("Failed to report the metrics: %s" % e)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+@contextmanager
+def profile(out_dir='data/profile', cpu=True, memory=False, top=30):
+    """Profile the block, e.g. a whole crawl.
+    With cpu, the calling thread and the threads started in the block are profiled by
+    cProfile, and their merged stats are dumped to <out_dir>/cpu.prof, which pstats and
+    snakeviz read, with the top functions by cumulative time in <out_dir>/cpu.txt.
+    With memory, the allocations are traced by tracemalloc, and the top allocating lines
+    at the end of the block are written to <out_dir>/memory.txt.
+    :param out_dir: (Str) output directory of the profiles
+    :param cpu: (Bool) whether to profile the cpu time
+    :param memory: (Bool) whether to trace the memory allocations, which slows the code down a lot
+    :param top: (Int) number of functions and lines listed in the text reports
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    profilers = []
+    profilers_lock = threading.Lock()
+
+    def profile_new_thread(frame, event, arg):
+        # Called once at the start of a new thread, and replaced by its own profiler.
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with profilers_lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    if cpu:
+        threading.setprofile(profile_new_thread)
+        profilers.append(cProfile.Profile())
+        profilers[0].enable()
+    if memory:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if cpu:
+            profilers[0].disable()
+            threading.setprofile(None)
+            with profilers_lock:
+                stats = pstats.Stats(*profilers)
+            stats.dump_stats(os.path.join(out_dir, 'cpu.prof'))
+            with open(os.path.join(out_dir, 'cpu.txt'), 'w', encoding='utf-8') as file:
+                stats.stream = file
+                stats.sort_stats('cumulative').print_stats(top)
+            logger.info("Saved the cpu profile of %d threads to %s." % (len(profilers), out_dir))
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(os.path.join(out_dir, 'memory.txt'), 'w', encoding='utf-8') as file:
+                file.write("Current: %.1f MB, peak: %.1f MB\n" % (current / 1024 / 1024, peak / 1024 / 1024))
+                for stat in snapshot.statistics('lineno')[:top]:
+                    file.write("%s\n" % stat)
+            logger.info("Saved the memory profile to %s, peak: %.1f MB." % (out_dir, peak / 1024 / 1024))
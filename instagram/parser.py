@@ -2,15 +2,170 @@
 # Entities used by query.py
 # Author: Tishacy
 # Date: 2021-03-26
+import time
+from operator import attrgetter
 from abc import ABC, abstractmethod
-from datetime import datetime
+from collections.abc import Mapping
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_timestamp(timestamp):
+    """Format a unix timestamp in local time.
+    :param timestamp: (Int) unix timestamp
+    :rtype Str:
+    """
+    return time.strftime(TIME_FORMAT, time.localtime(int(timestamp)))
+
+
+class Record(Mapping):
+    """Abstract Record class
+    A record is a parsed item stored in slots instead of a dict, which takes a
+    fraction of the memory of a dict with the same keys. It is a read-only mapping
+    of the output keys, so it can be used like the dicts of the parsed data, and
+    the 'formatted-time' is computed from the timestamp when read instead of being
+    stored. An explicit record has to define:
+        __slots__: the stored attributes
+        FIELDS: the (key, attribute) pairs, in the order of the output columns
+        OPTIONAL: the keys which are left out while their value is None
+    """
+    __slots__ = ()
+    FIELDS = ()
+    OPTIONAL = ()
+    _ATTRS = {}
+    _STORED = frozenset()
+    _KEYS = ()
+    _VALUES = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._ATTRS = dict(cls.FIELDS)
+        # The values of all the fields are read at once by to_dict.
+        cls._KEYS = tuple(key for key, _ in cls.FIELDS)
+        cls._VALUES = attrgetter(*(attr for _, attr in cls.FIELDS)) if len(cls.FIELDS) > 1 else None
+        # The keys of the stored attributes, the other ones are computed when read.
+        cls._STORED = frozenset(key for key, attr in cls.FIELDS if attr in cls.__slots__)
+
+    @property
+    def formatted_time(self):
+        return format_timestamp(self.timestamp) if self.timestamp is not None else None
+
+    def __getitem__(self, key):
+        if key not in self._ATTRS:
+            raise KeyError(key)
+        value = getattr(self, self._ATTRS[key])
+        if value is None and key in self.OPTIONAL:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self._ATTRS:
+            raise KeyError(key)
+        if key not in self._STORED:
+            raise KeyError("%r is computed from the other fields and can not be set" % key)
+        setattr(self, self._ATTRS[key], value)
+
+    def __iter__(self):
+        for key, attr in self.FIELDS:
+            if key not in self.OPTIONAL or getattr(self, attr) is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """Convert the record to a dict.
+        :rtype Dict:
+        """
+        if self._VALUES is None:
+            return {key: getattr(self, attr) for key, attr in self.FIELDS
+                    if key not in self.OPTIONAL or getattr(self, attr) is not None}
+        row = dict(zip(self._KEYS, self._VALUES(self)))
+        for key in self.OPTIONAL:
+            if row[key] is None:
+                del row[key]
+        return row
+
+    def __repr__(self):
+        return "%s%s" % (self.__class__.__name__, self.to_dict())
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class PostRecord(Record):
+    """A post of an author"""
+    __slots__ = ('id', 'short_code', 'text', 'display_image_url', 'is_video', 'video_url',
+                 'timestamp', 'likes_count', 'comments_count')
+    FIELDS = (('id', 'id'), ('short_code', 'short_code'), ('text', 'text'),
+              ('display_image_url', 'display_image_url'), ('is_video', 'is_video'), ('video_url', 'video_url'),
+              ('timestamp', 'timestamp'), ('formatted-time', 'formatted_time'),
+              ('likes_count', 'likes_count'), ('comments_count', 'comments_count'))
+
+    def __init__(self, id, short_code, text, display_image_url, is_video, video_url,
+                 timestamp, likes_count, comments_count):
+        self.id = id
+        self.short_code = short_code
+        self.text = text
+        self.display_image_url = display_image_url
+        self.is_video = is_video
+        self.video_url = video_url
+        self.timestamp = timestamp
+        self.likes_count = likes_count
+        self.comments_count = comments_count
+
+
+class TagPostRecord(Record):
+    """A post of a tag, whose video url is not given by the tag pagination"""
+    __slots__ = ('id', 'short_code', 'text', 'display_image_url', 'is_video',
+                 'timestamp', 'likes_count', 'comments_count')
+    FIELDS = (('id', 'id'), ('short_code', 'short_code'), ('text', 'text'),
+              ('display_image_url', 'display_image_url'), ('is_video', 'is_video'),
+              ('timestamp', 'timestamp'), ('formatted-time', 'formatted_time'),
+              ('likes_count', 'likes_count'), ('comments_count', 'comments_count'))
+
+    def __init__(self, id, short_code, text, display_image_url, is_video,
+                 timestamp, likes_count, comments_count):
+        self.id = id
+        self.short_code = short_code
+        self.text = text
+        self.display_image_url = display_image_url
+        self.is_video = is_video
+        self.timestamp = timestamp
+        self.likes_count = likes_count
+        self.comments_count = comments_count
+
+
+class CommentRecord(Record):
+    """A comment of a post, whose 'post_short_code' is set by the tasks querying the comments of posts"""
+    __slots__ = ('id', 'timestamp', 'text', 'username', 'likes_count', 'post_short_code')
+    FIELDS = (('id', 'id'), ('timestamp', 'timestamp'), ('formatted-time', 'formatted_time'),
+              ('text', 'text'), ('username', 'username'), ('likes_count', 'likes_count'),
+              ('post_short_code', 'post_short_code'))
+    OPTIONAL = ('post_short_code',)
+
+    def __init__(self, id, timestamp, text, username, likes_count, post_short_code=None):
+        self.id = id
+        self.timestamp = timestamp
+        self.text = text
+        self.username = username
+        self.likes_count = likes_count
+        self.post_short_code = post_short_code
+
+
+def as_dict(row):
+    """Get a dict of a parsed item, which is either a record or already a dict.
+    :param row: (Record|Dict) parsed item
+    :rtype Dict:
+    """
+    return row.to_dict() if isinstance(row, Record) else row
 
 
 class Parser(ABC):
     """Abstract Parser class
     A parser will parse the given data with the given variables.
     An explicit parser has to implements the following methods:
-        parse_data() -> List[Dict]
+        parse_data() -> List[Record]
         parse_next_variables() -> Dict
         parse_page_info() -> Dict
     """
@@ -41,12 +196,7 @@ class PostParser(Parser):
 
     def parse_data(self):
         edges = self.data['data']['user']['edge_owner_to_timeline_media']['edges']
-
-        parsed_data = []
-        for edge in edges:
-            node_info = self.get_info(edge['node'])
-            parsed_data.append(node_info)
-        return parsed_data
+        return [self.get_info(edge['node']) for edge in edges]
 
     def parse_next_variables(self):
         next_variable = self.variables.copy()
@@ -63,18 +213,19 @@ class PostParser(Parser):
 
     @staticmethod
     def get_info(node):
-        return {
-            'id': node['id'],
-            'short_code': node['shortcode'],
-            'text': node['edge_media_to_caption']['edges'][0]['node']['text'] if len(node['edge_media_to_caption']['edges']) > 0 else '',
-            'display_image_url': node['display_url'],
-            'is_video': node['is_video'],
-            'video_url': node['video_url'] if node['is_video'] else '',
-            'timestamp': node['taken_at_timestamp'],
-            'formatted-time': datetime.fromtimestamp(int(node['taken_at_timestamp'])).strftime('%Y-%m-%d %H:%M:%S'),
-            'likes_count': node['edge_media_preview_like']['count'],
-            'comments_count': node['edge_media_to_comment']['count']
-        }
+        caption_edges = node['edge_media_to_caption']['edges']
+        is_video = node['is_video']
+        return PostRecord(
+            id=node['id'],
+            short_code=node['shortcode'],
+            text=caption_edges[0]['node']['text'] if caption_edges else '',
+            display_image_url=node['display_url'],
+            is_video=is_video,
+            video_url=node['video_url'] if is_video else '',
+            timestamp=node['taken_at_timestamp'],
+            likes_count=node['edge_media_preview_like']['count'],
+            comments_count=node['edge_media_to_comment']['count'],
+        )
 
 
 class CommentParser(Parser):
@@ -85,12 +236,7 @@ class CommentParser(Parser):
     def parse_data(self):
         try:
             edges = self.data['data']['shortcode_media']['edge_media_to_parent_comment']['edges']
-
-            parsed_data = []
-            for edge in edges:
-                node_info = self.get_info(edge['node'])
-                parsed_data.append(node_info)
-            return parsed_data
+            return [self.get_info(edge['node']) for edge in edges]
         except Exception:
             print(self.data)
             return []
@@ -110,14 +256,13 @@ class CommentParser(Parser):
 
     @staticmethod
     def get_info(node):
-        return {
-            'id': node['id'],
-            'timestamp': node['created_at'],
-            'formatted-time': datetime.fromtimestamp(int(node['created_at'])).strftime('%Y-%m-%d %H:%M:%S'),
-            'text': node['text'],
-            'username': node['owner']['username'],
-            'likes_count': node['edge_liked_by']['count']
-        }
+        return CommentRecord(
+            id=node['id'],
+            timestamp=node['created_at'],
+            text=node['text'],
+            username=node['owner']['username'],
+            likes_count=node['edge_liked_by']['count'],
+        )
 
 
 class TagPostParser(Parser):
@@ -127,11 +272,7 @@ class TagPostParser(Parser):
 
     def parse_data(self):
         edges = self.data['data']['hashtag']['edge_hashtag_to_media']['edges']
-        parsed_data = []
-        for edge in edges:
-            node_info = self.get_info(edge['node'])
-            parsed_data.append(node_info)
-        return parsed_data
+        return [self.get_info(edge['node']) for edge in edges]
 
     def parse_next_variables(self):
         next_variable = self.variables.copy()
@@ -148,14 +289,47 @@ class TagPostParser(Parser):
 
     @staticmethod
     def get_info(node):
-        return {
-            'id': node['id'],
-            'short_code': node['shortcode'],
-            'text': node['edge_media_to_caption']['edges'][0]['node']['text'] if len(node['edge_media_to_caption']['edges']) > 0 else '',
-            'display_image_url': node['display_url'],
-            'is_video': node['is_video'],
-            'timestamp': node['taken_at_timestamp'],
-            'formatted-time': datetime.fromtimestamp(int(node['taken_at_timestamp'])).strftime('%Y-%m-%d %H:%M:%S'),
-            'likes_count': node['edge_media_preview_like']['count'],
-            'comments_count': node['edge_media_to_comment']['count']
-        }
+        caption_edges = node['edge_media_to_caption']['edges']
+        return TagPostRecord(
+            id=node['id'],
+            short_code=node['shortcode'],
+            text=caption_edges[0]['node']['text'] if caption_edges else '',
+            display_image_url=node['display_url'],
+            is_video=node['is_video'],
+            timestamp=node['taken_at_timestamp'],
+            likes_count=node['edge_media_preview_like']['count'],
+            comments_count=node['edge_media_to_comment']['count'],
+        )
+
+
+class MediaParser(Parser):
+    """A parser of the media of a post queried by its short code, whose signed urls are fresh"""
+    def __init__(self, data, variables):
+        super().__init__(data, variables)
+
+    def parse_data(self):
+        node = self.data['data']['shortcode_media']
+        return [self.get_info(node)] if node else []
+
+    def parse_next_variables(self):
+        return self.variables.copy()
+
+    def parse_page_info(self):
+        return {'has_next': False}
+
+    @staticmethod
+    def get_info(node):
+        caption_edges = node.get('edge_media_to_caption', {}).get('edges', [])
+        comments = node.get('edge_media_to_parent_comment', node.get('edge_media_to_comment', {}))
+        is_video = node.get('is_video', False)
+        return PostRecord(
+            id=node.get('id'),
+            short_code=node['shortcode'],
+            text=caption_edges[0]['node']['text'] if caption_edges else '',
+            display_image_url=node['display_url'],
+            is_video=is_video,
+            video_url=node.get('video_url', '') if is_video else '',
+            timestamp=node['taken_at_timestamp'],
+            likes_count=node['edge_media_preview_like']['count'],
+            comments_count=comments.get('count'),
+        )
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Pool of proxies shared by queries and downloaders
+# Author: Tishacy
+# Date: 2021-05-04
+import time
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import get_config
+from .sessions import get_session
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('proxypool')
+
+# Status codes sent by a proxy itself rather than by the server behind it.
+PROXY_ERROR_STATUSES = (407, 502, 504)
+
+
+class Proxy:
+    """A proxy with its in-flight requests and health stats.
+    The latency and the error rate are moving averages over the recent requests.
+    :argument proxies: (Dict) proxies of requests, {} to connect directly
+    :argument name: name of the proxy
+    :argument max_inflight: (Int|None) max number of requests sent through the proxy at the same time
+    """
+    # Weight of the newest request in the moving averages.
+    ALPHA = 0.2
+
+    def __init__(self, proxies, name=None, max_inflight=None):
+        self.proxies = proxies
+        self.name = name or proxies.get('https') or proxies.get('http') or 'direct'
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests_count = 0
+        self.failure_count = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url, max_inflight=None):
+        """Create a proxy of both http and https requests.
+        :param url: (Str) proxy url, e.g. 'http://127.0.0.1:1087'
+        :param max_inflight: (Int|None) max number of requests sent through the proxy at the same time
+        :rtype Proxy:
+        """
+        return cls({'http': url, 'https': url}, url, max_inflight)
+
+    @property
+    def is_full(self):
+        return self.max_inflight is not None and self.inflight >= self.max_inflight
+
+    @property
+    def is_ejected(self):
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def score(self):
+        """Expected cost of the next request, the lower the better. Unmeasured proxies come first."""
+        return (self.latency or 0) * (1 + self.inflight) / max(0.1, 1 - self.error_rate)
+
+    def observe(self, res):
+        """Record the latency of a response received through the proxy.
+        :param res: (requests.Response) response
+        :return None:
+        """
+        self._record(res.elapsed.total_seconds(), res.status_code in PROXY_ERROR_STATUSES)
+
+    def _record(self, latency=None, failed=False):
+        with self._lock:
+            self.requests_count += 1
+            self.error_rate += self.ALPHA * ((1.0 if failed else 0.0) - self.error_rate)
+            if failed:
+                self.failure_count += 1
+                self.consecutive_failures += 1
+            else:
+                self.consecutive_failures = 0
+                self.latency = latency if self.latency is None else \
+                    self.latency + self.ALPHA * (latency - self.latency)
+
+    @property
+    def stats(self):
+        return {
+            'name': self.name,
+            'inflight': self.inflight,
+            'latency (ms)': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'error rate': round(self.error_rate, 3),
+            'requests': self.requests_count,
+            'failures': self.failure_count,
+            'ejected': self.is_ejected,
+        }
+
+    def __repr__(self):
+        return "Proxy{%s}" % self.name
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class ProxyPool:
+    """Pool of proxies routing each request to the healthiest proxy with a free slot.
+    A proxy failing eject_after requests in a row is ejected for eject_for seconds, and
+    gets one request again afterwards, which ejects it again if it still fails. When all
+    the proxies are ejected, the requests go through the least bad ones rather than stop.
+    :argument proxies: (List[Proxy]) proxies of the pool
+    :argument eject_after: (Int) number of failures in a row ejecting a proxy
+    :argument eject_for: (Float) seconds a proxy is ejected for
+    """
+    def __init__(self, proxies, eject_after=3, eject_for=60.0):
+        if not proxies:
+            raise ValueError("A proxy pool needs at least one proxy.")
+        self.proxies = list(proxies)
+        self.eject_after = eject_after
+        self.eject_for = eject_for
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_urls(cls, urls, max_inflight=8, **kwargs):
+        """Create a pool of proxy urls.
+        :param urls: (List[Str]) proxy urls
+        :param max_inflight: (Int|None) max number of requests sent through each proxy at the same time
+        :rtype ProxyPool:
+        """
+        return cls([Proxy.from_url(url, max_inflight) for url in urls], **kwargs)
+
+    @classmethod
+    def direct(cls, proxies=None):
+        """Create a pool of one unlimited proxy, which is the configured proxies or a direct connection.
+        :param proxies: (Dict|None) proxies of requests
+        :rtype ProxyPool:
+        """
+        return cls([Proxy(proxies or {})])
+
+    def _pick(self):
+        candidates = [proxy for proxy in self.proxies if not proxy.is_ejected] or self.proxies
+        candidates = [proxy for proxy in candidates if not proxy.is_full]
+        return min(candidates, key=lambda proxy: proxy.score) if candidates else None
+
+    def acquire(self):
+        """Block until a proxy has a free slot, and take the slot of the healthiest one.
+        :rtype Proxy:
+        """
+        with self._cond:
+            proxy = self._pick()
+            while proxy is None:
+                # Wake up regularly, since an ejected proxy may come back meanwhile.
+                self._cond.wait(1.0)
+                proxy = self._pick()
+            proxy.inflight += 1
+            return proxy
+
+    def release(self, proxy, failed=False):
+        """Give back the slot of a proxy.
+        :param proxy: (Proxy) proxy acquired
+        :param failed: (Bool) whether the request failed because of the proxy
+        :return None:
+        """
+        if failed:
+            proxy._record(failed=True)
+        with self._cond:
+            proxy.inflight -= 1
+            if proxy.consecutive_failures >= self.eject_after and not proxy.is_ejected:
+                proxy.ejected_until = time.monotonic() + self.eject_for
+                logger.warning("%s failed %d times in a row, ejected for %.0fs."
+                               % (proxy, proxy.consecutive_failures, self.eject_for))
+            self._cond.notify()
+
+    @contextmanager
+    def use(self):
+        """Hold a slot of a proxy while sending requests through it. A connection error
+        escaping the block is recorded as a failure of the proxy, and the latency is
+        recorded by calling proxy.observe(res) in the block.
+        """
+        proxy = self.acquire()
+        failed = False
+        try:
+            yield proxy
+        except requests.RequestException:
+            failed = True
+            raise
+        finally:
+            self.release(proxy, failed)
+
+    def check(self, url='https://www.instagram.com/', timeout=10):
+        """Send a request through every proxy to measure its latency, e.g. before a run.
+        :param url: (Str) url to request
+        :param timeout: (Float) timeout of each request
+        :rtype List[Dict]: stats of each proxy
+        """
+        def check_one(proxy):
+            try:
+                proxy.observe(get_session().get(url, proxies=proxy.proxies, timeout=timeout))
+            except requests.RequestException as e:
+                logger.warning("%s failed the health check: %s" % (proxy, e))
+                proxy._record(failed=True)
+
+        with ThreadPoolExecutor(max_workers=len(self.proxies)) as executor:
+            list(executor.map(check_one, self.proxies))
+        return self.stats
+
+    @property
+    def stats(self):
+        """Health stats of each proxy.
+        :rtype List[Dict]:
+        """
+        return [proxy.stats for proxy in self.proxies]
+
+
+_proxy_pools = {}
+_proxy_pools_lock = threading.Lock()
+
+
+def get_proxy_pool(config=None):
+    """Get the pool of the proxies of a config shared in the process, configured as
+        [ProxyPool]
+        Proxies : http://127.0.0.1:1087, http://127.0.0.1:1088
+        MaxInflight : 8
+    :param config: (Config|None) config, the default one by default
+    :rtype ProxyPool|None: None if no proxy pool is configured
+    """
+    config = config or get_config()
+    parser = config.parser
+    with _proxy_pools_lock:
+        if config not in _proxy_pools:
+            if not parser.has_option('ProxyPool', 'Proxies'):
+                return None
+            urls = [url.strip() for url in parser.get('ProxyPool', 'Proxies').split(',') if url.strip()]
+            max_inflight = parser.getint('ProxyPool', 'MaxInflight', fallback=8)
+            logger.info("Routing the requests over %d proxies." % len(urls))
+            _proxy_pools[config] = ProxyPool.from_urls(urls, max_inflight)
+        return _proxy_pools[config]
@@ -1,45 +1,120 @@
 # -*- coding: utf-8 -*-
 # Author: Tishacy
 # Date: 2021-03-26
+import time
 import logging
 import requests
 import json
-import time
 
-from .common import *
+from .common import get_config
+from .ratelimit import RetryError, get_rate_limiter, parse_retry_after
+from .jsonlib import loads
+from .accounts import PooledSession, SessionPool, get_session_pool
+from .proxypool import ProxyPool, get_proxy_pool
+from .sessions import get_session
+from .metrics import get_metrics
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
 logger = logging.getLogger('query')
 
+BASE_API = "https://www.instagram.com/graphql/query/?query_hash=%s&variables=%s"
+
+
+def init_sess(config=None):
+    """Get the http session with the configured user agent and cookie shared in the process.
+    :param config: (Config|None) config, the default one by default
+    :rtype requests.Session:
+    """
+    return get_session(config=config)
+
 
 class Query:
     """Query class of instagram api.
     :argument parser_cls: a parser class
+    :argument checkpoint: (Checkpoint|None) checkpoint store to resume paginations from
+    :argument rate_limiter: (RateLimiter|None) rate limiter, the one shared in the process by default
+    :argument sess: (requests.Session|None) http session, the one shared in the process by default
+    :argument cache: (ResponseCache|None) cache of the raw responses
+    :argument base_api: (Str|None) api url with the placeholders of the query hash and variables, BASE_API by default
+    :argument proxies: (Dict|None) proxies of requests, the configured ones by default
+    :argument pool: (SessionPool|None) pool of sessions handed out per request, which overrides
+        rate_limiter, sess and proxies. By default, the pool of the accounts of config.ini if any
+        is configured and none of rate_limiter, sess and proxies is given.
+    :argument proxy_pool: (ProxyPool|None) pool of proxies routing the requests, which overrides
+        the proxies of the sessions. By default, the pool of the proxies of config.ini if any
+        is configured and proxies is not given.
+    :argument config: (Config|None) config of the session, accounts and proxies, the default one by default
     """
-    def __init__(self, parser_cls):
+    def __init__(self, parser_cls, checkpoint=None, rate_limiter=None, sess=None, cache=None,
+                 base_api=None, proxies=None, pool=None, proxy_pool=None, config=None):
         self._parser_cls = parser_cls
-        self._proxies = self._init_proxies()
-        self._sess = self._init_sess()
-        self._base_api = "https://www.instagram.com/graphql/query/?query_hash=%s&variables=%s"
-
-    @staticmethod
-    def _init_sess():
-        sess = requests.Session()
-        sess.headers.update({
-            'User-Agent': USER_AGENT,
-            'Cookie': COOKIE
-        })
-        return sess
-
-    @staticmethod
-    def _init_proxies():
-        proxies = {}
-        if HTTP_PROXY:
-            proxies['http'] = HTTP_PROXY
-        if HTTPS_PROXY:
-            proxies['https'] = HTTPS_PROXY
-        return proxies
+        self._checkpoint = checkpoint
+        self._cache = cache
+        self._base_api = base_api or BASE_API
+        self._config = config or get_config()
+        if pool is None and rate_limiter is None and sess is None and proxies is None:
+            pool = get_session_pool(self._config)
+        if pool is None:
+            pool = SessionPool([PooledSession(
+                sess or init_sess(self._config),
+                rate_limiter or get_rate_limiter('query'),
+                self._config.proxies if proxies is None else proxies)])
+        self._pool = pool
+        if proxy_pool is None and proxies is None:
+            proxy_pool = get_proxy_pool(self._config)
+        self._proxy_pool = proxy_pool or ProxyPool.direct()
+        self._metrics = get_metrics()
+
+    @property
+    def pool(self):
+        return self._pool
+
+    def _fetch(self, url):
+        """Fetch the data of the url, retrying with backoff while being throttled.
+        :param url: (Str) filled api url
+        :rtype Tuple[Dict, Bytes]: the data and the raw response
+        """
+        metrics = self._metrics
+        max_retries = self._pool.max_retries
+        for attempt in range(max_retries + 1):
+            if attempt:
+                metrics.inc('retries_total', stage='query')
+            start = time.perf_counter()
+            session = self._pool.acquire()
+            metrics.inc('sleep_seconds_total', time.perf_counter() - start, stage='query')
+            retry_after = None
+            try:
+                with self._proxy_pool.use() as proxy:
+                    try:
+                        res = session.sess.get(url, proxies=proxy.proxies or session.proxies)
+                    except requests.RequestException:
+                        metrics.inc('requests_total', stage='query', status='error')
+                        raise
+                    proxy.observe(res)
+                metrics.inc('requests_total', stage='query', status=res.status_code)
+                metrics.inc('bytes_total', len(res.content), stage='query')
+                metrics.observe('request_seconds', res.elapsed.total_seconds(), stage='query')
+                retry_after = parse_retry_after(res.headers)
+                data = loads(res.content)
+                # A throttled query gets either a 429 or a "please wait" message without 'ok' status.
+                if res.status_code != 429 and ('status' not in data or data['status'] == 'ok'):
+                    self._pool.on_success(session)
+                    return data, res.content
+                reason = "status code %s, %s" % (res.status_code, data.get('message', data.get('status')))
+            except requests.exceptions.ProxyError as e:
+                if len(self._proxy_pool.proxies) > 1:
+                    # A failing proxy says nothing about the throttling of the session.
+                    logger.info("%s failed (%r), retrying through another proxy..." % (proxy, e))
+                    continue
+                reason = repr(e)
+            except (requests.RequestException, ValueError) as e:
+                reason = repr(e)
+
+            delay = self._pool.on_throttle(session, retry_after)
+            logger.info("Throttled (%s), session %s cools down for %.1fs..." % (reason, session.name, delay))
+
+        raise RetryError("Still throttled after %d retries: %s" % (max_retries, url))
 
     def query_batch(self, query_hash, variables):
         """Query batch data.
@@ -50,42 +125,83 @@ class Query:
         dump_variables = json.dumps(variables)
         filled_api = self._base_api % (query_hash, dump_variables)
 
-        res = self._sess.get(filled_api, proxies=self._proxies)
-        data = json.loads(res.content.decode())
-
-        while 'status' in data and data['status'] != 'ok':
-            # return [], variables, { 'has_next': True }
-            time.sleep(5)
-            logger.info("Retrying...")
-            res = self._sess.get(filled_api, proxies=self._proxies)
-            data = json.loads(res.content.decode())
+        content = self._cache.get(query_hash, variables) if self._cache is not None else None
+        if content is not None:
+            self._metrics.inc('cache_hits_total')
+            data = loads(content)
+        else:
+            data, content = self._fetch(filled_api)
+            if self._cache is not None:
+                self._cache.put(query_hash, variables, content)
 
-        parser = self._parser_cls(data, variables)
-        parsed_data = parser.parse_data()
-        next_variables = parser.parse_next_variables()
-        page_info = parser.parse_page_info()
+        parser_name = self._parser_cls.__name__
+        with self._metrics.timer('parse_seconds', parser=parser_name):
+            parser = self._parser_cls(data, variables)
+            parsed_data = parser.parse_data()
+            next_variables = parser.parse_next_variables()
+            page_info = parser.parse_page_info()
+        self._metrics.inc('items_total', len(parsed_data), parser=parser_name)
         return parsed_data, next_variables, page_info
 
-    def query_all(self, query_hash, variables, total_count=None):
-        """Query batch data.
+    def iter_pages(self, query_hash, variables, total_count=None):
+        """Iterate over the pages of data, yielding each page as soon as it is queried.
+        The last page is truncated so that no more than total_count items are yielded,
+        and no more page is queried once total_count is reached.
+        With a checkpoint store, the data saved by an interrupted run are yielded first
+        as one page, and the pagination continues from the saved cursor.
         :param query_hash: (Str) query hash code
         :param variables: (Dict) query variables
         :param total_count: (Int) max number of data
-        :rtype List[Dict]:
+        :rtype Iterator[Tuple[List[Dict], Dict]]:
         """
-        all_data = []
-        parsed_data, variables, page_info = self.query_batch(query_hash, variables)
-        all_data.extend(parsed_data)
-        logger.info("Current count of data: %s, has next: %s" % (len(all_data), page_info['has_next']))
+        first_variables = variables
+        count = 0
+        has_next = True
+
+        if self._checkpoint is not None:
+            state = self._checkpoint.load(query_hash, first_variables)
+            if state is not None:
+                variables, saved_data, has_next = state
+                if total_count and len(saved_data) >= total_count:
+                    saved_data = saved_data[:total_count]
+                    has_next = False
+                count = len(saved_data)
+                logger.info("Resumed %s data from the checkpoint, has next: %s" % (count, has_next))
+                yield saved_data, {'has_next': has_next, 'resumed': True}
 
-        while page_info['has_next']:
+        while has_next:
             parsed_data, variables, page_info = self.query_batch(query_hash, variables)
-            all_data.extend(parsed_data)
-            logger.info("Current count of data: %s, has next: %s" % (len(all_data), page_info['has_next']))
+            has_next = page_info['has_next']
 
-            if total_count and len(all_data) >= total_count:
-                break
+            if total_count and count + len(parsed_data) >= total_count:
+                parsed_data = parsed_data[:total_count - count]
+                has_next = False
 
-        if total_count and total_count < len(all_data):
-            return all_data[:total_count]
-        return all_data
+            if self._checkpoint is not None:
+                self._checkpoint.save(query_hash, first_variables, variables, parsed_data, has_next)
+
+            count += len(parsed_data)
+            logger.info("Current count of data: %s, has next: %s" % (count, page_info['has_next']))
+            yield parsed_data, page_info
+
+        if self._checkpoint is not None:
+            self._checkpoint.finish(query_hash, first_variables)
+
+    def iter_items(self, query_hash, variables, total_count=None):
+        """Iterate over the data items, yielding the items of each page as soon as it is queried.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :param total_count: (Int) max number of data
+        :rtype Iterator[Dict]:
+        """
+        for parsed_data, _ in self.iter_pages(query_hash, variables, total_count):
+            yield from parsed_data
+
+    def query_all(self, query_hash, variables, total_count=None):
+        """Query batch data.
+        :param query_hash: (Str) query hash code
+        :param variables: (Dict) query variables
+        :param total_count: (Int) max number of data
+        :rtype List[Dict]:
+        """
+        return list(self.iter_items(query_hash, variables, total_count))
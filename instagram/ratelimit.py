@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Rate limiters shared by queries and downloaders
+# Author: Tishacy
+# Date: 2021-04-14
+import time
+import random
+import asyncio
+import threading
+
+
+class RetryError(RuntimeError):
+    """Raised when a request is still throttled after the max number of retries."""
+    pass
+
+
+class RateLimiter:
+    """Token bucket rate limiter adapting its rate to throttled responses.
+    The rate is increased additively after each successful request and halved after
+    each throttled one (AIMD), so it settles around the highest rate the endpoint
+    allows. A throttled response also pauses every request sharing the limiter for an
+    exponential backoff delay with jitter.
+    :argument rate: (Float) initial number of requests per second
+    :argument burst: (Int) max number of requests sent at once
+    :argument min_rate: (Float) min number of requests per second
+    :argument max_rate: (Float) max number of requests per second
+    :argument increase: (Float) rate increased after each successful request
+    :argument base_delay: (Float) backoff delay in seconds of the first retry
+    :argument max_delay: (Float) max backoff delay in seconds
+    :argument max_retries: (Int) max number of retries of one request
+    """
+    def __init__(self, rate=1.0, burst=5, min_rate=0.05, max_rate=20.0, increase=0.1,
+                 base_delay=5.0, max_delay=300.0, max_retries=8):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token from the bucket.
+        :rtype Float: seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            return max(wait, self._blocked_until - now)
+
+    def wait_time(self):
+        """Get the seconds to wait before a request is allowed to be sent, without taking a token.
+        :rtype Float:
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            wait = (1 - tokens) / self.rate if tokens < 1 else 0
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self):
+        """Block until a request is allowed to be sent.
+        :rtype Float: seconds waited
+        """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        """Wait on the event loop until a request is allowed to be sent.
+        :rtype Float: seconds waited
+        """
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def backoff(self, attempt):
+        """Get the backoff delay of a retry, with half of it randomized as jitter.
+        :param attempt: (Int) number of the retries already done
+        :rtype Float:
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def on_success(self):
+        """Increase the rate after a successful request."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, attempt, retry_after=None):
+        """Decrease the rate and pause the requests after a throttled request.
+        :param attempt: (Int) number of the retries already done
+        :param retry_after: (Float|None) delay in seconds asked by the server
+        :rtype Float: delay in seconds before the next request
+        """
+        delay = max(self.backoff(attempt), retry_after or 0)
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+
+
+# Default settings of the rate limiters shared in the process.
+DEFAULT_RATE_LIMITS = {
+    'query': dict(rate=1.0, burst=5, max_rate=20.0, increase=0.1),
+    'download': dict(rate=50.0, burst=100, max_rate=1000.0, increase=5.0,
+                     base_delay=1.0, max_delay=60.0, max_retries=5),
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name='query'):
+    """Get the rate limiter of the given name shared in the process.
+    :param name: (Str) name of the rate limiter, 'query' or 'download' by default
+    :rtype RateLimiter:
+    """
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = RateLimiter(**DEFAULT_RATE_LIMITS.get(name, {}))
+        return _rate_limiters[name]
+
+
+def parse_retry_after(headers):
+    """Parse the Retry-After header of a response.
+    :param headers: (Mapping) response headers
+    :rtype Float|None:
+    """
+    retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        return None
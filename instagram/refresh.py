@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Refresher of the expired media urls used by downloader.py
+# Author: Tishacy
+# Date: 2021-05-15
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .query import Query
+from .parser import MediaParser
+from .downloader import VIDEO_EXTS
+from .common import get_config
+from .metrics import get_metrics
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('refresh')
+
+# Fields of the urls kept of the posts queried.
+URL_FIELDS = ('display_image_url', 'video_url')
+
+
+class MediaUrlRefresher:
+    """Refresher of the expired signed urls of the resources, which queries the media of
+    their posts by short code. Each short code is queried once by a worker of the refresher,
+    so that the resources of a post share one query while the posts are queried at the same
+    time. Only the urls of the max_posts posts asked last are kept for the next resources,
+    and a short code whose query failed is queried again the next time it is asked.
+    :argument query: (Query|None) query of the media, a Query of MediaParser by default
+    :argument query_hash: (Str|None) query hash of the media, the one of the config by default
+    :argument max_workers: (Int) max number of posts queried at the same time
+    :argument max_posts: (Int) max number of posts whose urls are kept
+    """
+    def __init__(self, query=None, query_hash=None, max_workers=4, max_posts=10000):
+        self._query = query or Query(MediaParser)
+        self._query_hash = query_hash or get_config().media_query_hash
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='refresher')
+        self._lock = threading.Lock()
+        self._max_posts = max_posts
+        # Short code -> future of the urls of the post, or None if its media are not found,
+        # from the least recently asked one.
+        self._posts = OrderedDict()
+        self._metrics = get_metrics()
+
+    @staticmethod
+    def url_field(resource):
+        """Field of the url of a resource in the post data, guessed from its extension if not given.
+        :param resource: (Resource) resource
+        :rtype Str:
+        """
+        if resource.url_field:
+            return resource.url_field
+        _, ext = os.path.splitext((resource.url or '').split("?")[0])
+        return 'video_url' if ext.lower() in VIDEO_EXTS else 'display_image_url'
+
+    def refresh(self, resource):
+        """Get a fresh url of a resource, waiting for the post of its short code to be queried.
+        :param resource: (Resource) resource having a short code
+        :rtype Str|None: None if the media of the post are not found
+        """
+        post = self.post(resource.short_code).result()
+        url = post.get(self.url_field(resource)) if post is not None else None
+        self._metrics.inc('url_refreshes_total', result='ok' if url else 'failed')
+        return url or None
+
+    def post(self, short_code):
+        """Get the fresh urls of the post of a short code, queried if they are not known yet.
+        :param short_code: (Str) short code of a post
+        :rtype Future: future of the urls of URL_FIELDS of the post, or None if it is not found
+        """
+        with self._lock:
+            future = self._posts.get(short_code)
+            if future is not None:
+                self._posts.move_to_end(short_code)
+                return future
+            future = self._posts[short_code] = Future()
+            while len(self._posts) > self._max_posts:
+                self._posts.popitem(last=False)
+        self._executor.submit(self._query_post, short_code, future)
+        return future
+
+    def _query_post(self, short_code, future):
+        logger.info("Refresh the urls of the post %s." % short_code)
+        try:
+            posts, _, _ = self._query.query_batch(self._query_hash, {'shortcode': short_code})
+        except Exception as e:
+            logger.warning("Failed to refresh the urls of the post %s: %r" % (short_code, e))
+            # Not kept, so that the next resource of the post queries it again.
+            with self._lock:
+                if self._posts.get(short_code) is future:
+                    del self._posts[short_code]
+            future.set_result(None)
+            return
+        future.set_result({field: posts[0].get(field) for field in URL_FIELDS} if posts else None)
+
+    def close(self):
+        """Stop the workers once the posts asked are queried."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
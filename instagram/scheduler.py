@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# Scheduler of crawls over many authors and tags
+# Author: Tishacy
+# Date: 2021-04-22
+import os
+import logging
+import concurrent
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .query import Query
+from .sessions import get_session
+from .accounts import get_session_pool
+from .parser import PostParser, CommentParser, TagPostParser
+from .sink import open_sink
+from .common import get_config
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('scheduler')
+
+
+class Target:
+    """A crawl target, which is the posts of an author or a tag, or the comments of a post.
+    :argument kind: 'author', 'tag' or 'post'
+    :argument name: author id, tag name or post short code
+    :argument count: max number of posts or comments to fetch, None for all
+    """
+    KINDS = ['author', 'tag', 'post']
+
+    def __init__(self, kind, name, count=None):
+        if kind not in self.KINDS:
+            raise ValueError("Target kind must be one of %s, but got %s" % (', '.join(self.KINDS), kind))
+        self.kind = kind
+        self.name = name
+        self.count = count
+
+    @property
+    def key(self):
+        return "%s:%s" % (self.kind, self.name)
+
+    def query_params(self):
+        """Get the parser class, query hash and variables of the target.
+        :rtype Tuple[type, Str, Dict]:
+        """
+        if self.kind == 'author':
+            return PostParser, get_config().posts_query_hash, {"id": self.name, "first": 50}
+        if self.kind == 'post':
+            return CommentParser, get_config().comments_query_hash, {"shortcode": self.name, "first": 50}
+        return TagPostParser, get_config().tag_posts_query_hash, {"tag_name": self.name, "first": 50}
+
+    def annotate(self, rows):
+        """Add the short code of the post to its comments.
+        :param rows: (List[Dict]) parsed data of the target
+        :rtype List[Dict]: the same rows
+        """
+        if self.kind == 'post':
+            for row in rows:
+                row['post_short_code'] = self.name
+        return rows
+
+    def __repr__(self):
+        return "Target{%s}" % self.key
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def load_targets(fpath, count=None):
+    """Load the targets from a file, one '<kind>:<name>' per line, e.g.
+        author:1596900784
+        tag:computerscience
+        post:CNbMW5Yn1NS
+    Blank lines and lines starting with '#' are skipped.
+    :param fpath: (Str) targets file path
+    :param count: (Int|None) max number of posts to fetch of each target
+    :rtype List[Target]:
+    """
+    targets = []
+    with open(fpath, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, _, name = line.partition(':')
+            targets.append(Target(kind.strip(), name.strip(), count))
+    return targets
+
+
+class _TargetState:
+    def __init__(self, target, pages, sink):
+        self.target = target
+        self.pages = pages
+        self.sink = sink
+        self.progress = {'status': 'pending', 'count': 0, 'pages': 0, 'error': None}
+
+
+class CrawlScheduler:
+    """Scheduler interleaving the paginations of many targets over a pool of workers.
+    Each worker queries one page of a target at a time, and the target goes back to
+    the end of the queue afterwards, so every target progresses fairly and a slow or
+    throttled target only holds one worker. All the targets share the pool of accounts
+    of config.ini if any, or else one http session and the rate limiter shared in the process.
+    No more than max_active targets are crawled at the same time, so that a long list of
+    targets does not hold an open file, or the buffered rows of a sink, for each target.
+    :argument out_dir: output directory, each target is written to <out_dir>/<kind>_<name><out_ext>
+    :argument out_ext: extension of the output files
+    :argument max_workers: max number of pages queried at the same time
+    :argument checkpoint: (Checkpoint|None) checkpoint store to resume paginations from
+    :argument max_active: (Int|None) max number of targets whose sinks are open, 4 * max_workers by default
+    :argument cache: (ResponseCache|None) cache of the raw responses
+    """
+    def __init__(self, out_dir='data', out_ext='.jsonl', max_workers=8, checkpoint=None, max_active=None,
+                 cache=None):
+        self._out_dir = out_dir
+        self._out_ext = out_ext
+        self._max_workers = max_workers
+        self._max_active = max(max_active or 4 * max_workers, max_workers)
+        self._checkpoint = checkpoint
+        self._cache = cache
+        self._sess = get_session(pool_maxsize=max_workers)
+        self._queries = {}
+        self._states = []
+
+    def _query(self, parser_cls):
+        if parser_cls not in self._queries:
+            self._queries[parser_cls] = Query(
+                parser_cls, self._checkpoint, sess=self._sess, cache=self._cache, pool=get_session_pool())
+        return self._queries[parser_cls]
+
+    @property
+    def progress(self):
+        """Progress of each target by its key, which is updated while running.
+        :rtype Dict[Str, Dict]:
+        """
+        return {state.target.key: state.progress for state in self._states}
+
+    def out_fpath(self, target):
+        return os.path.join(self._out_dir, "%s_%s%s" % (target.kind, target.name, self._out_ext))
+
+    @staticmethod
+    def _step(state):
+        """Query the next page of a target and write it.
+        :rtype Bool: whether the target has more pages
+        """
+        page = next(state.pages, None)
+        if page is None:
+            return False
+        parsed_data, _ = page
+        state.sink.write(state.target.annotate(parsed_data))
+        state.progress['count'] += len(parsed_data)
+        state.progress['pages'] += 1
+        return True
+
+    def _finish(self, state, status, error=None):
+        state.sink.close()
+        # Release the sink and the pagination of the finished target.
+        state.sink = state.pages = None
+        state.progress['status'] = status
+        state.progress['error'] = error
+
+    def run(self, targets):
+        """Crawl the posts of all the targets.
+        :param targets: (Iterable[Target]) targets to crawl
+        :rtype Dict[Str, Dict]: progress of each target by its key
+        """
+        states = self._states = []
+        for target in targets:
+            parser_cls, query_hash, variables = target.query_params()
+            pages = self._query(parser_cls).iter_pages(query_hash, variables, target.count)
+            states.append(_TargetState(target, pages, None))
+        waiting = deque(states)
+        ready = deque()
+        n_active = 0
+        n_finished = 0
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            future_to_state = {}
+            while waiting or ready or future_to_state:
+                # Start the waiting targets as the active ones finish.
+                while waiting and n_active < self._max_active:
+                    state = waiting.popleft()
+                    state.sink = open_sink(self.out_fpath(state.target))
+                    state.progress['status'] = 'running'
+                    ready.append(state)
+                    n_active += 1
+                while ready and len(future_to_state) < self._max_workers:
+                    state = ready.popleft()
+                    future_to_state[executor.submit(self._step, state)] = state
+
+                done, _ = concurrent.futures.wait(future_to_state, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    state = future_to_state.pop(future)
+                    try:
+                        if future.result():
+                            ready.append(state)
+                            continue
+                        self._finish(state, 'done')
+                    except Exception as e:
+                        logger.warning("%s generated an exception: %s" % (state.target, e))
+                        self._finish(state, 'failed', repr(e))
+                    n_active -= 1
+                    n_finished += 1
+                    logger.info("[%d/%d] %s %s with %d posts." % (
+                        n_finished, len(states), state.target, state.progress['status'], state.progress['count']))
+
+        return self.progress
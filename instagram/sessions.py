@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Http sessions shared by queries and downloaders
+# Author: Tishacy
+# Date: 2021-05-06
+import os
+import weakref
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from .common import get_config
+
+# Max number of hosts whose connection pools are kept, and default max number of
+# connections kept alive for each host.
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 32
+
+# Adapters of the sessions created here, which are dropped with their sessions.
+_adapters = weakref.WeakSet()
+_lock = threading.RLock()
+
+
+def _mount(sess, pool_maxsize):
+    adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=pool_maxsize)
+    replaced = {sess.adapters.get('http://'), sess.adapters.get('https://')} - {None}
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    with _lock:
+        _adapters.add(adapter)
+        _adapters.difference_update(replaced)
+    # The idle connections of the replaced pools are closed, and the ones of the requests
+    # in flight are closed when they are released to the closed pools.
+    for old_adapter in replaced:
+        old_adapter.close()
+
+
+def new_session(headers=None, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """Create a http session keeping up to pool_maxsize connections alive for each host,
+    which should be at least the number of workers sending requests through it, otherwise
+    the connections of the extra workers are discarded and reopened on every request.
+    :param headers: (Dict|None) headers of every request
+    :param pool_maxsize: (Int) max number of connections kept alive for each host
+    :rtype requests.Session:
+    """
+    sess = requests.Session()
+    _mount(sess, pool_maxsize)
+    if headers:
+        sess.headers.update(headers)
+    return sess
+
+
+def ensure_pool_maxsize(sess, pool_maxsize):
+    """Grow the connection pools of a session to keep at least pool_maxsize connections
+    alive for each host. The requests in flight finish on the previous pools.
+    :param sess: (requests.Session) http session
+    :param pool_maxsize: (Int|None) max number of connections kept alive for each host
+    :return None:
+    """
+    if pool_maxsize is None:
+        return
+    with _lock:
+        adapter = sess.get_adapter('https://')
+        if getattr(adapter, '_pool_maxsize', 0) < pool_maxsize:
+            _mount(sess, pool_maxsize)
+
+
+def _renew_pools_after_fork():
+    # The connections kept alive are shared with the parent process after a fork, whose
+    # responses would be read by either process, so the child opens its own connections.
+    global _lock
+    _lock = threading.RLock()
+    for adapter in list(_adapters):
+        adapter.init_poolmanager(adapter._pool_connections, adapter._pool_maxsize, block=adapter._pool_block)
+        adapter.proxy_manager = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_renew_pools_after_fork)
+
+
+_sessions = {}
+
+
+def get_session(pool_maxsize=None, config=None):
+    """Get the http session with the configured user agent and cookie shared in the process.
+    :param pool_maxsize: (Int|None) max number of connections kept alive for each host,
+        which grows the pools of the session if larger than the current one
+    :param config: (Config|None) config of the session, the default one by default
+    :rtype requests.Session:
+    """
+    config = config or get_config()
+    with _lock:
+        sess = _sessions.get(config)
+        if sess is None:
+            sess = _sessions[config] = new_session({
+                'User-Agent': config.user_agent,
+                'Cookie': config.cookie
+            }, max(pool_maxsize or 0, DEFAULT_POOL_MAXSIZE))
+        else:
+            ensure_pool_maxsize(sess, pool_maxsize)
+        return sess
+
+
+def pool_stats():
+    """Reuse of the connections of all the sessions created here. A request sent on
+    a kept-alive connection is a hit, and one which opens a new connection is a miss.
+    :rtype Dict:
+    """
+    requests_count = connections_count = 0
+    with _lock:
+        adapters = list(_adapters)
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
+    hits = requests_count - connections_count
+    return {
+        'requests': requests_count,
+        'hits': hits,
+        'misses': connections_count,
+        'hit rate': round(hits / requests_count, 3) if requests_count else 0.0,
+    }
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+# Sharded crawls over worker processes and hosts sharing a work queue
+# Author: Tishacy
+# Date: 2021-05-08
+import os
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .query import Query
+from .checkpoint import Checkpoint
+from .scheduler import Target, load_targets
+from .sink import open_sink, read_data, SINKS
+from .metrics import MetricsReporter, profile
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+logger = logging.getLogger('shard')
+
+# Names of the merged output files of each kind of targets.
+MERGED_NAMES = {
+    'author': 'posts_data',
+    'tag': 'tag_posts_data',
+    'post': 'comments_data',
+}
+
+
+class LeaseLostError(Exception):
+    """The lease of a claimed target has expired, and the target may be claimed by another worker."""
+    pass
+
+
+class WorkQueue:
+    """Queue of crawl targets in a SQLite file, shared by the worker processes of one
+    host, or of several hosts through a shared directory. A worker claims a target
+    with a lease, which it renews from a heartbeat thread while crawling the target,
+    see LeaseKeeper, so the target of a worker which died is claimed again by another
+    one once its lease expires, and only the worker holding the lease may finish it.
+    :argument fpath: path of the SQLite file
+    :argument lease: (Float) seconds a claimed target is kept by a silent worker
+    """
+    def __init__(self, fpath='data/.queue.db', lease=600.0):
+        _dir, _ = os.path.split(fpath)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
+        self._lease = lease
+        self._lock = threading.Lock()
+        # Transactions are begun explicitly, so that a claim locks the queue for writing.
+        self._conn = sqlite3.connect(fpath, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS targets ("
+                               "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, name TEXT NOT NULL, count INTEGER, "
+                               "status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, error TEXT, "
+                               "UNIQUE (kind, name))")
+
+    def put(self, targets):
+        """Add targets to the queue, skipping the ones already in it.
+        :param targets: (Iterable[Target]) targets
+        :rtype Int: number of targets added
+        """
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("INSERT OR IGNORE INTO targets (kind, name, count) VALUES (?, ?, ?)",
+                                   [(target.kind, target.name, target.count) for target in targets])
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def claim(self, worker):
+        """Claim the next pending target, or a target whose lease expired.
+        :param worker: (Str) worker id
+        :rtype Tuple[Int, Target, Str|None]|None: id, target and the worker which held it before if any,
+            None if no target is left to claim
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, kind, name, count, worker FROM targets "
+                    "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) "
+                    "ORDER BY id LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE targets SET status = 'running', worker = ?, lease_until = ? "
+                                       "WHERE id = ?", (worker, now + self._lease, row[0]))
+            finally:
+                self._conn.execute("COMMIT")
+        if row is None:
+            return None
+        _id, kind, name, count, previous = row
+        return _id, Target(kind, name, count), previous
+
+    @property
+    def lease(self):
+        return self._lease
+
+    def renew(self, _id, worker):
+        """Renew the lease of a claimed target, unless another worker has claimed it since.
+        :param _id: (Int) id of the target
+        :param worker: (Str) worker id
+        :rtype Bool: whether the worker still holds the lease
+        """
+        with self._lock:
+            return self._conn.execute("UPDATE targets SET lease_until = ? "
+                                      "WHERE id = ? AND worker = ? AND status = 'running'",
+                                      (time.time() + self._lease, _id, worker)).rowcount > 0
+
+    def finish(self, _id, worker, error=None):
+        """Mark a claimed target as done, or as failed with an error, unless another worker
+        has claimed it since, in which case nothing is changed.
+        :param _id: (Int) id of the target
+        :param worker: (Str) worker id
+        :param error: (Str|None) error of a failed target
+        :rtype Bool: whether the target is marked
+        """
+        with self._lock:
+            return self._conn.execute("UPDATE targets SET status = ?, error = ?, lease_until = NULL "
+                                      "WHERE id = ? AND worker = ? AND status = 'running'",
+                                      ('failed' if error else 'done', error, _id, worker)).rowcount > 0
+
+    def retry_failed(self):
+        """Put the failed targets back to pending.
+        :rtype Int: number of targets put back
+        """
+        with self._lock:
+            return self._conn.execute("UPDATE targets SET status = 'pending', error = NULL "
+                                      "WHERE status = 'failed'").rowcount
+
+    def progress(self):
+        """Number of targets of each status.
+        :rtype Dict[Str, Int]:
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM targets GROUP BY status").fetchall())
+
+    def close(self):
+        self._conn.close()
+
+
+class LeaseKeeper:
+    """Heartbeat thread renewing the lease of a claimed target every third of the lease,
+    so that a target whose pages wait long for the rate limiter is not claimed again.
+    :argument queue: (WorkQueue) work queue
+    :argument _id: (Int) id of the target
+    :argument worker: (Str) worker id
+    """
+    def __init__(self, queue, _id, worker):
+        self._queue = queue
+        self._id = _id
+        self._worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-keeper', daemon=True)
+        self.lost = False
+
+    def _run(self):
+        while not self._stop.wait(self._queue.lease / 3):
+            try:
+                if not self._queue.renew(self._id, self._worker):
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                logger.warning("[%s] Failed to renew the lease of %s: %r" % (self._worker, self._id, e))
+
+    def check(self):
+        """Renew the lease, e.g. before publishing the partition, and raise LeaseLostError if it is lost."""
+        if self.lost or not self._queue.renew(self._id, self._worker):
+            self.lost = True
+            raise LeaseLostError("The lease of the target %s is lost by %s." % (self._id, self._worker))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+class LeasedCheckpoint(Checkpoint):
+    """Checkpoint store of a worker, which checks that the worker still holds the lease of
+    its target before saving a page, so that a worker which lost its target never writes
+    to the checkpoint another worker resumes from.
+    :argument root: directory of the checkpoints of the worker
+    :argument lease: (LeaseKeeper) lease of the target
+    """
+    def __init__(self, root, lease):
+        super().__init__(root)
+        self._lease = lease
+
+    def save(self, query_hash, variables, next_variables, parsed_data, has_next):
+        self._lease.check()
+        super().save(query_hash, variables, next_variables, parsed_data, has_next)
+
+
+def checkpoint_root(out_dir, worker):
+    """Get the directory of the checkpoints of a worker.
+    :rtype Str:
+    """
+    return os.path.join(out_dir, '.checkpoints', worker)
+
+
+def adopt_checkpoint(out_dir, target, worker, previous):
+    """Copy the checkpoint of a target from the worker which held it before to the store of
+    the worker claiming it, and remove the copied one. The previous worker checks its lease
+    before each save, so it no longer writes to its checkpoint once the target is claimed again.
+    :param out_dir: (Str) output directory
+    :param target: (Target) target
+    :param worker: (Str) worker id
+    :param previous: (Str|None) worker id of the previous holder of the target
+    :rtype Bool: whether a checkpoint is copied
+    """
+    if previous is None or previous == worker:
+        return False
+    _, query_hash, variables = target.query_params()
+    previous_store = Checkpoint(checkpoint_root(out_dir, previous))
+    if not previous_store.copy_to(Checkpoint(checkpoint_root(out_dir, worker)), query_hash, variables):
+        return False
+    previous_store.clear(query_hash, variables)
+    return True
+
+
+def partition_fpath(out_dir, target, out_ext):
+    """Get the path of the output partition of a target.
+    :rtype Str:
+    """
+    return os.path.join(out_dir, 'parts', target.kind, "%s_%s%s" % (target.kind, target.name, out_ext))
+
+
+def crawl_target(target, fpath, on_page=None, checkpoint=None, worker=None):
+    """Crawl a target into its output partition. The partition is written to a hidden
+    file of the worker first and renamed once complete, so it is either complete or missing,
+    and a worker which lost the target to another one never overwrites its partition.
+    :param target: (Target) target
+    :param fpath: (Str) output partition path
+    :param on_page: (Callable[[], None]|None) called after each page and before the rename,
+        which raises LeaseLostError to drop the partition of a target claimed by another worker
+    :param checkpoint: (Checkpoint|None) checkpoint store to resume the target from, owned by the worker
+    :param worker: (Str|None) worker id, which names the hidden file
+    :rtype Int: number of rows written
+    """
+    _dir, fname = os.path.split(fpath)
+    tmp_fpath = os.path.join(_dir, '.%s.%s' % (worker, fname) if worker else '.' + fname)
+    parser_cls, query_hash, variables = target.query_params()
+    query = Query(parser_cls, checkpoint)
+    try:
+        with open_sink(tmp_fpath) as sink:
+            for parsed_data, _ in query.iter_pages(query_hash, variables, target.count):
+                sink.write(target.annotate(parsed_data))
+                if on_page is not None:
+                    on_page()
+        if on_page is not None:
+            on_page()
+    except LeaseLostError:
+        os.remove(tmp_fpath)
+        raise
+    os.replace(tmp_fpath, fpath)
+    return sink.count
+
+
+def run_worker(queue_fpath, out_dir='data', out_ext='.jsonl', threads=4, worker=None,
+               metrics_dir=None, report_interval=60.0, profile_dir=None):
+    """Claim and crawl the targets of a work queue until none is left.
+    :param queue_fpath: (Str) path of the work queue
+    :param out_dir: (Str) output directory, whose 'parts' subdirectory receives the partitions
+    :param out_ext: (Str) extension of the partitions
+    :param threads: (Int) number of targets crawled at the same time by this worker
+    :param worker: (Str|None) worker id, '<host>-<pid>' by default
+    :param metrics_dir: (Str|None) directory of the Prometheus text file of the worker, None to only log the metrics
+    :param report_interval: (Float) seconds between the summaries of the metrics
+    :param profile_dir: (Str|None) directory of the cpu profile of the worker, None to disable the profiling
+    :rtype Int: number of targets crawled
+    """
+    worker = worker or "%s-%d" % (socket.gethostname(), os.getpid())
+    queue = WorkQueue(queue_fpath)
+
+    def loop():
+        n_targets = 0
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                return n_targets
+            _id, target, previous = claimed
+            fpath = partition_fpath(out_dir, target, out_ext)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            try:
+                with LeaseKeeper(queue, _id, worker) as lease:
+                    # Each worker resumes from its own checkpoints, taking over the one of a previous holder.
+                    if adopt_checkpoint(out_dir, target, worker, previous):
+                        logger.info("[%s] Took over the checkpoint of %s from %s." % (worker, target, previous))
+                    checkpoint = LeasedCheckpoint(checkpoint_root(out_dir, worker), lease)
+                    count = crawl_target(target, fpath, lease.check, checkpoint, worker)
+                if queue.finish(_id, worker):
+                    logger.info("[%s] %s done with %d rows." % (worker, target, count))
+            except LeaseLostError as e:
+                logger.warning("[%s] %s" % (worker, e))
+                continue
+            except Exception as e:
+                logger.warning("[%s] %s generated an exception: %s" % (worker, target, e))
+                queue.finish(_id, worker, repr(e))
+            n_targets += 1
+
+    metrics_fpath = os.path.join(metrics_dir, 'instagram_%s.prom' % worker) if metrics_dir else None
+    try:
+        with MetricsReporter(interval=report_interval, fpath=metrics_fpath), \
+                (profile(os.path.join(profile_dir, worker)) if profile_dir else nullcontext()):
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                return sum(executor.map(lambda _: loop(), range(threads)))
+    finally:
+        queue.close()
+
+
+def merge_partitions(out_dir='data', out_ext='.jsonl', merged_ext=None):
+    """Merge the partitions of each kind of targets into one file, e.g. the partitions
+    of the 'author' targets into <out_dir>/posts_data.jsonl.
+    :param out_dir: (Str) output directory of the partitions
+    :param out_ext: (Str) extension of the partitions
+    :param merged_ext: (Str|None) extension of the merged files, out_ext by default
+    :rtype Dict[Str, Str]: merged file path of each kind
+    """
+    merged_ext = merged_ext or out_ext
+    merged = {}
+    for kind, name in MERGED_NAMES.items():
+        parts_dir = os.path.join(out_dir, 'parts', kind)
+        if not os.path.isdir(parts_dir):
+            continue
+        fpaths = sorted(os.path.join(parts_dir, fname) for fname in os.listdir(parts_dir)
+                        if fname.endswith(out_ext) and not fname.startswith('.'))
+        if not fpaths:
+            continue
+        out_fpath = os.path.join(out_dir, name + merged_ext)
+        if out_ext == merged_ext == '.jsonl':
+            # Json lines are merged by concatenating the bytes, without parsing them.
+            with open(out_fpath, 'wb') as out_file:
+                for fpath in fpaths:
+                    with open(fpath, 'rb') as file:
+                        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                            out_file.write(chunk)
+        else:
+            with open_sink(out_fpath) as sink:
+                for fpath in fpaths:
+                    sink.write(read_data(fpath).to_dict('records'))
+        logger.info("Merged %d partitions into %s." % (len(fpaths), out_fpath))
+        merged[kind] = out_fpath
+    return merged
+
+
+def _run_worker(args):
+    return run_worker(*args)
+
+
+def _run_workers(processes, queue_fpath, out_dir, out_ext, threads, metrics_dir, profile_dir):
+    args = (queue_fpath, out_dir, out_ext, threads, None, metrics_dir, 60.0, profile_dir)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        list(executor.map(_run_worker, [args] * processes))
+
+
+def run_sharded(targets, out_dir='data', out_ext='.jsonl', processes=None, threads=4,
+                queue_fpath=None, merged_ext=None, metrics_dir=None, profile_dir=None):
+    """Crawl the targets over worker processes, and merge their partitions.
+    Other hosts may join the crawl by running workers on the same queue file, e.g.
+        python -m instagram.shard worker --queue <out_dir>/.queue.db --out-dir <out_dir>
+    :param targets: (Iterable[Target]) targets to crawl
+    :param out_dir: (Str) output directory
+    :param out_ext: (Str) extension of the partitions
+    :param processes: (Int|None) number of worker processes, the number of cpus by default
+    :param threads: (Int) number of targets crawled at the same time by each process
+    :param queue_fpath: (Str|None) path of the work queue, <out_dir>/.queue.db by default
+    :param merged_ext: (Str|None) extension of the merged files, out_ext by default
+    :param metrics_dir: (Str|None) directory of the Prometheus text files of the workers
+    :param profile_dir: (Str|None) directory of the cpu profiles of the workers
+    :rtype Dict[Str, Str]: merged file path of each kind
+    """
+    if out_ext not in SINKS:
+        raise TypeError("out_ext must be one of %s, but got %s" % (', '.join(SINKS), out_ext))
+    queue_fpath = queue_fpath or os.path.join(out_dir, '.queue.db')
+    queue = WorkQueue(queue_fpath)
+    logger.info("Queued %d new targets." % queue.put(targets))
+
+    _run_workers(processes or os.cpu_count(), queue_fpath, out_dir, out_ext, threads, metrics_dir, profile_dir)
+
+    progress = queue.progress()
+    queue.close()
+    logger.info("Progress of the targets: %s" % progress)
+    return merge_partitions(out_dir, out_ext, merged_ext)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Sharded crawls over worker processes and hosts.")
+    sub_parsers = arg_parser.add_subparsers(dest='command', required=True)
+    for command in ['run', 'enqueue', 'worker', 'merge']:
+        sub_parser = sub_parsers.add_parser(command)
+        sub_parser.add_argument('--out-dir', default='data', help="output directory")
+        sub_parser.add_argument('--ext', default='.jsonl', help="extension of the partitions")
+        sub_parser.add_argument('--queue', default=None, help="work queue file, <out-dir>/.queue.db by default")
+        if command in ['run', 'enqueue']:
+            sub_parser.add_argument('targets', help="targets file, one '<kind>:<name>' per line")
+            sub_parser.add_argument('--count', type=int, default=None, help="max number of items of each target")
+        if command in ['run', 'worker']:
+            sub_parser.add_argument('--processes', type=int, default=None, help="number of worker processes")
+            sub_parser.add_argument('--threads', type=int, default=4, help="targets crawled at once by a process")
+            sub_parser.add_argument('--metrics-dir', default=None,
+                                    help="directory of the Prometheus text files of the workers")
+            sub_parser.add_argument('--profile-dir', default=None, help="directory of the cpu profiles of the workers")
+        if command in ['run', 'merge']:
+            sub_parser.add_argument('--merged-ext', default=None, help="extension of the merged files")
+    args = arg_parser.parse_args()
+    queue_fpath = args.queue or os.path.join(args.out_dir, '.queue.db')
+
+    if args.command == 'run':
+        run_sharded(load_targets(args.targets, args.count), args.out_dir, args.ext, args.processes,
+                    args.threads, queue_fpath, args.merged_ext, args.metrics_dir, args.profile_dir)
+    elif args.command == 'enqueue':
+        queue = WorkQueue(queue_fpath)
+        logger.info("Queued %d new targets." % queue.put(load_targets(args.targets, args.count)))
+    elif args.command == 'worker':
+        _run_workers(args.processes or 1, queue_fpath, args.out_dir, args.ext, args.threads,
+                     args.metrics_dir, args.profile_dir)
+    else:
+        merge_partitions(args.out_dir, args.ext, args.merged_ext)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Output sinks of the data used by tasks
+# Author: Tishacy
+# Date: 2021-04-20
+import os
+import csv
+import json
+import threading
+from abc import ABC, abstractmethod
+
+from .parser import as_dict
+from .metrics import get_metrics
+
+
+class Sink(ABC):
+    """Abstract Sink class
+    A sink writes the rows of data to a file page by page as they arrive, and records
+    the rows written and the time spent writing them in the metrics.
+    An explicit sink has to implements the following methods:
+        _write(rows: List[Dict]) -> None
+        _close() -> None
+    :argument fpath: output file path
+    :argument append: whether to append to the existing file
+    """
+    def __init__(self, fpath, append=False):
+        self.fpath = fpath
+        self.append = append and os.path.exists(fpath) and os.path.getsize(fpath) > 0
+        self.count = 0
+        self._metrics = get_metrics()
+        self._name = type(self).__name__
+        _dir, _ = os.path.split(fpath)
+        if _dir and not os.path.exists(_dir):
+            os.makedirs(_dir, exist_ok=True)
+
+    def write(self, rows):
+        """Write a page of rows to the file.
+        :param rows: (List[Dict]) rows
+        :return None:
+        """
+        with self._metrics.timer('write_seconds', sink=self._name):
+            self._write(rows)
+        self.count += len(rows)
+        self._metrics.inc('rows_written_total', len(rows), sink=self._name)
+
+    def close(self):
+        """Flush the buffered rows and close the file."""
+        with self._metrics.timer('write_seconds', sink=self._name):
+            self._close()
+
+    @abstractmethod
+    def _write(self, rows):
+        pass
+
+    @abstractmethod
+    def _close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JsonlSink(Sink):
+    """A sink writing one json object per line"""
+    def __init__(self, fpath, append=False):
+        super().__init__(fpath, append)
+        self._file = open(fpath, 'a' if self.append else 'w', encoding='utf-8')
+
+    def _write(self, rows):
+        for row in rows:
+            self._file.write(json.dumps(as_dict(row), ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+
+class CsvSink(Sink):
+    """A sink writing comma-separated values, whose header is taken from the first row"""
+    def __init__(self, fpath, append=False):
+        super().__init__(fpath, append)
+        fieldnames = None
+        if self.append:
+            with open(fpath, 'r', encoding='utf-8', newline='') as file:
+                fieldnames = next(csv.reader(file))
+        self._file = open(fpath, 'a' if self.append else 'w', encoding='utf-8', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames, extrasaction='ignore') if fieldnames else None
+
+    def _write(self, rows):
+        if not rows:
+            return
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._file, list(rows[0].keys()), extrasaction='ignore')
+            self._writer.writeheader()
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetSink(Sink):
+    """A sink writing a parquet row group every row_group_size rows, which requires pyarrow
+    :argument row_group_size: number of rows of each row group
+    """
+    def __init__(self, fpath, append=False, row_group_size=10000):
+        if append:
+            raise ValueError("Parquet files can not be appended to.")
+        super().__init__(fpath, append)
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._row_group_size = row_group_size
+        self._rows = []
+        self._writer = None
+
+    def _flush(self):
+        if not self._rows:
+            return
+        if self._writer is None:
+            table = self._pa.Table.from_pylist([as_dict(row) for row in self._rows])
+            self._writer = self._pq.ParquetWriter(self.fpath, table.schema)
+        else:
+            table = self._pa.Table.from_pylist([as_dict(row) for row in self._rows], schema=self._writer.schema)
+        self._writer.write_table(table)
+        self._rows = []
+
+    def _write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self._row_group_size:
+            self._flush()
+
+    def _close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ExcelSink(Sink):
+    """A sink writing an excel file when closed, which keeps all rows in memory"""
+    def __init__(self, fpath, append=False):
+        super().__init__(fpath, append)
+        self._rows = []
+
+    def _write(self, rows):
+        self._rows.extend(rows)
+
+    def _close(self):
+        import pandas as pd
+        data_df = pd.DataFrame(self._rows)
+        if self.append:
+            data_df = pd.concat([pd.read_excel(self.fpath), data_df], ignore_index=True)
+        data_df.to_excel(self.fpath, index=False)
+
+
+SINKS = {
+    '.jsonl': JsonlSink,
+    '.csv': CsvSink,
+    '.parquet': ParquetSink,
+    '.xls': ExcelSink,
+    '.xlsx': ExcelSink,
+}
+
+
+def open_sink(fpath, append=False):
+    """Open a sink by the extension of the file path.
+    :param fpath: (Str) output file path, with one of the extensions of SINKS
+    :param append: (Bool) whether to append to the existing file
+    :rtype Sink:
+    """
+    _, ext = os.path.splitext(fpath)
+    if ext not in SINKS:
+        raise TypeError("fpath must have one of the extensions %s, but got %s" % (', '.join(SINKS), ext))
+    return SINKS[ext](fpath, append)
+
+
+class PartitionedSink:
+    """A sink writing the rows of each value of a key to their own file, e.g. the comments of
+    each post, so that the rows of a partition are written as soon as they arrive and the
+    buffers of a partition are released once it is closed:
+        <out_dir>/<value><ext>
+    The sinks of the partitions are opened on their first rows and kept open until closed,
+    so the rows of a partition may arrive page by page from one worker while other workers
+    write to other partitions. Each partition has its own lock, so that the writes to
+    different partitions do not wait for each other.
+    :argument out_dir: output directory
+    :argument partition_by: (Str) key of the rows whose values are the partitions
+    :argument ext: (Str) extension of the files, one of the extensions of SINKS
+    """
+    def __init__(self, out_dir, partition_by='post_short_code', ext='.jsonl'):
+        if ext not in SINKS:
+            raise TypeError("ext must be one of the extensions %s, but got %s" % (', '.join(SINKS), ext))
+        self.out_dir = out_dir
+        self.partition_by = partition_by
+        self.ext = ext
+        self.count = 0
+        # Value -> [lock, sink] of a partition, the sink being opened on the first rows.
+        self._sinks = {}
+        self._lock = threading.Lock()
+
+    def partition_fpath(self, value):
+        """Get the file path of a partition.
+        :param value: value of the key of the partition
+        :rtype Str:
+        """
+        return os.path.join(self.out_dir, str(value).replace(os.sep, '_') + self.ext)
+
+    def write(self, rows):
+        """Write rows to the files of their partitions.
+        :param rows: (List[Dict]) rows
+        :return None:
+        """
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(row[self.partition_by], []).append(row)
+        for value, partition_rows in partitions.items():
+            with self._lock:
+                partition = self._sinks.get(value)
+                if partition is None:
+                    partition = self._sinks[value] = [threading.Lock(), None]
+            with partition[0]:
+                if partition[1] is None:
+                    partition[1] = SINKS[self.ext](self.partition_fpath(value))
+                partition[1].write(partition_rows)
+            with self._lock:
+                self.count += len(partition_rows)
+
+    def close_partition(self, value):
+        """Close the file of a partition once all of its rows are written.
+        :param value: value of the key of the partition
+        :return None:
+        """
+        with self._lock:
+            partition = self._sinks.pop(value, None)
+        if partition is not None:
+            self._close(partition)
+
+    @staticmethod
+    def _close(partition):
+        with partition[0]:
+            if partition[1] is not None:
+                partition[1].close()
+
+    def close(self):
+        """Close the files of all the partitions."""
+        with self._lock:
+            partitions, self._sinks = self._sinks, {}
+        for partition in partitions.values():
+            self._close(partition)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_data(fpath):
+    """Read the data file written by a sink.
+    :param fpath: (Str) data file path, with one of the extensions of SINKS
+    :rtype pd.DataFrame:
+    """
+    import pandas as pd
+    _, ext = os.path.splitext(fpath)
+    if ext == '.jsonl':
+        return pd.read_json(fpath, lines=True, dtype=False)
+    if ext == '.csv':
+        return pd.read_csv(fpath, dtype=str, keep_default_na=False)
+    if ext == '.parquet':
+        return pd.read_parquet(fpath)
+    if ext in ['.xls', '.xlsx']:
+        return pd.read_excel(fpath)
+    raise TypeError("fpath must have one of the extensions %s, but got %s" % (', '.join(SINKS), ext))
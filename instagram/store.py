@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Content-addressed media store used by downloader.py
+# Author: Tishacy
+# Date: 2021-04-18
+import os
+import shutil
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlsplit
+
+
+class MediaStore:
+    """Content-addressed store of media files.
+    Each distinct content is stored once as a blob named by its sha256, and the
+    output files are hard links (or copies, where links are not supported) of the
+    blobs. An index maps the url paths, without the signed query strings, to the
+    blobs, so that a known media is never fetched again:
+        <root>/blobs/<hash[:2]>/<hash>      blobs
+        <root>/index.db                     url -> hash and file -> hash
+    :argument root: directory of the store
+    """
+    def __init__(self, root='data/.media'):
+        self._root = root
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS urls (url_key TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS files (out TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+
+    @staticmethod
+    def url_key(url):
+        """Get the key of a url, which is its path without the host and the signed query string.
+        :param url: (Str) media url
+        :rtype Str:
+        """
+        return urlsplit(url).path
+
+    @staticmethod
+    def new_hasher():
+        return hashlib.sha256()
+
+    def blob_path(self, digest):
+        return os.path.join(self._root, 'blobs', digest[:2], digest)
+
+    def lookup(self, url):
+        """Get the hash of a known url whose blob is in the store.
+        :param url: (Str) media url
+        :rtype Str|None:
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT hash FROM urls WHERE url_key = ?", (self.url_key(url),)).fetchone()
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            return None
+        return row[0]
+
+    def put(self, fpath, url, digest=None):
+        """Move a downloaded file into the store.
+        :param fpath: (Str) path of the downloaded file, which is moved or removed
+        :param url: (Str) media url of the file
+        :param digest: (Str|None) sha256 of the file, computed if not given
+        :rtype Str: hash of the file
+        """
+        if digest is None:
+            hasher = self.new_hasher()
+            with open(fpath, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.remove(fpath)
+        else:
+            os.replace(fpath, blob)
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (self.url_key(url), digest))
+        return digest
+
+    def link(self, digest, out):
+        """Make the output file a hard link (or a copy) of a blob.
+        :param digest: (Str) hash of the blob
+        :param out: (Str) output file path
+        :return None:
+        """
+        blob = self.blob_path(digest)
+        # Renaming a link onto another link of the same blob does nothing, so skip it.
+        if not (os.path.exists(out) and os.path.samefile(out, blob)):
+            tmp = out + '.link'
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            try:
+                os.link(blob, tmp)
+            except OSError:
+                shutil.copyfile(blob, tmp)
+            os.replace(tmp, out)
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (os.path.abspath(out), digest))
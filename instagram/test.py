@@ -6,6 +6,7 @@ import pandas as pd
 
 from .query import *
 from .parser import *
+from .common import get_config
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
@@ -14,7 +15,7 @@ logger = logging.getLogger('test')
 
 def test2():
     post_query = Query(PostParser)
-    parsed_data, next_variables, page_info = post_query.query_batch(POSTS_QUERY_HASH_PARAM, {
+    parsed_data, next_variables, page_info = post_query.query_batch(get_config().posts_query_hash, {
         "id": "586319507",
         "first": 50,
     })
@@ -26,7 +27,7 @@ def test2():
 
 def test3():
     post_query = Query(PostParser)
-    data = post_query.query_all(POSTS_QUERY_HASH_PARAM, {
+    data = post_query.query_all(get_config().posts_query_hash, {
         "id": "586319507",
         "first": 50,
     }, None)
@@ -36,7 +37,7 @@ def test3():
 
 def test4():
     comment_query = Query(CommentParser)
-    parsed_data, next_variables, page_info = comment_query.query_batch(COMMENTS_QUERY_HASH_PARAM, {
+    parsed_data, next_variables, page_info = comment_query.query_batch(get_config().comments_query_hash, {
         "shortcode": "CMh2irVJW1b",
         "first": 50,
     })
@@ -48,7 +49,7 @@ def test4():
 
 def test5():
     comment_query = Query(CommentParser)
-    data = comment_query.query_all(COMMENTS_QUERY_HASH_PARAM, {
+    data = comment_query.query_all(get_config().comments_query_hash, {
         "shortcode": "CMh2irVJW1b",
         "first": 50,
     })
@@ -60,7 +61,7 @@ def test6():
     post_query = Query(TagPostParser)
     comment_query = Query(CommentParser)
 
-    post_data = post_query.query_all(TAG_POSTS_QUERY_HASH_PARAM, {
+    post_data = post_query.query_all(get_config().tag_posts_query_hash, {
         "tag_name": "pringles",
         "first": 50,
     }, 100)
@@ -71,7 +72,7 @@ def test6():
     comment_data = []
     for i, post in enumerate(post_data):
         print("Get comment of %d %s" % (i, post['short_code']))
-        comment_data_of_one_post = comment_query.query_all(COMMENTS_QUERY_HASH_PARAM, {
+        comment_data_of_one_post = comment_query.query_all(get_config().comments_query_hash, {
             "shortcode": post['short_code'],
             "first": 50,
         }, 100)
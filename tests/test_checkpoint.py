@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Tests of the checkpoints of paginations, against the mock server of the benchmarks
+# Author: Tishacy
+# Date: 2021-05-17
+import os
+
+from instagram.benchmark import MockServer, local_environment
+from instagram.checkpoint import Checkpoint
+from instagram.query import Query
+from instagram.scheduler import Target
+
+
+def _short_codes(pages):
+    return [item['short_code'] for parsed_data, _ in pages for item in parsed_data]
+
+
+def test_resume_after_an_interrupted_page(tmp_path):
+    target = Target('author', '1', None)
+    with MockServer(pages=5, page_size=10) as server, local_environment(server, []):
+        parser_cls, query_hash, variables = target.query_params()
+        pages = Query(parser_cls, Checkpoint(str(tmp_path))).iter_pages(query_hash, variables)
+        first_pages = [next(pages), next(pages)]
+        pages.close()
+        # A crash while saving the third page leaves its bytes after the saved offset.
+        _dir = os.path.join(str(tmp_path), Checkpoint.key(query_hash, variables))
+        with open(os.path.join(_dir, 'data.jsonl'), 'ab') as file:
+            file.write(b'{"short_code": "half a pa')
+
+        resumed_pages = list(Query(parser_cls, Checkpoint(str(tmp_path))).iter_pages(query_hash, variables))
+        assert server.pages_sent == 5
+
+    assert resumed_pages[0][1]['resumed']
+    assert _short_codes(resumed_pages[:1]) == _short_codes(first_pages)
+    assert _short_codes(resumed_pages) == ['u1_%d' % i for i in range(50)]
+    # The checkpoint of the finished pagination is removed.
+    assert not os.path.exists(_dir)
+
+
+def test_resume_is_truncated_to_the_total_count(tmp_path):
+    target = Target('author', '1', None)
+    with MockServer(pages=5, page_size=10) as server, local_environment(server, []):
+        parser_cls, query_hash, variables = target.query_params()
+        pages = Query(parser_cls, Checkpoint(str(tmp_path))).iter_pages(query_hash, variables)
+        next(pages), next(pages), next(pages)
+        pages.close()
+        resumed_pages = list(Query(parser_cls, Checkpoint(str(tmp_path))).iter_pages(query_hash, variables, 25))
+        assert server.pages_sent == 3
+    assert _short_codes(resumed_pages) == ['u1_%d' % i for i in range(25)]
+
+
+def test_keep_finished_until_clear_kept(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path), keep_finished=True)
+    target = Target('post', 'abc', None)
+    with MockServer(pages=2, page_size=10) as server, local_environment(server, []):
+        parser_cls, query_hash, variables = target.query_params()
+        assert len(Query(parser_cls, checkpoint).query_all(query_hash, variables)) == 20
+        # A rerun loads the finished pagination without querying it.
+        assert len(Query(parser_cls, checkpoint).query_all(query_hash, variables)) == 20
+        assert server.pages_sent == 2
+
+    assert checkpoint.load(query_hash, variables)[2] is False
+    checkpoint.clear_kept()
+    assert checkpoint.load(query_hash, variables) is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_copy_to_another_store(tmp_path):
+    source = Checkpoint(str(tmp_path / 'a'))
+    other = Checkpoint(str(tmp_path / 'b'))
+    source.save('hash', {'id': '1'}, {'id': '1', 'after': '2'}, [{'short_code': 'x'}, {'short_code': 'y'}], True)
+    assert source.copy_to(other, 'hash', {'id': '1'})
+    assert other.load('hash', {'id': '1'}) == source.load('hash', {'id': '1'})
+    assert not Checkpoint(str(tmp_path / 'c')).copy_to(other, 'hash', {'id': '2'})
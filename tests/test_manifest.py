@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Tests of the manifest of the downloads, against a local stand-in of the CDN
+# Author: Tishacy
+# Date: 2021-05-17
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from instagram import common
+from instagram.downloader import Downloader, Resource
+from instagram.manifest import DownloadManifest
+from instagram.refresh import MediaUrlRefresher
+from instagram.parser import MediaParser
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Media of 100 bytes, except the urls under /old/ whose signature has expired."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        status, body = (403, b'') if self.path.startswith('/old/') else (200, b'x' * 100)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def cdn():
+    saved = common._config
+    common.set_config(common.Config())
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_port
+    server.shutdown()
+    server.server_close()
+    common.set_config(saved)
+
+
+class _MediaQuery:
+    """Query of the media of a post answering fresh urls, and no post for the short code 'gone'."""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.short_codes = []
+
+    def query_batch(self, query_hash, variables):
+        short_code = variables['shortcode']
+        self.short_codes.append(short_code)
+        if short_code == 'gone':
+            return [], variables, {}
+        parser = MediaParser({'data': {'shortcode_media': {
+            'shortcode': short_code,
+            'display_url': "%s/new/%s.jpg?oe=%x" % (self.base_url, short_code, int(time.time()) + 3600),
+            'is_video': False,
+            'taken_at_timestamp': 1600000000,
+            'edge_media_preview_like': {'count': 7},
+        }}}, variables)
+        return parser.parse_data(), variables, parser.parse_page_info()
+
+
+def _rows(manifest):
+    return {os.path.basename(out): (status, attempts, error) for out, status, attempts, error in
+            manifest._conn.execute("SELECT out, status, attempts, error FROM resources").fetchall()}
+
+
+def test_batched_records_and_iter_missing(tmp_path):
+    with DownloadManifest(str(tmp_path / 'manifest.db'), batch_size=3, flush_interval=3600) as manifest:
+        resources = [Resource('http://cdn/%d.jpg' % i, str(tmp_path / ('%d.jpg' % i))) for i in range(5)]
+        assert manifest.add(resources) == 5
+        manifest.record(resources[0].out, resources[0].url, True, 10)
+        manifest.record(resources[1].out, resources[1].url, False, error='status code 500')
+        # Buffered until the batch is full.
+        assert _rows(manifest)['0.jpg'] == ('pending', 0, None)
+        manifest.record(resources[2].out, resources[2].url, False, error='status code 500')
+        assert _rows(manifest)['0.jpg'] == ('done', 1, None)
+        manifest.record(resources[1].out, resources[1].url, False, error='status code 404')
+
+        assert manifest.stats() == {'done': {'count': 1, 'bytes': 10}, 'failed': {'count': 2, 'bytes': 0},
+                                    'pending': {'count': 2, 'bytes': 0}}
+        assert [f['out'] for f in manifest.failures()] == [resources[1].out, resources[2].out]
+        assert manifest.failures()[0]['error'] == 'status code 404'
+        assert sorted(r.out for r in manifest.iter_missing(batch_size=2)) == [r.out for r in resources[1:]]
+        assert sorted(r.out for r in manifest.iter_missing(max_attempts=2)) == [r.out for r in resources[2:]]
+
+        # The done resources keep their urls, the other ones get the new ones.
+        manifest.add([Resource('http://cdn/new.jpg', resource.out) for resource in resources[:2]])
+        assert {r.out: r.url for r in manifest.iter_missing()}[resources[1].out] == 'http://cdn/new.jpg'
+
+
+def test_records_only_the_final_outcome(cdn, tmp_path):
+    out_dir = str(tmp_path)
+    resources = [
+        Resource(cdn + '/old/a.jpg', os.path.join(out_dir, 'a.jpg'), short_code='a', url_field='display_image_url'),
+        Resource(cdn + '/x/b.jpg?oe=%x' % (int(time.time()) - 10), os.path.join(out_dir, 'b.jpg'), short_code='b'),
+        Resource(cdn + '/old/g.jpg', os.path.join(out_dir, 'g.jpg'), short_code='gone'),
+        Resource(cdn + '/old/n.jpg', os.path.join(out_dir, 'n.jpg')),
+        Resource(cdn + '/ok/c.jpg', os.path.join(out_dir, 'c.jpg'), short_code='c'),
+    ]
+    query = _MediaQuery(cdn)
+    with DownloadManifest(os.path.join(out_dir, '.manifest.db')) as manifest, \
+            MediaUrlRefresher(query=query, query_hash='hash') as refresher:
+        manifest.add(resources)
+        with Downloader(max_workers=4, manifest=manifest, refresher=refresher, proxies={}) as downloader:
+            results = {os.path.basename(r.out): ok for r, ok in downloader.iter_download(resources)}
+        assert results == {'a.jpg': True, 'b.jpg': True, 'g.jpg': False, 'n.jpg': False, 'c.jpg': True}
+        assert sorted(query.short_codes) == ['a', 'b', 'gone']
+        manifest.flush()
+        assert _rows(manifest) == {
+            # Expired, refreshed and downloaded is one attempt.
+            'a.jpg': ('done', 1, None),
+            'b.jpg': ('done', 1, None),
+            'g.jpg': ('failed', 1, 'expired url, no fresh url'),
+            'n.jpg': ('failed', 1, 'status code 403'),
+            'c.jpg': ('done', 1, None),
+        }
+        assert [r.out for r in manifest.iter_missing()] == [resources[2].out, resources[3].out]
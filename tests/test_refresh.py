@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Tests of the refresher of the expired media urls
+# Author: Tishacy
+# Date: 2021-05-17
+from instagram.downloader import Resource
+from instagram.parser import MediaParser
+from instagram.refresh import MediaUrlRefresher
+
+
+def _node(short_code, **kwargs):
+    node = {
+        'id': '1',
+        'shortcode': short_code,
+        'edge_media_to_caption': {'edges': []},
+        'display_url': "http://cdn/new/%s.jpg" % short_code,
+        'is_video': True,
+        'video_url': "http://cdn/new/%s.mp4" % short_code,
+        'taken_at_timestamp': 1600000000,
+        'edge_media_preview_like': {'count': 7},
+        'edge_media_to_parent_comment': {'count': 3},
+    }
+    node.update(kwargs)
+    return node
+
+
+class _MediaQuery:
+    """Query of the media of a post failing the first query of the short code 'flaky'."""
+    def __init__(self):
+        self.short_codes = []
+
+    def query_batch(self, query_hash, variables):
+        short_code = variables['shortcode']
+        self.short_codes.append(short_code)
+        if short_code == 'flaky' and self.short_codes.count('flaky') == 1:
+            raise IOError("connection reset")
+        parser = MediaParser({'data': {'shortcode_media': _node(short_code)}}, variables)
+        return parser.parse_data(), variables, parser.parse_page_info()
+
+
+def test_media_parser():
+    record = MediaParser.get_info(_node('abc'))
+    assert record['likes_count'] == 7 and record['comments_count'] == 3
+    assert record.to_dict()['formatted-time'] is not None
+    assert record['video_url'] == "http://cdn/new/abc.mp4"
+
+
+def test_refresh_queries_a_post_once_and_a_failed_one_again():
+    query = _MediaQuery()
+    with MediaUrlRefresher(query=query, query_hash='hash') as refresher:
+        assert refresher.refresh(Resource('http://cdn/old/a.jpg', 'a.jpg', short_code='a')) == "http://cdn/new/a.jpg"
+        assert refresher.refresh(Resource('http://cdn/old/a.mp4', 'a.mp4', short_code='a')) == "http://cdn/new/a.mp4"
+        flaky = Resource('http://cdn/old/f.jpg', 'f.jpg', short_code='flaky')
+        assert refresher.refresh(flaky) is None
+        assert refresher.refresh(flaky) == "http://cdn/new/flaky.jpg"
+    assert query.short_codes == ['a', 'flaky', 'flaky']
+
+
+def test_refresh_keeps_the_urls_of_the_last_posts_only():
+    query = _MediaQuery()
+    with MediaUrlRefresher(query=query, query_hash='hash', max_posts=2) as refresher:
+        for short_code in ['a', 'b', 'a', 'c', 'a', 'b']:
+            refresher.refresh(Resource('http://cdn/old/x.jpg', 'x.jpg', short_code=short_code))
+        assert list(refresher._posts) == ['a', 'b']
+        assert refresher.post('a').result() == {'display_image_url': "http://cdn/new/a.jpg",
+                                                'video_url': "http://cdn/new/a.mp4"}
+    assert query.short_codes == ['a', 'b', 'c', 'b']
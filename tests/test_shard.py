@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Tests of the work queue and the workers of sharded crawls, against the mock server of the benchmarks
+# Author: Tishacy
+# Date: 2021-05-17
+import os
+import time
+
+import pytest
+
+from instagram.benchmark import MockServer, local_environment
+from instagram.query import Query
+from instagram.scheduler import Target
+from instagram.shard import WorkQueue, LeaseKeeper, LeaseLostError, LeasedCheckpoint, adopt_checkpoint, \
+    checkpoint_root, crawl_target, partition_fpath, merge_partitions, run_worker
+
+
+def test_claim_renew_finish(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.db'), lease=60)
+    assert queue.put([Target('author', '1', 10), Target('tag', 'cat', 10)]) == 2
+    assert queue.put([Target('author', '1', 10)]) == 0
+
+    _id, target, previous = queue.claim('w1')
+    assert (target.kind, target.name, previous) == ('author', '1', None)
+    assert queue.claim('w2')[1].name == 'cat'
+    assert queue.claim('w3') is None
+
+    assert queue.renew(_id, 'w1')
+    assert not queue.renew(_id, 'w2')
+    assert not queue.finish(_id, 'w2')
+    assert queue.finish(_id, 'w1', 'boom')
+    assert not queue.renew(_id, 'w1')
+    assert queue.progress() == {'failed': 1, 'running': 1}
+    assert queue.retry_failed() == 1
+    assert queue.claim('w3')[2] == 'w1'
+    queue.close()
+
+
+def test_reclaim_after_the_lease_expires(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.db'), lease=0.3)
+    queue.put([Target('author', '1', 10)])
+    _id, _, _ = queue.claim('w1')
+
+    # The heartbeat keeps the lease of a worker stalled for longer than the lease.
+    with LeaseKeeper(queue, _id, 'w1') as lease:
+        time.sleep(0.8)
+        assert queue.claim('w2') is None
+        lease.check()
+
+    time.sleep(0.4)
+    claimed_id, target, previous = queue.claim('w2')
+    assert (claimed_id, target.name, previous) == (_id, '1', 'w1')
+    # Only the new holder may finish the target.
+    assert not queue.finish(_id, 'w1')
+    with pytest.raises(LeaseLostError):
+        LeaseKeeper(queue, _id, 'w1').check()
+    assert queue.finish(_id, 'w2')
+    assert queue.progress() == {'done': 1}
+    queue.close()
+
+
+def test_takeover_of_a_target_from_its_checkpoint(tmp_path):
+    out_dir = str(tmp_path)
+    queue = WorkQueue(os.path.join(out_dir, 'queue.db'), lease=0.3)
+    target = Target('author', '7', None)
+    queue.put([target])
+    with MockServer(pages=10, page_size=10) as server, local_environment(server, []):
+        parser_cls, query_hash, variables = target.query_params()
+        _id, _, _ = queue.claim('w1')
+        with LeaseKeeper(queue, _id, 'w1') as lease:
+            pages = Query(parser_cls, LeasedCheckpoint(checkpoint_root(out_dir, 'w1'), lease)).iter_pages(
+                query_hash, variables)
+            next(pages), next(pages), next(pages)
+
+        time.sleep(0.4)
+        _id, _, previous = queue.claim('w2')
+        assert previous == 'w1'
+        # The previous holder never saves to its checkpoint once it lost the lease.
+        with pytest.raises(LeaseLostError):
+            next(pages)
+
+        fpath = partition_fpath(out_dir, target, '.jsonl')
+        os.makedirs(os.path.dirname(fpath))
+        with LeaseKeeper(queue, _id, 'w2') as lease:
+            assert adopt_checkpoint(out_dir, target, 'w2', previous)
+            checkpoint = LeasedCheckpoint(checkpoint_root(out_dir, 'w2'), lease)
+            assert crawl_target(target, fpath, lease.check, checkpoint, 'w2') == 100
+        assert queue.finish(_id, 'w2')
+        # 3 pages of the previous holder, the one it could not save, and the 7 pages left.
+        assert server.pages_sent == 11
+    queue.close()
+
+    with open(fpath, 'r', encoding='utf-8') as file:
+        assert len(set(file.read().splitlines())) == 100
+    assert os.listdir(checkpoint_root(out_dir, 'w1')) == []
+    assert os.listdir(checkpoint_root(out_dir, 'w2')) == []
+
+
+def test_lost_target_leaves_no_partition(tmp_path):
+    out_dir = str(tmp_path)
+    queue = WorkQueue(os.path.join(out_dir, 'queue.db'), lease=60)
+    target = Target('post', 'abc', None)
+    queue.put([target])
+    _id, _, _ = queue.claim('w1')
+    queue.finish(_id, 'w1', 'boom')
+    queue.retry_failed()
+    queue.claim('w2')
+
+    fpath = partition_fpath(out_dir, target, '.jsonl')
+    os.makedirs(os.path.dirname(fpath))
+    with MockServer(pages=2, page_size=10) as server, local_environment(server, []):
+        with pytest.raises(LeaseLostError):
+            crawl_target(target, fpath, LeaseKeeper(queue, _id, 'w1').check, None, 'w1')
+    assert os.listdir(os.path.dirname(fpath)) == []
+    queue.close()
+
+
+def test_run_worker_and_merge(tmp_path):
+    out_dir = str(tmp_path)
+    queue_fpath = os.path.join(out_dir, '.queue.db')
+    queue = WorkQueue(queue_fpath)
+    queue.put([Target('author', '1', 25), Target('author', '2', 25), Target('tag', 'cat', 10), Target('post', 'x', 5)])
+    with MockServer(pages=3, page_size=10) as server, local_environment(server, []):
+        assert run_worker(queue_fpath, out_dir, threads=2, worker='w1') == 4
+    assert queue.progress() == {'done': 4}
+    queue.close()
+
+    merged = merge_partitions(out_dir)
+    with open(merged['author'], 'r', encoding='utf-8') as file:
+        assert len(file.read().splitlines()) == 50
+    with open(merged['post'], 'r', encoding='utf-8') as file:
+        assert len(file.read().splitlines()) == 5